@@ -0,0 +1,196 @@
+"""
+Approximate Kernel SVR
+======================
+
+Support vector regression that scales to large catalogs.
+
+Fitting an exact kernel SVR scales roughly quadratically to cubically with the number
+of galaxies. Here the kernel is instead approximated with an explicit feature map,
+either with Nystroem landmarks (any kernel of SVR: rbf, poly, sigmoid) or with random
+Fourier features (rbf only), and a linear model is trained on the mapped features.
+The linear model is either solved exactly as a ridge regression from the normal
+equations accumulated batch by batch (the default), or trained with the
+epsilon-insensitive loss of SVR using stochastic gradient descent with a decaying
+step size (invscaling). For the latter the mapped features are centred and divided by
+their mean norm in the subsample, so that the step size means the same for all the
+kernels: the polynomial and sigmoid feature maps have a large scale, on which a
+constant step diverges. The input features are clipped to their range in the
+subsample, which bounds the extrapolation of the polynomial kernel to galaxies far
+outside the training set. The training runs over mini-batches, so only one mapped
+batch is held in memory at a time and the cost is linear in the number of galaxies.
+
+:requires: numpy
+:requires: scikit-learn
+
+:version: 0.1
+"""
+import numpy as np
+import time
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.kernel_approximation import Nystroem, RBFSampler
+from sklearn.linear_model import SGDRegressor
+from sklearn.svm import SVR
+from sklearn import metrics
+
+
+class ApproximateKernelSVR(BaseEstimator, RegressorMixin):
+    """
+    Kernel SVR approximated with a Nystroem or random Fourier feature map and a
+    linear epsilon-insensitive regressor trained in mini-batches.
+
+    The parameters kernel, C, epsilon, gamma, degree and coef0 have the same meaning as
+    in sklearn.svm.SVR (gamma=0.0 means 1/n_features), so the SVR search grids can be used
+    as they are.
+
+    :param method: 'nystroem' or 'fourier'
+    :param solver: 'ridge' for least squares solved in a single pass (the penalty is 1/(2C),
+                   epsilon is not used), or 'sgd' for the epsilon-insensitive loss of SVR
+    :param n_components: dimension of the feature map (number of landmarks)
+    :param batch_size: number of galaxies per mini-batch
+    :param n_epochs: number of passes over the training data
+    """
+    def __init__(self, kernel='rbf', C=1.0, epsilon=0.1, gamma=0.0, degree=3, coef0=0.0, method='nystroem',
+                 solver='ridge', n_components=500, batch_size=10000, n_epochs=5, random_state=None, verbose=0):
+        self.kernel = kernel
+        self.C = C
+        self.epsilon = epsilon
+        self.gamma = gamma
+        self.degree = degree
+        self.coef0 = coef0
+        self.method = method
+        self.solver = solver
+        self.n_components = n_components
+        self.batch_size = batch_size
+        self.n_epochs = n_epochs
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def _featureMap(self, nfeatures):
+        gamma = self.gamma if self.gamma > 0 else 1. / nfeatures
+        if self.method == 'fourier':
+            if self.kernel != 'rbf':
+                raise ValueError('random Fourier features are only available for the rbf kernel')
+            return RBFSampler(gamma=gamma, n_components=self.n_components, random_state=self.random_state)
+        if self.method == 'nystroem':
+            return Nystroem(kernel=self.kernel, gamma=gamma, degree=self.degree, coef0=self.coef0,
+                            n_components=self.n_components, random_state=self.random_state)
+        raise ValueError('method must be nystroem or fourier, got %s' % self.method)
+
+    def _batches(self, n, rng=None):
+        starts = np.arange(0, n, self.batch_size)
+        if rng is not None:
+            rng.shuffle(starts)
+        for start in starts:
+            yield start, min(start + self.batch_size, n)
+
+    def fit(self, X, y):
+        """
+        Fit the feature map on a random subsample and train the linear model in mini-batches.
+        """
+        n = X.shape[0]
+        y = np.asarray(y).ravel()
+        rng = np.random.RandomState(self.random_state)
+        subsample = np.sort(rng.choice(n, min(n, max(10 * self.n_components, 20000)), replace=False))
+        sample = np.asarray(X[subsample], dtype=np.float64)
+        self.inputMin_, self.inputMax_ = sample.min(axis=0), sample.max(axis=0)
+        self.featureMap_ = self._featureMap(X.shape[1]).fit(sample)
+
+        if self.solver == 'ridge':
+            self._fitRidge(X, y)
+        elif self.solver == 'sgd':
+            self._fitSGD(sample, X, y, rng)
+        else:
+            raise ValueError('solver must be sgd or ridge, got %s' % self.solver)
+        return self
+
+    def _transform(self, X):
+        """
+        Mapped features of a batch, normalised for the SGD solver.
+        """
+        Z = self.featureMap_.transform(np.clip(np.asarray(X, dtype=np.float64), self.inputMin_, self.inputMax_))
+        if self.solver == 'sgd':
+            Z -= self.mapMean_
+            Z /= self.mapScale_
+        return Z
+
+    def _fitSGD(self, sample, X, y, rng):
+        #a single scale for all the components keeps the geometry of the feature map
+        Z = self.featureMap_.transform(sample)
+        self.mapMean_ = Z.mean(axis=0)
+        self.mapScale_ = max(np.sqrt(np.mean(np.sum((Z - self.mapMean_) ** 2, axis=1))), 1e-12)
+        #alpha of the l2 penalty corresponding to the C of SVR
+        self.linear_ = SGDRegressor(loss='epsilon_insensitive', epsilon=self.epsilon, penalty='l2',
+                                    alpha=1. / (self.C * X.shape[0]), learning_rate='invscaling', eta0=0.01,
+                                    power_t=0.25, random_state=self.random_state)
+        for epoch in range(self.n_epochs):
+            for start, stop in self._batches(X.shape[0], rng):
+                self.linear_.partial_fit(self._transform(X[start:stop]), y[start:stop])
+            if self.verbose:
+                print 'Epoch %i done' % (epoch + 1)
+
+    def _fitRidge(self, X, y):
+        """
+        Ridge regression with an intercept from the normal equations, accumulated in one pass.
+        """
+        m = self._transform(X[:1]).shape[1]
+        ZZ, Zy, Zsum = np.zeros((m, m)), np.zeros(m), np.zeros(m)
+        for start, stop in self._batches(X.shape[0]):
+            Z = self._transform(X[start:stop])
+            ZZ += np.dot(Z.T, Z)
+            Zy += np.dot(Z.T, y[start:stop])
+            Zsum += Z.sum(axis=0)
+        n = X.shape[0]
+        Zmean, ymean = Zsum / n, y.mean()
+        covariance = ZZ - n * np.outer(Zmean, Zmean) + np.eye(m) / (2. * self.C)
+        self.coef_ = np.linalg.solve(covariance, Zy - n * Zmean * ymean)
+        self.intercept_ = ymean - np.dot(Zmean, self.coef_)
+        self.linear_ = None
+
+    def predict(self, X):
+        """
+        Predict the redshifts of the rows of X, one mini-batch at a time.
+        """
+        predicted = np.empty(X.shape[0])
+        for start, stop in self._batches(X.shape[0]):
+            Z = self._transform(X[start:stop])
+            if self.linear_ is None:
+                predicted[start:stop] = np.dot(Z, self.coef_) + self.intercept_
+            else:
+                predicted[start:stop] = self.linear_.predict(Z)
+        return predicted
+
+
+def compareWithExactSVR(X_train, X_test, y_train, y_test, sizes=(1000, 3000, 10000, 30000), kernel='rbf',
+                        methods=('nystroem', 'fourier'), solvers=('ridge', 'sgd'), maxExact=30000):
+    """
+    Compare the fit time and the accuracy (RMS, R2) of the exact SVR and the approximate
+    kernel SVR on random subsamples of the training data of the given sizes. The exact
+    SVR is skipped for subsamples larger than maxExact.
+    """
+    rng = np.random.RandomState(42)
+    models = [('exact', lambda: SVR(kernel=kernel))]
+    for method in methods:
+        if method == 'fourier' and kernel != 'rbf':
+            continue
+        for solver in solvers:
+            models.append(('%s/%s' % (method, solver),
+                           lambda method=method, solver=solver: ApproximateKernelSVR(kernel=kernel, method=method,
+                                                                                     solver=solver, random_state=42)))
+
+    print '%10s %16s %12s %10s %10s' % ('size', 'method', 'fit [s]', 'RMS', 'R2')
+    results = []
+    for size in sizes:
+        rows = np.sort(rng.choice(X_train.shape[0], min(size, X_train.shape[0]), replace=False))
+        for name, model in models:
+            if name == 'exact' and size > maxExact:
+                continue
+            clf = model()
+            start = time.time()
+            clf.fit(X_train[rows], y_train[rows])
+            fitTime = time.time() - start
+            predicted = clf.predict(X_test)
+            rms = np.sqrt(np.mean((y_test - predicted) ** 2))
+            r2 = metrics.r2_score(y_test, predicted)
+            print '%10i %16s %12.2f %10.4f %10.4f' % (len(rows), name, fitTime, rms, r2)
+            results.append(dict(size=len(rows), method=name, fit_time=fitTime, rms=rms, r2=r2))
+    return results
@@ -0,0 +1,128 @@
+"""
+Batched Random Forest
+=====================
+
+Random forest regression with a memory use bounded by the batch size.
+
+A forest of thousands of deep trees does not fit in the memory of a normal node (5000
+trees of depth 28 on the Kaggle data need about 36GB). Here the forest is grown in
+batches of trees with warm starts. After each batch the new trees are flattened to
+the compact node arrays of modelStore, written to disk and released, so only one
+batch of trees is held in memory at a time.
+
+Because the forest is grown with warm starts, the trees are the same as those of a
+RandomForestRegressor with the same random_state fitted in one go. Prediction streams
+through the batches on disk (memory-mapped) and accumulates the sum over the trees in
+the same order as RandomForestRegressor.predict, so the predictions are identical too.
+
+:requires: numpy
+:requires: scikit-learn
+
+:version: 0.1
+"""
+import numpy as np
+import json
+import shutil
+import tempfile
+import os
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.ensemble import RandomForestRegressor
+import modelStore
+
+
+class BatchedRandomForestRegressor(BaseEstimator, RegressorMixin):
+    """
+    RandomForestRegressor trained in batches of batch_size trees that are spilled to a
+    model store folder. The forest parameters have the same meaning as in
+    RandomForestRegressor (out-of-bag scores are not supported).
+
+    :param batch_size: number of trees held in memory during the training
+    :param folder: model store folder the batches are written to; by default a temporary
+                   folder, which is removed by close
+    """
+    def __init__(self, n_estimators=2000, batch_size=100, folder=None, max_depth=None, max_features='auto',
+                 min_samples_split=2, min_samples_leaf=1, bootstrap=True, n_jobs=1, random_state=None, verbose=0):
+        self.n_estimators = n_estimators
+        self.batch_size = batch_size
+        self.folder = folder
+        self.max_depth = max_depth
+        self.max_features = max_features
+        self.min_samples_split = min_samples_split
+        self.min_samples_leaf = min_samples_leaf
+        self.bootstrap = bootstrap
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def _prepareFolder(self):
+        """
+        The folder the batches are written to: a new temporary folder if no folder is
+        given, otherwise the given folder, from which only the batches of an earlier
+        batched forest are removed (e.g. the features.pkl saved with it is kept).
+        """
+        self.close()
+        if self.folder is None:
+            self.temporaryFolder_ = tempfile.mkdtemp(prefix='batchedForest')
+            return self.temporaryFolder_
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        filename = os.path.join(self.folder, 'meta.json')
+        if os.path.exists(filename):
+            with open(filename) as fh:
+                meta = json.load(fh)
+            if meta['kind'] == 'batched':
+                for name in meta['batches']:
+                    shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+            os.remove(filename)
+        return self.folder
+
+    def fit(self, X, y):
+        """
+        Grow the forest batch by batch and write each batch to the folder.
+        """
+        folder = self._prepareFolder()
+
+        forest = RandomForestRegressor(n_estimators=0, warm_start=True, max_depth=self.max_depth,
+                                       max_features=self.max_features, min_samples_split=self.min_samples_split,
+                                       min_samples_leaf=self.min_samples_leaf, bootstrap=self.bootstrap,
+                                       n_jobs=self.n_jobs, random_state=self.random_state, verbose=self.verbose)
+        batches = []
+        importances = 0.
+        for start in range(0, self.n_estimators, self.batch_size):
+            stop = min(start + self.batch_size, self.n_estimators)
+            forest.set_params(n_estimators=stop)
+            forest.fit(X, y)
+
+            trees = forest.estimators_[start:stop]
+            arrays, meta = modelStore.flattenTrees(trees)
+            name = 'batch%05i' % len(batches)
+            modelStore.saveArrays(arrays, meta, os.path.join(folder, name))
+            batches.append(name)
+            importances += np.sum([tree.feature_importances_ for tree in trees], axis=0)
+            #keep placeholders so that the warm start draws the same random states
+            forest.estimators_[start:stop] = [None] * len(trees)
+            if self.verbose:
+                print 'Batch %i: %i of %i trees written to %s' % (len(batches), stop, self.n_estimators, folder)
+
+        self.feature_importances_ = importances / self.n_estimators
+        meta = {'kind': 'batched', 'n_trees': self.n_estimators, 'n_features': int(X.shape[1]), 'batches': batches}
+        with open(os.path.join(folder, 'meta.json'), 'w') as fh:
+            json.dump(meta, fh, indent=1)
+        self.ensemble_ = modelStore.loadEnsemble(folder)
+        return self
+
+    def close(self):
+        """
+        Remove the temporary folder of the batches, if fit created one. A folder given
+        as folder is never removed.
+        """
+        if getattr(self, 'temporaryFolder_', None) is not None:
+            shutil.rmtree(self.temporaryFolder_, ignore_errors=True)
+            self.temporaryFolder_ = None
+            self.ensemble_ = None
+
+    def predict(self, X):
+        """
+        Predict the redshifts of the rows of X, streaming through the batches on disk.
+        """
+        return self.ensemble_.predict(X)
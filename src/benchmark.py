@@ -0,0 +1,414 @@
+"""
+Benchmarks
+==========
+
+Benchmark suite for the training and inference paths.
+
+Synthetic catalogs in the format of the Kaggle training file (ugriz magnitudes, their
+errors and a redshift) are generated so that the benchmarks run offline. The loading,
+the fit and the predict of each model and plotResults are then timed for a range of
+catalog sizes and n_jobs settings. Every case runs in a fresh Python process, so that
+the peak resident memory reported for it belongs to that case only.
+
+The results (wall time, peak RSS and rows per second, plus the versions of the
+libraries) are written to a JSON file. Two such files, e.g. from two versions of the
+code, can be compared with compareBenchmarks.
+
+The cold start of a short scoring job (a fresh process running photoz.py predict on a
+small catalog) is measured separately with coldStart, and the latency of the predict of
+the tree ensembles against the compiled evaluator of modelStore with evaluatorLatency.
+serviceLoad runs the load generator of scoringService against a local scoring service
+with and without micro-batching.
+
+Usage::
+
+    python benchmark.py run benchmark.json
+    python benchmark.py compare old.json new.json
+    python benchmark.py startup
+    python benchmark.py latency
+    python benchmark.py service
+
+:requires: pandas
+:requires: numpy
+:requires: scikit-learn
+:requires: matplotlib
+
+:version: 0.1
+"""
+import numpy as np
+import subprocess
+import platform
+import tempfile
+import json
+import time
+import sys
+import os
+
+
+#models and their settings, the same as in photometricRedshifts but with fewer trees
+MODELS = ('randomForest', 'GradientBoostingRegressor', 'BayesianRidge', 'SupportVectorRegression', 'NearestNeighbours')
+MAXIMUM_SVR_SIZE = 20000
+
+
+def syntheticCatalog(filename, n, random_state=42, chunksize=100000, query=False):
+    """
+    Write a synthetic catalog of n galaxies in the format of the Kaggle files.
+
+    The redshifts follow a gamma distribution peaking at low redshift. The colours
+    redden with redshift, the magnitude errors grow exponentially with the magnitude
+    and the magnitudes are scattered by their errors. With query=True the redshift
+    column is left out, as in the Kaggle query file. Written in chunks, so that the
+    memory use does not depend on n.
+    """
+    rng = np.random.RandomState(random_state)
+    folder = os.path.dirname(filename)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    columns = ['ID', 'u', 'g', 'r', 'i', 'z', 'modelmagerr_u', 'modelmagerr_g',
+               'modelmagerr_r', 'modelmagerr_i', 'modelmagerr_z']
+    if not query:
+        columns.append('redshift')
+
+    fh = open(filename, 'w')
+    fh.write(','.join(columns) + '\n')
+    for start in range(0, n, chunksize):
+        size = min(chunksize, n - start)
+        z = rng.gamma(2., 0.08, size)
+        r = 17. + 2.5 * np.log10(1. + 10. * z) + rng.normal(0., 0.8, size)
+        colours = np.column_stack((1.3 + 2.5 * z, 0.6 + 1.8 * z, 0.25 + 0.9 * z, 0.15 + 0.5 * z))
+        colours += rng.normal(0., 0.1, colours.shape)
+        magnitudes = np.column_stack((r + colours[:, 0] + colours[:, 1], r + colours[:, 1], r,
+                                      r - colours[:, 2], r - colours[:, 2] - colours[:, 3]))
+        errors = 0.005 + 0.02 * np.exp(0.6 * (magnitudes - 21.))
+        magnitudes += rng.normal(0., 1., magnitudes.shape) * errors
+        data = [np.arange(start, start + size), magnitudes, errors]
+        if not query:
+            data.append(z)
+        np.savetxt(fh, np.column_stack(data), fmt=['%d'] + ['%.5f'] * (len(columns) - 1), delimiter=',')
+    fh.close()
+
+
+def _estimator(model, n_jobs, n_estimators):
+    """
+    The estimators of the model functions of photometricRedshifts with the given
+    number of trees and n_jobs.
+    """
+    from photometricRedshifts import RandomForestRegressor, GBR, SVR, linear_model, NearestNeighbourRegressor, \
+        RANDOM_FOREST, GRADIENT_BOOSTING, BAYESIAN_RIDGE, NEAREST_NEIGHBOURS
+    if model == 'randomForest':
+        return RandomForestRegressor(n_estimators=n_estimators, n_jobs=n_jobs, **RANDOM_FOREST)
+    if model == 'GradientBoostingRegressor':
+        return GBR(n_estimators=n_estimators, **GRADIENT_BOOSTING)
+    if model == 'BayesianRidge':
+        return linear_model.BayesianRidge(**BAYESIAN_RIDGE)
+    if model == 'NearestNeighbours':
+        return NearestNeighbourRegressor(n_jobs=n_jobs, **NEAREST_NEIGHBOURS)
+    return SVR()
+
+
+def _runCase(case):
+    """
+    Run a single benchmark case, called in a fresh process.
+    """
+    import resource
+    import photometricRedshifts as pz
+
+    result = {}
+    if case['stage'] == 'load':
+        start = time.time()
+        pz.loadKaggledata(folder=case['folder'], useErrors=True)
+        result['wall'] = time.time() - start
+        result['rows'] = case['size']
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        result['rows_per_second'] = result['rows'] / max(result['wall'], 1e-9)
+        return result
+
+    X_train, X_test, y_train, y_test = pz.loadKaggledata(folder=case['folder'], useErrors=True)
+    if case['stage'] == 'plotResults':
+        start = time.time()
+        pz.plotResults(y_test + np.random.normal(0, 0.02, y_test.shape), y_test,
+                       output=os.path.join(case['folder'], 'benchmark'))
+        result['wall'] = time.time() - start
+        result['rows'] = len(y_test)
+    else:
+        #fit and predict in the same process, the peak RSS of predict includes that of the fit
+        estimator = _estimator(case['model'], case['n_jobs'], case['n_estimators'])
+        start = time.time()
+        estimator.fit(X_train, y_train)
+        result['fit'] = {'wall': time.time() - start, 'rows': len(y_train),
+                         'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+        start = time.time()
+        estimator.predict(X_test)
+        result['predict'] = {'wall': time.time() - start, 'rows': len(y_test),
+                             'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+        for stage in result.values():
+            stage['rows_per_second'] = stage['rows'] / max(stage['wall'], 1e-9)
+        return result
+
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    result['rows_per_second'] = result['rows'] / max(result['wall'], 1e-9)
+    return result
+
+
+def _environment():
+    import sklearn
+    import pandas
+    environment = {'python': platform.python_version(), 'numpy': np.__version__,
+                   'sklearn': sklearn.__version__, 'pandas': pandas.__version__,
+                   'machine': platform.node(), 'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    try:
+        environment['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                                        cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        environment['commit'] = None
+    return environment
+
+
+def runBenchmarks(output='benchmark.json', sizes=(10000, 100000, 1000000), n_jobs=(1, -1), models=MODELS,
+                  n_estimators=100, folder='benchmarkData/'):
+    """
+    Run the benchmark suite and write the results to a JSON file.
+
+    For every catalog size: loadKaggledata, the fit and the predict of every model for
+    every n_jobs setting (the n_jobs settings only apply to the random forest and the kNN
+    queries) and plotResults.
+    SVR is only run for catalogs up to MAXIMUM_SVR_SIZE galaxies.
+    """
+    cases = []
+    for size in sizes:
+        data = os.path.join(folder, str(size)) + '/'
+        if not os.path.exists(data + 'train.csv'):
+            print 'Generating a synthetic catalog of %i galaxies' % size
+            syntheticCatalog(data + 'train.csv', size)
+        cases.append({'stage': 'load', 'size': size, 'folder': data})
+        for model in models:
+            if model == 'SupportVectorRegression' and size > MAXIMUM_SVR_SIZE:
+                continue
+            for jobs in (n_jobs if model in ('randomForest', 'NearestNeighbours') else (1,)):
+                cases.append({'stage': 'model', 'model': model, 'n_jobs': jobs, 'size': size,
+                              'n_estimators': n_estimators, 'folder': data})
+        cases.append({'stage': 'plotResults', 'size': size, 'folder': data})
+
+    results = []
+    for case in cases:
+        handle, resultFile = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        with open(os.devnull, 'w') as devnull:
+            status = subprocess.call([sys.executable, os.path.abspath(__file__), 'case', json.dumps(case),
+                                      resultFile], stdout=devnull)
+        if status == 0:
+            with open(resultFile) as fh:
+                result = json.load(fh)
+        else:
+            result = {'error': status}
+        os.remove(resultFile)
+
+        if case['stage'] == 'model':
+            records = [dict(case, stage=stage, **result.get(stage, result)) for stage in ('fit', 'predict')]
+        else:
+            records = [dict(case, **result)]
+        for record in records:
+            print '%-12s %-26s n_jobs=%-3s size=%-9i %s' % \
+                  (record['stage'], record.get('model', ''), record.get('n_jobs', ''), record['size'],
+                   'failed' if 'error' in record else '%.2f s, %.0f MB, %.0f rows/s' %
+                   (record['wall'], record['peak_rss_mb'], record['rows_per_second']))
+        results += records
+
+    with open(output, 'w') as fh:
+        json.dump({'environment': _environment(), 'results': results}, fh, indent=1)
+    return results
+
+
+def _caseKey(case):
+    return (case['stage'], case.get('model'), case.get('n_jobs'), case['size'])
+
+
+def compareBenchmarks(old, new, tolerance=0.1, minimum=0.05):
+    """
+    Compare two benchmark files and report the cases that got slower or use more
+    memory by more than the tolerance (a fraction). Differences in wall time below
+    minimum seconds are ignored.
+
+    :return: list of the regressions
+    """
+    with open(old) as fh:
+        before = dict((_caseKey(case), case) for case in json.load(fh)['results'] if 'error' not in case)
+    with open(new) as fh:
+        after = dict((_caseKey(case), case) for case in json.load(fh)['results'] if 'error' not in case)
+
+    regressions = []
+    print '%-12s %-26s %-6s %-9s %10s %10s %10s %10s' % ('stage', 'model', 'n_jobs', 'size',
+                                                          'old [s]', 'new [s]', 'old [MB]', 'new [MB]')
+    for key in sorted(set(before) & set(after)):
+        b, a = before[key], after[key]
+        slower = a['wall'] > (1. + tolerance) * b['wall'] and a['wall'] - b['wall'] > minimum
+        larger = a['peak_rss_mb'] > (1. + tolerance) * b['peak_rss_mb']
+        flag = ' <- regression' if slower or larger else ''
+        print '%-12s %-26s %-6s %-9i %10.2f %10.2f %10.0f %10.0f%s' % (key[0], key[1] or '', key[2] or '', key[3],
+                                                                     b['wall'], a['wall'], b['peak_rss_mb'],
+                                                                     a['peak_rss_mb'], flag)
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def _timeProcess(command, repeats):
+    """
+    Median wall time of running a command in a fresh process.
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeats):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def _smallModel(folder, size):
+    """
+    A small GBR saved to the model store with its features transform, trained on a
+    synthetic catalog, and a synthetic query catalog of size galaxies.
+    """
+    model = os.path.join(folder, 'model/')
+    if not os.path.exists(os.path.join(model, 'features.pkl')):
+        import photometricRedshifts as pz
+        import modelStore
+        syntheticCatalog(os.path.join(folder, 'train.csv'), 20000)
+        features = pz.PhotometricFeatures()
+        X_train, X_test, y_train, y_test = pz.loadKaggledata(folder=folder, features=features)
+        modelStore.saveEnsemble(_estimator('GradientBoostingRegressor', 1, 100).fit(X_train, y_train), model)
+        modelStore.saveFeatures(features, model)
+    catalog = os.path.join(folder, 'query%i.csv' % size)
+    if not os.path.exists(catalog):
+        syntheticCatalog(catalog, size, query=True)
+    return model, catalog
+
+
+def coldStart(size=1000, repeats=5, folder='benchmarkData/coldStart/'):
+    """
+    Measure the cold start of a predict-only job: the median wall time of photoz.py
+    predict (n_jobs=1) scoring a catalog of size galaxies with a small saved GBR in a
+    fresh process. For reference the time of starting Python with numpy only and of
+    importing the training module (photometricRedshifts) are measured too.
+
+    :return: dictionary of the median times in seconds
+    """
+    source = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(source, 'photoz.py')
+    model, catalog = _smallModel(folder, size)
+
+    python = [sys.executable, '-c']
+    result = {'python_numpy': _timeProcess(python + ['import numpy'], repeats),
+              'import_photometricRedshifts': _timeProcess(python + ['import sys; sys.path.insert(0, %r); '
+                                                                    'import photometricRedshifts' % source],
+                                                          repeats),
+              'predict': _timeProcess([sys.executable, script, 'predict', model, catalog,
+                                       os.path.join(folder, 'photoz.csv')], repeats),
+              'rows': size}
+    for name in ('python_numpy', 'import_photometricRedshifts', 'predict'):
+        print '%-28s %.3f s' % (name, result[name])
+    return result
+
+
+def _medianTime(function, repeats):
+    """
+    Median wall time of calling function.
+    """
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def evaluatorLatency(models=('randomForest', 'GradientBoostingRegressor'), sizes=(1, 10, 100, 1000, 10000, 100000,
+                                                                                    1000000),
+                     n_estimators=200, n_jobs=1, training=20000, repeats=5, folder='benchmarkData/latency/'):
+    """
+    Latency of the predict of the tree ensembles against that of the compiled flat
+    evaluator of modelStore (compileEnsemble), for batches of the given sizes. The
+    models are trained on a synthetic catalog of training galaxies, and the batches are
+    rows of a synthetic query catalog of the largest size.
+
+    :return: list of dictionaries with the median times in seconds
+    """
+    import photometricRedshifts as pz
+    import modelStore
+    filename = os.path.join(folder, 'train.csv')
+    if not os.path.exists(filename):
+        syntheticCatalog(filename, training)
+    X_train, X_test, y_train, y_test = pz.loadKaggledata(folder=folder, useErrors=True)
+    rng = np.random.RandomState(42)
+    X = X_test[rng.randint(0, X_test.shape[0], max(sizes))]
+
+    results = []
+    print '%-26s %9s %12s %12s %8s' % ('model', 'rows', 'predict', 'compiled', 'speed-up')
+    for model in models:
+        estimator = _estimator(model, n_jobs, n_estimators).fit(X_train, y_train)
+        compiled = modelStore.compileEnsemble(estimator)
+        for size in sizes:
+            batch = X[:size]
+            repeat = repeats if size <= 100000 else 1
+            result = {'model': model, 'rows': size,
+                      'predict': _medianTime(lambda: estimator.predict(batch), repeat),
+                      'compiled': _medianTime(lambda: compiled.predict(batch, n_jobs), repeat)}
+            print '%-26s %9i %10.5f s %10.5f s %8.2f' % (model, size, result['predict'], result['compiled'],
+                                                         result['predict'] / result['compiled'])
+            results.append(result)
+    return results
+
+
+def serviceLoad(clients=(1, 4, 16, 64), maxWait=(0., 0.005), requests=2000, rows=1, port=8765, workers=1,
+                folder='benchmarkData/coldStart/'):
+    """
+    Load test of the scoring service (see scoringService) with the small saved GBR of
+    coldStart: for every maximum wait a service is started in a fresh process and loaded
+    by increasing numbers of concurrent clients sending requests of rows galaxies.
+
+    :return: list of the results of scoringService.loadTest
+    """
+    import scoringService
+    import urllib2
+    model, catalog = _smallModel(folder, 10000)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scoringService.py')
+    url = 'http://127.0.0.1:%i' % port
+    results = []
+    for wait in maxWait:
+        print 'Maximum wait %.1f ms' % (1e3 * wait)
+        service = subprocess.Popen([sys.executable, script, 'serve', model, '--port', str(port),
+                                    '--max-wait', str(wait), '--workers', str(workers)])
+        try:
+            for i in range(600):
+                try:
+                    scoringService.stats(url)
+                    break
+                except urllib2.URLError:
+                    time.sleep(0.05)
+            for count in clients:
+                result = scoringService.loadTest(url, catalog, count, requests, rows)
+                result['max_wait'] = wait
+                results.append(result)
+        finally:
+            service.terminate()
+            service.wait()
+    return results
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'case':
+        result = _runCase(json.loads(sys.argv[2]))
+        with open(sys.argv[3], 'w') as fh:
+            json.dump(result, fh)
+    elif sys.argv[1] == 'run':
+        runBenchmarks(*sys.argv[2:3])
+    elif sys.argv[1] == 'compare':
+        compareBenchmarks(sys.argv[2], sys.argv[3])
+    elif sys.argv[1] == 'startup':
+        coldStart()
+    elif sys.argv[1] == 'latency':
+        evaluatorLatency()
+    elif sys.argv[1] == 'service':
+        serviceLoad()
@@ -0,0 +1,123 @@
+"""
+Density Plots
+=============
+
+Photo-z versus spectroscopic redshift plots for catalogs of millions of galaxies.
+
+Instead of drawing every galaxy as a marker in a vector file, the galaxies are binned
+to a 2D histogram of spectroscopic redshift and photo-z, which is drawn as a single
+raster image. The histogram is accumulated with one bincount per chunk of galaxies, so
+it can be filled from streamed predictions and histograms of parallel workers can be
+added together. For every spectroscopic redshift bin the bias and the scatter of
+dz/(1+z) and the fraction of catastrophic outliers (|dz|/(1+z) > 0.15) are accumulated
+as well and shown below the histogram.
+
+The plot time and the size of the file depend on the number of bins only, not on the
+number of galaxies.
+
+:requires: numpy
+:requires: matplotlib
+
+:version: 0.1
+"""
+import numpy as np
+from plotting import plt
+
+
+class RedshiftDensity(object):
+    """
+    2D histogram of photo-z versus spectroscopic redshift with per-bin statistics.
+
+    :param zmax: upper limit of both axes, by default 1.1 times the largest spectroscopic
+                 redshift of the first chunk; galaxies beyond it go to the last bin
+    :param bins: number of bins per axis
+    :param outlier: limit of |dz|/(1+z) for catastrophic outliers
+    """
+    def __init__(self, zmax=None, bins=200, outlier=0.15):
+        self.zmax = zmax
+        self.bins = bins
+        self.outlier = outlier
+        self.counts = np.zeros((bins, bins), dtype=np.int64)
+        self.columnCounts = np.zeros(bins, dtype=np.int64)
+        self.biasSum = np.zeros(bins)
+        self.biasSquares = np.zeros(bins)
+        self.outliers = np.zeros(bins, dtype=np.int64)
+
+    def _bin(self, z):
+        return np.clip((z * (self.bins / self.zmax)).astype(np.int64), 0, self.bins - 1)
+
+    def update(self, predicted, expected):
+        """
+        Add a chunk of galaxies.
+        """
+        predicted = np.asarray(predicted, dtype=np.float64).ravel()
+        expected = np.asarray(expected, dtype=np.float64).ravel()
+        if self.zmax is None:
+            self.zmax = 1.1 * expected.max()
+        column = self._bin(expected)
+        row = self._bin(predicted)
+        self.counts += np.bincount(row * self.bins + column, minlength=self.bins ** 2).reshape(self.bins, self.bins)
+
+        dz = (predicted - expected) / (1. + expected)
+        self.columnCounts += np.bincount(column, minlength=self.bins)
+        self.biasSum += np.bincount(column, weights=dz, minlength=self.bins)
+        self.biasSquares += np.bincount(column, weights=dz * dz, minlength=self.bins)
+        self.outliers += np.bincount(column, weights=np.abs(dz) > self.outlier, minlength=self.bins).astype(np.int64)
+        return self
+
+    def merge(self, other):
+        """
+        Add the histogram of another RedshiftDensity with the same binning.
+        """
+        if (other.zmax, other.bins) != (self.zmax, self.bins):
+            raise ValueError('the binning of the histograms differs')
+        for name in ('counts', 'columnCounts', 'biasSum', 'biasSquares', 'outliers'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def statistics(self):
+        """
+        Centres of the spectroscopic redshift bins and the bias, the scatter of dz/(1+z)
+        and the outlier fraction in each bin (nan for empty bins).
+        """
+        centres = (np.arange(self.bins) + 0.5) * self.zmax / self.bins
+        n = np.where(self.columnCounts > 0, self.columnCounts, np.nan)
+        bias = self.biasSum / n
+        scatter = np.sqrt(np.maximum(self.biasSquares / n - bias ** 2, 0.))
+        return centres, bias, scatter, self.outliers / n
+
+    def plot(self, output, title=''):
+        """
+        Draw the histogram as a raster and the per-bin statistics below it.
+        """
+        #imported here so that importing this module does not import matplotlib
+        from matplotlib.colors import LogNorm
+
+        centres, bias, scatter, outliers = self.statistics()
+        fig = plt.figure(figsize=(7, 9))
+        ax1 = fig.add_axes([0.12, 0.36, 0.68, 0.58])
+        ax2 = fig.add_axes([0.12, 0.07, 0.68, 0.22], sharex=ax1)
+        colourbar = fig.add_axes([0.82, 0.36, 0.03, 0.58])
+        ax1.set_title(title)
+
+        counts = np.ma.masked_equal(self.counts, 0)
+        image = ax1.imshow(counts, origin='lower', extent=(0, self.zmax, 0, self.zmax), aspect='auto',
+                           interpolation='nearest', cmap=plt.cm.Blues, norm=LogNorm(vmin=1, vmax=max(counts.max(), 1)))
+        fig.colorbar(image, cax=colourbar, label='galaxies per bin')
+        ax1.plot([0, self.zmax], [0, self.zmax], '-r', lw=0.8)
+        ax1.set_xlim(0, self.zmax)
+        ax1.set_ylim(0, self.zmax)
+        ax1.set_ylabel('Photo-z')
+
+        ax2.plot(centres, bias, 'b-', label=r'bias $\Delta z / (1+z)$')
+        ax2.fill_between(centres, bias - scatter, bias + scatter, color='b', alpha=0.2)
+        ax2.axhline(0, color='k', lw=0.5)
+        ax2.set_xlabel('Spectroscopic Redshift')
+        ax2.set_ylabel('bias')
+        ax3 = ax2.twinx()
+        ax3.plot(centres, outliers, 'r-', label='outlier fraction')
+        ax3.set_ylabel('outlier fraction (> %.2f)' % self.outlier, color='r')
+        ax3.set_ylim(0, 1)
+
+        plt.savefig(output)
+        plt.close()
@@ -0,0 +1,257 @@
+"""
+Diagnostics Runner
+==================
+
+Runs the model fits behind the diagnostic plots (validation curves, learning curves
+and deviance plots) as independent tasks.
+
+Every task is a single fit: one cross-validation fold of one parameter value, one
+split of one training set size, or one gradient boosting model for the deviance
+plots. Identical tasks, e.g. the baseline GBR that appears in several plots, are
+run only once. The tasks that are not in the cache are run in a pool of worker
+processes, the number of which is chosen so that the workers fit in the memory
+budget, and the scores of every finished task are written to the cache folder. Re-rendering a
+plot, or adding one more parameter value, then only runs the missing fits.
+
+:requires: numpy
+:requires: scikit-learn
+
+:version: 0.1
+"""
+import numpy as np
+from sklearn.base import clone
+from sklearn import cross_validation
+from hyperparameterSearch import dataFile, dataFingerprint, estimatorFingerprint, _limitMemory
+import multiprocessing
+import hashlib
+import errno
+import os
+try:
+    from sklearn.ensemble._gradient_boosting import predict_stage
+except ImportError:
+    predict_stage = None
+
+
+def _folds(fold):
+    """
+    Train and test indices of a fold described by a tuple, so that the workers can
+    regenerate the indices instead of receiving them.
+    """
+    if fold[0] == 'kfold':
+        kind, n, n_folds, i = fold
+        cv = cross_validation.KFold(n, n_folds=n_folds)
+    else:
+        kind, n, n_iter, test_size, random_state, i = fold
+        cv = cross_validation.ShuffleSplit(n, n_iter=n_iter, test_size=test_size, random_state=random_state)
+    for j, (train, test) in enumerate(cv):
+        if j == i:
+            return train, test
+
+
+def _lossSum(loss, gamma, alpha, y, predicted, diff, work):
+    """
+    Sum of the loss terms of the rows, same definitions as the loss functions of GBR.
+    diff and work are preallocated buffers of the size of y.
+    """
+    np.subtract(y, predicted, out=diff)
+    if loss == 'ls':
+        return np.dot(diff, diff)
+    if loss == 'quantile':
+        return alpha * diff.sum() - np.minimum(diff, 0, out=work).sum()
+    np.abs(diff, out=diff)
+    if loss == 'lad':
+        return diff.sum()
+    if loss == 'huber':
+        #0.5 d**2 below gamma and gamma (|d| - gamma / 2) above it
+        np.minimum(diff, gamma, out=work)
+        return 0.5 * np.dot(work, work) + gamma * (diff.sum() - work.sum())
+    raise ValueError('unsupported loss %s' % loss)
+
+
+def stagedDeviance(estimator, X, y, chunksize=100000):
+    """
+    Test deviance of a fitted GBR after every stage, computed in a single pass.
+
+    The rows are processed in chunks of chunksize. For each chunk the prediction buffer is
+    allocated once and the contribution of every tree is added to it in place, after which
+    the loss of the stage is accumulated. Compared to calling loss_ on the output of
+    staged_predict no new prediction vector is created per stage and each chunk of X is
+    read only once, so the curve is cheap even for thousands of stages and large test sets.
+
+    For the Huber loss the threshold found during training is used, which is also what
+    loss_ of a fitted GBR does.
+    """
+    loss = estimator.loss
+    gamma = getattr(estimator.loss_, 'gamma', None)
+    alpha = getattr(estimator, 'alpha', 0.9)
+    nstages = len(estimator.estimators_)
+    y = np.asarray(y, dtype=np.float64).ravel()
+
+    if predict_stage is None or not hasattr(estimator, 'init_') or (loss == 'huber' and gamma is None):
+        #not a sklearn GBR (or no Huber threshold), evaluate the stages on the whole set
+        return np.array([estimator.loss_(y, predicted) for predicted in estimator.staged_predict(X)])
+
+    total = np.zeros(nstages)
+    for start in range(0, X.shape[0], chunksize):
+        Xchunk = np.ascontiguousarray(X[start:start + chunksize], dtype=np.float32)
+        ychunk = y[start:start + chunksize]
+        score = estimator.init_.predict(Xchunk).astype(np.float64).reshape(-1, 1)
+        diff, work = np.empty_like(ychunk), np.empty_like(ychunk)
+        for i in range(nstages):
+            predict_stage(estimator.estimators_, i, Xchunk, estimator.learning_rate, score)
+            total[i] += _lossSum(loss, gamma, alpha, ychunk, score[:, 0], diff, work)
+    return total / y.shape[0]
+
+
+def _runTask(args):
+    """
+    Run a single diagnostic fit in a worker process.
+    """
+    task, files = args
+    estimator = clone(task['estimator'])
+    try:
+        X_train, X_test, y_train, y_test = [np.load(filename, mmap_mode='r') for filename in files]
+        if task['kind'] == 'cv':
+            train, test = _folds(task['fold'])
+            if task['size'] is not None:
+                train = train[:task['size']]
+            estimator.fit(X_train[train], y_train[train])
+            return {'train': estimator.score(X_train[train], y_train[train]),
+                    'test': estimator.score(X_train[test], y_train[test])}
+
+        estimator.fit(X_train, y_train)
+        test_deviance = stagedDeviance(estimator, X_test, y_test)
+        return {'train_score': estimator.train_score_, 'test_deviance': test_deviance,
+                'feature_importances': estimator.feature_importances_}
+    except MemoryError:
+        return None
+    except EnvironmentError as error:
+        #memory-mapping the data fails with ENOMEM rather than a MemoryError
+        if error.errno != errno.ENOMEM:
+            raise
+        return None
+
+
+class DiagnosticsRunner(object):
+    """
+    Schedules and caches the fits of the diagnostic plots.
+
+    :param folder: cache folder of the fit results
+    :param n_jobs: maximum number of worker processes, -1 for the number of cores
+    :param memoryBudget: total memory the worker processes can allocate in bytes, on top of
+                         what they inherit from this process
+    :param memoryPerFit: estimated memory of a single fit in bytes, by default four
+                         times the size of the training data
+    """
+    def __init__(self, X_train, X_test, y_train, y_test, folder='diagnostics/', n_jobs=-1,
+                 memoryBudget=16 * 1024 ** 3, memoryPerFit=None, verbose=1):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.verbose = verbose
+        self.n_train = X_train.shape[0]
+
+        if memoryPerFit is None:
+            memoryPerFit = 4 * X_train.nbytes + 256 * 1024 ** 2
+        n_jobs = multiprocessing.cpu_count() if n_jobs < 1 else n_jobs
+        self.n_workers = int(max(1, min(n_jobs, memoryBudget // memoryPerFit)))
+        self.memoryLimit = memoryBudget // self.n_workers
+
+        arrays = (('X_train', X_train), ('X_test', X_test), ('y_train', y_train), ('y_test', y_test))
+        self.files = [dataFile(folder, name, array) for name, array in arrays]
+        self.fingerprint = dataFingerprint(arrays)
+
+    def _key(self, task):
+        description = repr((self.fingerprint, task['kind'], estimatorFingerprint(task['estimator']),
+                            task.get('fold'), task.get('size')))
+        return hashlib.sha1(description).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def compute(self, tasks):
+        """
+        Results of a list of tasks. The tasks missing from the cache are run in parallel,
+        each distinct task only once.
+        """
+        keys = [self._key(task) for task in tasks]
+        todo = {}
+        for key, task in zip(keys, tasks):
+            if key not in todo and not os.path.exists(self._filename(key)):
+                task = dict(task, estimator=clone(task['estimator']))
+                if 'n_jobs' in task['estimator'].get_params():
+                    #the parallelism comes from the pool
+                    task['estimator'].set_params(n_jobs=1)
+                todo[key] = task
+
+        if self.verbose:
+            print '%i diagnostic fits (%i distinct), %i to run with %i workers' % \
+                  (len(tasks), len(set(keys)), len(todo), self.n_workers)
+        if todo:
+            pool = multiprocessing.Pool(self.n_workers, initializer=_limitMemory, initargs=(self.memoryLimit,))
+            try:
+                todoKeys = todo.keys()
+                results = pool.imap_unordered(_runTaskWithKey, [(key, todo[key], self.files) for key in todoKeys])
+                for key, result in results:
+                    if result is None:
+                        raise MemoryError('a diagnostic fit exceeded the memory limit of %i bytes' % self.memoryLimit)
+                    temporary = self._filename(key + '.tmp')
+                    np.savez(temporary, **result)
+                    os.rename(temporary, self._filename(key))
+            finally:
+                #the other fits are not waited for when one of them fails
+                pool.terminate()
+                pool.join()
+
+        return [dict(np.load(self._filename(key))) for key in keys]
+
+    def validationCurveTasks(self, estimator, param_name, param_range, cv=3):
+        return [{'kind': 'cv', 'estimator': clone(estimator).set_params(**{param_name: value}),
+                 'fold': ('kfold', self.n_train, cv, i), 'size': None}
+                for value in param_range for i in range(cv)]
+
+    def validationCurve(self, estimator, param_name, param_range, cv=3):
+        """
+        Training and test scores of a validation curve, shape (len(param_range), cv).
+        """
+        results = self.compute(self.validationCurveTasks(estimator, param_name, param_range, cv))
+        train = np.array([result['train'] for result in results]).reshape(len(param_range), cv)
+        test = np.array([result['test'] for result in results]).reshape(len(param_range), cv)
+        return train, test
+
+    def _trainSizes(self, train_sizes, test_size):
+        n = self.n_train - int(np.ceil(test_size * self.n_train))
+        return np.unique((np.asarray(train_sizes) * n).astype(np.int))
+
+    def learningCurveTasks(self, estimator, train_sizes=np.linspace(.1, 1.0, 5), n_iter=50, test_size=0.2,
+                           random_state=0):
+        return [{'kind': 'cv', 'estimator': estimator, 'size': size,
+                 'fold': ('shuffle', self.n_train, n_iter, test_size, random_state, i)}
+                for size in self._trainSizes(train_sizes, test_size) for i in range(n_iter)]
+
+    def learningCurve(self, estimator, train_sizes=np.linspace(.1, 1.0, 5), n_iter=50, test_size=0.2,
+                      random_state=0):
+        """
+        Training set sizes and the training and test scores of a learning curve over
+        n_iter shuffle splits, as returned by sklearn's learning_curve.
+        """
+        sizes = self._trainSizes(train_sizes, test_size)
+        results = self.compute(self.learningCurveTasks(estimator, train_sizes, n_iter, test_size, random_state))
+        train = np.array([result['train'] for result in results]).reshape(len(sizes), n_iter)
+        test = np.array([result['test'] for result in results]).reshape(len(sizes), n_iter)
+        return sizes, train, test
+
+    def devianceTasks(self, estimators):
+        return [{'kind': 'deviance', 'estimator': estimator} for estimator in estimators]
+
+    def deviance(self, estimators):
+        """
+        Training loss, test deviance per stage and feature importances of gradient
+        boosting models. Models with identical parameters are fitted only once.
+        """
+        return self.compute(self.devianceTasks(estimators))
+
+
+def _runTaskWithKey(args):
+    key, task, files = args
+    return key, _runTask((task, files))
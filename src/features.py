@@ -0,0 +1,180 @@
+"""
+Photometric Features
+====================
+
+Feature engineering for the photometric redshifts.
+
+The Kaggle files give the u, g, r, i and z magnitudes and their errors. Most photo-z
+methods work better with colours (u-g, g-r, r-i, i-z) than with the magnitudes, and the
+colour errors follow from the magnitude errors as sqrt(err1**2 + err2**2). Optionally
+the fluxes (in nanomaggies, f = 10**(-0.4 * (m - 22.5))) and their errors
+(0.4 ln(10) f err) are added too.
+
+All the features of a block are computed in one pass: the rows are processed in tiles
+that fit in the cache, and every feature is written by a single ufunc directly into its
+columns of the preallocated output, so there are no pandas or other intermediate copies.
+The block is standardised in place with the fitted scaler in the same pass.
+
+A PhotometricFeatures object holds both the configuration and the fitted scaler, so
+pickling it (see modelStore.saveFeatures) stores the complete transform from the raw
+catalog columns to the model input. Only the mean and the scale of the scaler are
+pickled, so loading the transform does not import sklearn. The default configuration (magnitudes and their
+errors) reproduces the original raw features.
+
+The reader of the Kaggle csv files is here as well, so that the inference scripts need
+neither matplotlib nor the training code.
+
+:requires: numpy
+:requires: pandas
+
+:version: 0.1
+"""
+import numpy as np
+import pandas as pd
+
+
+MAGNITUDES = ['u', 'g', 'r', 'i', 'z']
+MAGNITUDE_ERRORS = ['modelmagerr_u', 'modelmagerr_g', 'modelmagerr_r', 'modelmagerr_i', 'modelmagerr_z']
+
+#flux = exp(FLUX_SCALE * (m - 22.5)) in nanomaggies, its error is -FLUX_SCALE * flux * err
+FLUX_SCALE = -0.4 * np.log(10.)
+
+
+def _featureColumns(useErrors=True):
+    """
+    Names of the feature columns in the Kaggle files.
+    """
+    if useErrors:
+        return MAGNITUDES + MAGNITUDE_ERRORS
+    return list(MAGNITUDES)
+
+
+def _readKaggleChunks(filename, columns, chunksize=1000000):
+    """
+    Iterate over a Kaggle csv file in blocks of at most chunksize rows.
+
+    All the photometric columns are parsed directly to float32 so that a block never
+    exists as float64 in memory. Yields the ID and the requested columns as arrays.
+    """
+    dtypes = dict((column, np.float32) for column in columns)
+    dtypes['ID'] = np.int64
+    reader = pd.read_csv(filename, usecols=['ID'] + columns, dtype=dtypes, chunksize=chunksize)
+    for chunk in reader:
+        yield chunk['ID'].values, chunk[columns].values
+
+
+class Standardisation(object):
+    """
+    Mean and scale of a fitted StandardScaler, all that the transform needs of it.
+    """
+    def __init__(self, mean, scale):
+        self.mean_ = np.asarray(mean)
+        self.scale_ = np.asarray(scale)
+
+
+class PhotometricFeatures(object):
+    """
+    Transform from the raw catalog columns to the (scaled) model features.
+
+    :param magnitudes: include the magnitudes
+    :param errors: include the errors of the other features
+    :param colours: include the colours u-g, g-r, r-i and i-z
+    :param fluxes: include the fluxes in nanomaggies
+    :param scaler: fitted StandardScaler of the features, set by the data loaders
+    :param tile: number of rows processed at a time
+    """
+    def __init__(self, magnitudes=True, errors=True, colours=False, fluxes=False, scaler=None, tile=8192):
+        if not (magnitudes or colours or fluxes):
+            raise ValueError('no features selected')
+        self.magnitudes = magnitudes
+        self.errors = errors
+        self.colours = colours
+        self.fluxes = fluxes
+        self.scaler = scaler
+        self.tile = tile
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.scaler is not None:
+            state['scaler'] = Standardisation(self.scaler.mean_, self.scaler.scale_)
+        return state
+
+    @property
+    def columns(self):
+        """
+        Names of the raw catalog columns the features are computed from.
+        """
+        if self.errors:
+            return MAGNITUDES + MAGNITUDE_ERRORS
+        return list(MAGNITUDES)
+
+    @property
+    def names(self):
+        """
+        Names of the features, in the order of the columns of the output.
+        """
+        names = []
+        if self.magnitudes:
+            names += MAGNITUDES
+            if self.errors:
+                names += MAGNITUDE_ERRORS
+        if self.colours:
+            colours = ['%s-%s' % pair for pair in zip(MAGNITUDES[:-1], MAGNITUDES[1:])]
+            names += colours
+            if self.errors:
+                names += ['err_' + colour for colour in colours]
+        if self.fluxes:
+            names += ['flux_' + band for band in MAGNITUDES]
+            if self.errors:
+                names += ['fluxerr_' + band for band in MAGNITUDES]
+        return names
+
+    def _fill(self, raw, out):
+        """
+        Write the features of a tile of raw rows into out.
+        """
+        magnitudes = raw[:, :5]
+        errors = raw[:, 5:10]
+        column = 0
+        if self.magnitudes:
+            width = 10 if self.errors else 5
+            out[:, :width] = raw[:, :width]
+            column = width
+        if self.colours:
+            np.subtract(magnitudes[:, :-1], magnitudes[:, 1:], out=out[:, column:column + 4])
+            column += 4
+            if self.errors:
+                np.hypot(errors[:, :-1], errors[:, 1:], out=out[:, column:column + 4])
+                column += 4
+        if self.fluxes:
+            flux = out[:, column:column + 5]
+            np.subtract(magnitudes, 22.5, out=flux)
+            flux *= FLUX_SCALE
+            np.exp(flux, out=flux)
+            column += 5
+            if self.errors:
+                np.multiply(flux, errors, out=out[:, column:column + 5])
+                out[:, column:column + 5] *= -FLUX_SCALE
+                column += 5
+
+    def transform(self, raw, out=None, scale=True):
+        """
+        Compute the features of a block of raw rows (columns as in self.columns).
+
+        The output has the dtype of the block (float32 for the chunked loaders) unless
+        out is given. With scale=True and a fitted scaler the features are standardised.
+        """
+        raw = np.asarray(raw)
+        if raw.shape[1] != len(self.columns):
+            raise ValueError('expected the %i columns %s, got %i' % (len(self.columns), self.columns, raw.shape[1]))
+        if out is None:
+            dtype = raw.dtype if raw.dtype.kind == 'f' else np.float32
+            out = np.empty((raw.shape[0], len(self.names)), dtype=dtype)
+        scaler = self.scaler if scale else None
+        for start in range(0, raw.shape[0], self.tile):
+            tile = out[start:start + self.tile]
+            self._fill(raw[start:start + self.tile], tile)
+            if scaler is not None:
+                tile -= scaler.mean_
+                tile /= scaler.scale_
+        return out
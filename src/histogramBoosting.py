@@ -0,0 +1,338 @@
+"""
+Histogram Gradient Boosting
+===========================
+
+Gradient boosting regression with histogram binned features.
+
+The features are binned once to at most 255 bins using quantiles of the training
+data and stored as uint8 codes. The regression trees are grown level by level: for
+every node of a level the gradient sums and counts in each bin are accumulated with
+a single bincount per feature, and the best split of all the nodes is found from the
+cumulative histograms at once. The features are processed in a pool of threads.
+Compared to the exact splitter of sklearn the cost of a split search no longer
+depends on sorting the rows, and the binned data takes an eighth of the memory of
+float64 features.
+
+The loss functions (least squares, Huber and quantile), the subsampling and the leaf updates
+follow the GradientBoostingRegressor of sklearn.
+
+:requires: numpy
+
+:version: 0.1
+"""
+import numpy as np
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+class HistogramGradientBoostingRegressor(object):
+    """
+    Gradient boosting for regression using histogram binned features.
+
+    :param n_estimators: number of boosting stages
+    :param learning_rate: shrinks the contribution of each tree
+    :param loss: 'ls' for least squares, 'huber' or 'quantile'
+    :param alpha: quantile of the absolute residuals used as the Huber threshold, or the
+                  quantile to predict for the quantile loss
+    :param max_depth: maximum depth of the trees
+    :param min_samples_leaf: minimum number of samples in a leaf
+    :param subsample: fraction of the rows used to fit each tree
+    :param max_bins: maximum number of bins per feature (at most 255)
+    :param n_jobs: number of threads, -1 to use all the cores
+    :param random_state: seed of the subsampling
+    :param verbose: print the progress every verbose stages
+    """
+    def __init__(self, n_estimators=100, learning_rate=0.1, loss='ls', alpha=0.9, max_depth=3,
+                 min_samples_leaf=1, subsample=1.0, max_bins=255, n_jobs=-1, random_state=None,
+                 verbose=0):
+        if loss not in ('ls', 'huber', 'quantile'):
+            raise ValueError('loss must be ls, huber or quantile, got %s' % loss)
+        if not 1 < max_bins <= 255:
+            raise ValueError('max_bins must be between 2 and 255, got %s' % max_bins)
+        self.n_estimators = n_estimators
+        self.learning_rate = learning_rate
+        self.loss = loss
+        self.alpha = alpha
+        self.max_depth = max_depth
+        self.min_samples_leaf = min_samples_leaf
+        self.subsample = subsample
+        self.max_bins = max_bins
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def _findEdges(self, X, sample=200000):
+        """
+        Bin edges of each feature from quantiles of (a subsample of) the data.
+        """
+        if X.shape[0] > sample:
+            X = X[np.random.RandomState(0).choice(X.shape[0], sample, replace=False)]
+        self.edges_ = []
+        for column in X.T:
+            values = np.unique(column)
+            if len(values) <= self.max_bins:
+                edges = values[:-1]
+            else:
+                quantiles = np.linspace(0, 100, self.max_bins + 1)[1:-1]
+                edges = np.unique(np.percentile(column, quantiles).astype(np.float32))
+            self.edges_.append(edges.astype(np.float32))
+
+    def binData(self, X):
+        """
+        Bin the features to uint8 codes, returned as (n_features, n_samples).
+
+        A code is the number of bin edges smaller than the value, so that code <= b
+        is the same as value <= edges[b].
+        """
+        X = np.asarray(X, dtype=np.float32)
+        codes = np.empty((X.shape[1], X.shape[0]), dtype=np.uint8)
+        for f, edges in enumerate(self.edges_):
+            codes[f] = np.searchsorted(edges, X[:, f], side='left')
+        return codes
+
+    def _lossValue(self, y, pred):
+        diff = y - pred
+        if self.loss == 'ls':
+            return np.mean(diff ** 2)
+        if self.loss == 'quantile':
+            return np.mean(np.where(diff > 0, self.alpha * diff, (self.alpha - 1.) * diff))
+        gamma = np.percentile(np.abs(diff), self.alpha * 100)
+        small = np.abs(diff) <= gamma
+        return (0.5 * np.sum(diff[small] ** 2) +
+                np.sum(gamma * (np.abs(diff[~small]) - gamma / 2.))) / y.shape[0]
+
+    def loss_(self, y, pred):
+        """
+        Loss of the predictions, same interface as the loss_ of sklearn.
+        """
+        return self._lossValue(y, np.ravel(pred))
+
+    def _negativeGradient(self, residual):
+        if self.loss == 'ls':
+            return residual, None
+        if self.loss == 'quantile':
+            return np.where(residual > 0, self.alpha, self.alpha - 1.), None
+        gamma = np.percentile(np.abs(residual), self.alpha * 100)
+        return np.where(np.abs(residual) <= gamma, residual, gamma * np.sign(residual)), gamma
+
+    def _bestSplits(self, codes, nodes, gradient, nnodes):
+        """
+        Best split (gain, bin) of each node for a single feature.
+
+        Rows of finished nodes have the node index nnodes and are ignored.
+        """
+        nbins = self.max_bins
+        index = nodes * nbins + codes
+        size = (nnodes + 1) * nbins
+        sums = np.bincount(index, weights=gradient, minlength=size).reshape(nnodes + 1, nbins)[:-1]
+        counts = np.bincount(index, minlength=size).reshape(nnodes + 1, nbins)[:-1]
+
+        leftSum = np.cumsum(sums, axis=1)
+        leftCount = np.cumsum(counts, axis=1)
+        totalSum = leftSum[:, -1:]
+        totalCount = leftCount[:, -1:]
+        rightSum = totalSum - leftSum
+        rightCount = totalCount - leftCount
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gain = (leftSum ** 2 / leftCount + rightSum ** 2 / rightCount -
+                    totalSum ** 2 / np.maximum(totalCount, 1))
+        valid = (leftCount >= self.min_samples_leaf) & (rightCount >= self.min_samples_leaf)
+        gain[~valid] = -np.inf
+        best = gain.argmax(axis=1)
+        return gain[np.arange(nnodes), best], best
+
+    def _growTree(self, codes, gradient, pool):
+        """
+        Grow a regression tree on the binned features level by level.
+
+        Returns the tree as node arrays and the leaf of every row.
+        """
+        nrows = codes.shape[1]
+        rows = np.arange(nrows)
+        feature, threshold, left, right = [-2], [-1], [-1], [-1]
+        leaf = np.zeros(nrows, dtype=np.int64)
+        level = [0]
+        nodes = np.zeros(nrows, dtype=np.int64)
+
+        for depth in range(self.max_depth):
+            nnodes = len(level)
+            results = pool.map(lambda f: self._bestSplits(codes[f], nodes, gradient, nnodes),
+                               range(codes.shape[0]))
+            gains = np.array([gain for gain, best in results])
+            bins = np.array([best for gain, best in results])
+            bestFeature = gains.argmax(axis=0)
+            bestGain = gains[bestFeature, np.arange(nnodes)]
+            bestBin = bins[bestFeature, np.arange(nnodes)]
+            split = np.isfinite(bestGain) & (bestGain > 0)
+            if not split.any():
+                break
+
+            #children of the split nodes, position of the left child in the next level
+            childPosition = np.full(nnodes + 1, nnodes, dtype=np.int64)
+            nextLevel = []
+            for k in np.flatnonzero(split):
+                node = level[k]
+                feature[node] = bestFeature[k]
+                threshold[node] = bestBin[k]
+                left[node], right[node] = len(feature), len(feature) + 1
+                for child in (left[node], right[node]):
+                    feature.append(-2)
+                    threshold.append(-1)
+                    left.append(-1)
+                    right.append(-1)
+                childPosition[k] = len(nextLevel)
+                nextLevel += [left[node], right[node]]
+                self.feature_importances_[bestFeature[k]] += bestGain[k]
+
+            splitRow = np.append(split, False)[nodes]
+            goRight = codes[np.append(bestFeature, 0)[nodes], rows] > np.append(bestBin, 0)[nodes]
+            nodes = np.where(splitRow, childPosition[nodes] + goRight, len(nextLevel))
+            nextLevel = np.array(nextLevel)
+            active = nodes < len(nextLevel)
+            leaf[active] = nextLevel[nodes[active]]
+            level = list(nextLevel)
+
+        tree = {'feature': np.array(feature), 'threshold': np.array(threshold),
+                'left': np.array(left), 'right': np.array(right)}
+        return tree, leaf
+
+    def _leafValues(self, tree, leaf, residual, gradient, gamma):
+        """
+        Value of each leaf: the mean gradient for least squares, for Huber the median of the
+        residuals plus the mean of the clipped deviations from it and for the quantile loss
+        the alpha quantile of the residuals (as in sklearn).
+        """
+        nnodes = len(tree['feature'])
+        if self.loss == 'ls':
+            sums = np.bincount(leaf, weights=gradient, minlength=nnodes)
+            counts = np.bincount(leaf, minlength=nnodes)
+            return sums / np.maximum(counts, 1)
+
+        value = np.zeros(nnodes)
+        order = np.argsort(leaf, kind='mergesort')
+        bounds = np.searchsorted(leaf[order], np.arange(nnodes + 1))
+        for node in np.flatnonzero(np.diff(bounds)):
+            r = residual[order[bounds[node]:bounds[node + 1]]]
+            if self.loss == 'quantile':
+                value[node] = np.percentile(r, self.alpha * 100)
+                continue
+            median = np.median(r)
+            deviation = r - median
+            value[node] = median + np.mean(np.sign(deviation) * np.minimum(np.abs(deviation), gamma))
+        return value
+
+    @staticmethod
+    def _applyTree(tree, codes):
+        """
+        Leaf of each row of the binned data.
+        """
+        rows = np.arange(codes.shape[1])
+        node = np.zeros(codes.shape[1], dtype=np.int64)
+        internal = tree['left'][node] != -1
+        while internal.any():
+            goRight = codes[np.maximum(tree['feature'][node], 0), rows] > tree['threshold'][node]
+            node = np.where(internal, np.where(goRight, tree['right'][node], tree['left'][node]), node)
+            internal = tree['left'][node] != -1
+        return node
+
+    def fit(self, X, y, monitor=None):
+        """
+        Fit the gradient boosting model.
+
+        A monitor is called after each stage as monitor(i, self, locals()) and stops
+        the training when it returns True.
+        """
+        y = np.asarray(y, dtype=np.float64).ravel()
+        X = np.asarray(X, dtype=np.float32)
+        self._findEdges(X)
+        codes = self.binData(X)
+        nrows = codes.shape[1]
+        nsample = max(int(self.subsample * nrows), 1)
+        rng = np.random.RandomState(self.random_state)
+        threads = multiprocessing.cpu_count() if self.n_jobs < 1 else self.n_jobs
+        pool = ThreadPool(threads)
+
+        if self.loss == 'quantile':
+            self.init_value_ = np.percentile(y, self.alpha * 100)
+        else:
+            self.init_value_ = np.median(y) if self.loss == 'huber' else np.mean(y)
+        self.feature_importances_ = np.zeros(codes.shape[0])
+        self.estimators_ = []
+        self.train_score_ = []
+        prediction = np.full(nrows, self.init_value_)
+
+        for i in range(self.n_estimators):
+            if nsample < nrows:
+                sample = np.sort(rng.permutation(nrows)[:nsample])
+                stageCodes, residual = codes[:, sample], y[sample] - prediction[sample]
+            else:
+                stageCodes, residual = codes, y - prediction
+            gradient, gamma = self._negativeGradient(residual)
+
+            tree, leaf = self._growTree(stageCodes, gradient, pool)
+            tree['value'] = self._leafValues(tree, leaf, residual, gradient, gamma)
+            self.estimators_.append(tree)
+
+            prediction += self.learning_rate * tree['value'][self._applyTree(tree, codes)]
+            self.train_score_.append(self._lossValue(y[sample] if nsample < nrows else y,
+                                                     prediction[sample] if nsample < nrows else prediction))
+            if self.verbose and (i + 1) % self.verbose == 0:
+                print 'Stage %i, training loss %f' % (i + 1, self.train_score_[-1])
+            if monitor is not None and monitor(i, self, locals()):
+                break
+
+        pool.close()
+        self.train_score_ = np.array(self.train_score_)
+        total = self.feature_importances_.sum()
+        if total > 0:
+            self.feature_importances_ /= total
+        return self
+
+    def staged_predict(self, X):
+        """
+        Yield the predictions after each stage.
+        """
+        codes = self.binData(X)
+        prediction = np.full(codes.shape[1], self.init_value_)
+        for tree in self.estimators_:
+            prediction += self.learning_rate * tree['value'][self._applyTree(tree, codes)]
+            yield prediction.copy()
+
+    def predict(self, X):
+        """
+        Predict the redshifts of the rows of X.
+        """
+        codes = self.binData(X)
+        prediction = np.full(codes.shape[1], self.init_value_)
+        for tree in self.estimators_:
+            prediction += self.learning_rate * tree['value'][self._applyTree(tree, codes)]
+        return prediction
+
+    def flatten(self):
+        """
+        Node arrays and meta data in the format of modelStore.flattenEnsemble.
+
+        The bins of the splits are replaced by the corresponding bin edges, which
+        gives the same predictions for float32 features.
+        """
+        sizes = np.array([len(tree['feature']) for tree in self.estimators_])
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+        thresholds = []
+        for tree in self.estimators_:
+            threshold = np.zeros(len(tree['feature']), dtype=np.float32)
+            for node in np.flatnonzero(tree['left'] != -1):
+                threshold[node] = self.edges_[tree['feature'][node]][tree['threshold'][node]]
+            thresholds.append(threshold)
+        nfeatures = len(self.edges_)
+        arrays = {'feature': np.concatenate([tree['feature'] for tree in self.estimators_]).astype(
+                      np.int8 if nfeatures < 127 else np.int32),
+                  'threshold': np.concatenate(thresholds),
+                  'left': np.concatenate([tree['left'] for tree in self.estimators_]).astype(np.int32),
+                  'right': np.concatenate([tree['right'] for tree in self.estimators_]).astype(np.int32),
+                  'value': np.concatenate([tree['value'] for tree in self.estimators_]),
+                  'offsets': offsets}
+        meta = {'n_features': nfeatures, 'n_trees': len(self.estimators_), 'kind': 'gbr',
+                'learning_rate': float(self.learning_rate), 'init': float(self.init_value_)}
+        return arrays, meta
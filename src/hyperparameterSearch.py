@@ -0,0 +1,281 @@
+"""
+Hyperparameter Search
+=====================
+
+Budget aware alternative to the exhaustive GridSearchCV.
+
+A random sample of the parameter grid is evaluated with successive halving: all the
+candidates are first cross-validated with a small budget (a subset of the training
+rows or a small number of trees), and only the best 1/eta of them are promoted to the
+next rung, which has eta times the budget. Only a few candidates are ever trained
+with the full budget.
+
+The trials run in a pool of worker processes with a cap on the address space of
+each worker, so that a candidate that would use too much memory fails with a
+MemoryError rather than taking the whole node down. Every trial result is appended
+to a file as soon as it is done; an interrupted search reads the file back and only
+runs the trials that are missing. The trials are keyed by a fingerprint of the data
+and of the estimator too, so a trial log left by a search on other data or with another
+estimator is not reused.
+
+:requires: numpy
+:requires: scikit-learn
+
+:version: 0.1
+"""
+import numpy as np
+from sklearn.base import clone
+from sklearn.cross_validation import cross_val_score
+import multiprocessing
+import resource
+import hashlib
+import errno
+import json
+import os
+
+
+def _addressSpace():
+    """
+    Current address space (VmSize) of the process in bytes, 0 where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[0]) * resource.getpagesize()
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _limitMemory(memoryLimit):
+    """
+    Cap the memory a worker process can allocate (in bytes).
+
+    The cap is on the address space, which already holds what the worker inherits from
+    the parent at the fork (the interpreter, the libraries and the data of the parent),
+    so the limit is set memoryLimit above the current address space of the worker.
+    """
+    if memoryLimit is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = _addressSpace() + memoryLimit
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _runTrial(args):
+    """
+    Cross-validate a single candidate with the given budget in a worker process.
+    """
+    estimator, params, budget, resourceName, Xfile, yfile, cv, seed = args
+    estimator = clone(estimator).set_params(**params)
+    try:
+        X = np.load(Xfile, mmap_mode='r')
+        y = np.load(yfile, mmap_mode='r')
+        if resourceName == 'n_samples':
+            rows = np.sort(np.random.RandomState(seed).permutation(len(y))[:budget])
+            X, y = X[rows], y[rows]
+        else:
+            estimator.set_params(**{resourceName: budget})
+        scores = cross_val_score(estimator, X, y, scoring='r2', cv=cv)
+        return float(np.mean(scores)), None
+    except MemoryError:
+        return -np.inf, 'MemoryError'
+    except EnvironmentError as error:
+        #memory-mapping the data fails with ENOMEM rather than a MemoryError
+        if error.errno != errno.ENOMEM:
+            raise
+        return -np.inf, 'MemoryError'
+
+
+def dataFile(folder, name, array):
+    """
+    Name of a .npy file worker processes can memory-map the array from. Arrays that are
+    already memory-mapped from a .npy file (e.g. the feature cache) are used directly,
+    others are written once to the folder.
+    """
+    filename = getattr(array, 'filename', None)
+    if filename is not None and filename.endswith('.npy'):
+        mapped = np.load(filename, mmap_mode='r')
+        if mapped.shape == array.shape and mapped.dtype == array.dtype:
+            return filename
+    filename = os.path.join(folder, name + '.npy')
+    np.save(filename, np.asarray(array))
+    return filename
+
+
+def dataFingerprint(arrays):
+    """
+    SHA1 of a sequence of (name, array) pairs: their names, shapes, dtypes and contents.
+    """
+    fingerprint = hashlib.sha1()
+    for name, array in arrays:
+        fingerprint.update(name + str(array.shape) + str(array.dtype))
+        for start in range(0, array.shape[0], 1000000):
+            fingerprint.update(np.ascontiguousarray(array[start:start + 1000000]))
+    return fingerprint.hexdigest()
+
+
+def estimatorFingerprint(estimator):
+    """
+    Class and parameters of an estimator, leaving out those that do not change the fit.
+    """
+    params = estimator.get_params()
+    for name in ('verbose', 'n_jobs'):
+        params.pop(name, None)
+    return repr((estimator.__class__.__name__, sorted(params.items())))
+
+
+def _key(params, budget):
+    return json.dumps(params, sort_keys=True) + ' @ %i' % budget
+
+
+def sampleCandidates(parameters, n_candidates, random_state=None):
+    """
+    Draw distinct random candidates from a parameter grid, a dictionary of lists or, as
+    in GridSearchCV, a list of such dictionaries (e.g. to tune the degree only for the
+    polynomial kernel). If the grid has fewer points than n_candidates, all of them are
+    returned.
+    """
+    grids = [parameters] if isinstance(parameters, dict) else list(parameters)
+    points = [int(np.prod([len(grid[name]) for name in grid])) for grid in grids]
+    rng = np.random.RandomState(random_state)
+    indices = rng.permutation(sum(points))[:n_candidates]
+    candidates = []
+    for index in indices:
+        index = int(index)
+        for grid, size in zip(grids, points):
+            if index < size:
+                break
+            index -= size
+        params = {}
+        for name in sorted(grid):
+            index, position = divmod(index, len(grid[name]))
+            value = grid[name][position]
+            params[name] = value.item() if isinstance(value, np.generic) else value
+        candidates.append(params)
+    return candidates
+
+
+class SuccessiveHalvingSearch(object):
+    """
+    Randomized search with successive halving, used like GridSearchCV.
+
+    :param estimator: estimator to tune
+    :param parameters: dictionary of parameter names and lists of values, or a list of them
+    :param n_candidates: number of random candidates in the first rung
+    :param resource: 'n_samples' to use a subset of the training rows as the budget,
+                     or the name of an estimator parameter such as 'n_estimators'
+    :param min_resource: budget of the first rung
+    :param max_resource: budget of the last rung, defaults to all the rows or to the
+                         parameter value of the estimator
+    :param eta: a 1/eta fraction of the candidates is promoted, with eta times the budget
+    :param cv: number of cross-validation folds
+    :param n_jobs: number of worker processes
+    :param memoryLimit: memory each worker can allocate in bytes, None for no limit
+    :param folder: folder of the trial log, used to resume an interrupted search
+    :param random_state: seed for drawing the candidates and the row subsets
+    :param refit: fit the best candidate with the full budget on all the data
+    """
+    def __init__(self, estimator, parameters, n_candidates=27, resource='n_samples', min_resource=None,
+                 max_resource=None, eta=3, cv=3, n_jobs=2, memoryLimit=8 * 1024 ** 3,
+                 folder='search/', random_state=42, refit=True, verbose=1):
+        self.estimator = estimator
+        self.parameters = parameters
+        self.n_candidates = n_candidates
+        self.resource = resource
+        self.min_resource = min_resource
+        self.max_resource = max_resource
+        self.eta = eta
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.memoryLimit = memoryLimit
+        self.folder = folder
+        self.random_state = random_state
+        self.refit = refit
+        self.verbose = verbose
+
+    def _budgets(self, n_rows):
+        """
+        Budget of each rung.
+        """
+        if self.max_resource is not None:
+            maximum = self.max_resource
+        elif self.resource == 'n_samples':
+            maximum = n_rows
+        else:
+            maximum = self.estimator.get_params()[self.resource]
+        rungs = int(np.floor(np.log(max(self.n_candidates, 1)) / np.log(self.eta))) + 1
+        budgets = [int(maximum / float(self.eta) ** (rungs - 1 - k)) for k in range(rungs)]
+        if self.min_resource is not None:
+            budgets = [max(budget, self.min_resource) for budget in budgets]
+        return budgets
+
+    def _loadTrials(self):
+        """
+        Trials of the trial log that were run on the same data with the same estimator.
+        """
+        trials = {}
+        stale = 0
+        if os.path.exists(self.trialFile):
+            with open(self.trialFile) as fh:
+                for line in fh:
+                    trial = json.loads(line)
+                    if trial.get('fingerprint') != self.fingerprint:
+                        stale += 1
+                        continue
+                    trials[_key(trial['params'], trial['budget'])] = trial
+        if stale:
+            print 'Warning: %i trials in %s are from other data or another estimator and are ignored' % \
+                  (stale, self.trialFile)
+        return trials
+
+    def fit(self, X, y):
+        """
+        Run the search. Trials already found in the trial log are not run again.
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.trialFile = os.path.join(self.folder, 'trials.jsonl')
+        description = repr((dataFingerprint((('X', X), ('y', y))), estimatorFingerprint(self.estimator),
+                            self.resource, self.cv, self.random_state))
+        self.fingerprint = hashlib.sha1(description).hexdigest()
+        trials = self._loadTrials()
+        Xfile, yfile = dataFile(self.folder, 'X', X), dataFile(self.folder, 'y', y)
+
+        candidates = sampleCandidates(self.parameters, self.n_candidates, self.random_state)
+        pool = multiprocessing.Pool(self.n_jobs, initializer=_limitMemory, initargs=(self.memoryLimit,),
+                                    maxtasksperchild=1)
+        log = open(self.trialFile, 'a')
+        try:
+            for rung, budget in enumerate(self._budgets(len(y))):
+                todo = [params for params in candidates if _key(params, budget) not in trials]
+                if self.verbose:
+                    print 'Rung %i: %i candidates with %s=%i (%i from the trial log)' % \
+                          (rung, len(candidates), self.resource, budget, len(candidates) - len(todo))
+                tasks = [(self.estimator, params, budget, self.resource, Xfile, yfile, self.cv, self.random_state)
+                         for params in todo]
+                for params, (score, error) in zip(todo, pool.imap(_runTrial, tasks)):
+                    trial = {'params': params, 'budget': budget, 'rung': rung, 'score': score, 'error': error,
+                             'fingerprint': self.fingerprint}
+                    trials[_key(params, budget)] = trial
+                    log.write(json.dumps(trial) + '\n')
+                    log.flush()
+                    if self.verbose:
+                        print '    %s: %s' % (json.dumps(params, sort_keys=True), error or '%.5f' % score)
+
+                scores = [trials[_key(params, budget)]['score'] for params in candidates]
+                ranking = np.argsort(scores)[::-1]
+                self.best_params_ = candidates[ranking[0]]
+                self.best_score_ = scores[ranking[0]]
+                keep = max(int(len(candidates) / self.eta), 1)
+                candidates = [candidates[i] for i in ranking[:keep]]
+        finally:
+            #also stops the workers if a trial or the log raises
+            log.close()
+            pool.terminate()
+            pool.join()
+
+        self.trials_ = trials.values()
+        if self.refit:
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+            self.best_estimator_.fit(X, y)
+        return self
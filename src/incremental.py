@@ -0,0 +1,388 @@
+"""
+Incremental Retraining
+======================
+
+Incremental update of the photo-z models when new spectroscopic redshifts arrive.
+
+The state of a set of models is kept in a folder (state.pkl). It holds the running
+moments of the training features, the features transform with the scaler built from
+them, the models (a random forest, gradient boosting and Bayesian ridge regression),
+the fixed validation set and the history of the validation metrics. IncrementalPhotoz.fit trains
+the models on a catalog and holds out the test part of it (see
+photometricRedshifts._testMask) as the validation set. Each update then takes a batch
+of new galaxies:
+
+    #. the running moments of the features are updated with the batch and the scaler
+       is rebuilt from them. The models are re-expressed in the new scaling (the
+       thresholds of the trees and the statistics of the ridge regression are
+       transformed). The old trees hence split the galaxies as before, except the few
+       that lie within the float32 rounding of a threshold
+    #. treesPerUpdate trees fitted to the batch are added to the forest
+    #. stagesPerUpdate stages fitted to the batch are added to the gradient boosting
+       model with a warm start
+    #. the sufficient statistics of the ridge regression (the means and the centred
+       cross products of the features and the redshifts) are updated with the batch and
+       the evidence maximisation is rerun on them, which gives the same model as
+       BayesianRidge fitted to all the galaxies so far
+    #. the models are scored on the validation set and the metrics are added to the
+       history, so a drift of the accuracy shows up update by update
+
+Apart from the validation, whose size is fixed, and the rescaling of the trees, which
+depends on the size of the models, an update costs time proportional to the size of
+the batch and not to that of the catalog.
+
+Usage::
+
+    python photoz.py update kaggleData/train.csv --state model/incremental/
+    python photoz.py update newRedshifts.csv --state model/incremental/ --export
+
+:requires: numpy
+:requires: pandas
+:requires: scipy
+:requires: scikit-learn
+
+:version: 0.1
+"""
+import numpy as np
+import cPickle
+import time
+import os
+from scipy import linalg
+from sklearn import linear_model
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import GradientBoostingRegressor as GBR
+import modelStore
+import instrument
+from features import PhotometricFeatures, _readKaggleChunks
+from photozMetrics import PhotozMetrics
+from photometricRedshifts import _testMask, _updateMoments, _scalerFromMoments, RANDOM_FOREST, GRADIENT_BOOSTING, \
+    BAYESIAN_RIDGE
+
+
+MODELS = ('randomForest', 'GradientBoostingRegressor', 'BayesianRidge')
+
+
+class SufficientStatisticsBayesianRidge(linear_model.BayesianRidge):
+    """
+    BayesianRidge fitted from sufficient statistics that can be updated batch by batch.
+
+    The counts, the means and the centred cross products X^T X, X^T y and y^T y are
+    merged batch by batch (Chan et al.), and the evidence maximisation of
+    BayesianRidge.fit is run on them instead of on the data, using the eigenvalues of
+    X^T X in place of the singular values of X. The model is hence the same as
+    BayesianRidge fitted to all the data at once (to the rounding of the sums). The
+    parameters are those of BayesianRidge; fit_intercept=True is assumed, and normalize
+    and compute_score are not supported.
+    """
+    def _reset(self):
+        self.count_ = 0
+        self.xMean_, self.yMean_ = None, 0.
+
+    def fit(self, X, y):
+        """
+        Fit the model to X and y, discarding the statistics of earlier batches.
+        """
+        self._reset()
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y):
+        """
+        Add a batch to the sufficient statistics and refit the model.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        if not hasattr(self, 'count_'):
+            self._reset()
+        n = len(y)
+        xMean, yMean = X.mean(axis=0), y.mean()
+        X, y = X - xMean, y - yMean
+        if self.count_ == 0:
+            self.xx_, self.xy_, self.yy_ = np.zeros((X.shape[1], X.shape[1])), np.zeros(X.shape[1]), 0.
+            self.xMean_ = np.zeros(X.shape[1])
+        total = self.count_ + n
+        dx, dy = xMean - self.xMean_, yMean - self.yMean_
+        weight = self.count_ * n / float(total)
+        self.xx_ += np.dot(X.T, X) + weight * np.outer(dx, dx)
+        self.xy_ += np.dot(X.T, y) + weight * dx * dy
+        self.yy_ += np.dot(y, y) + weight * dy * dy
+        self.xMean_ += dx * n / total
+        self.yMean_ += dy * n / total
+        self.count_ = total
+        return self._solve()
+
+    def rescale(self, shift, scale):
+        """
+        Transform the statistics to the features (X - shift) / scale and refit the model.
+        """
+        self.xMean_ = (self.xMean_ - shift) / scale
+        self.xx_ /= np.outer(scale, scale)
+        self.xy_ /= scale
+        return self._solve()
+
+    def _solve(self):
+        """
+        The evidence maximisation of BayesianRidge.fit on the sufficient statistics.
+        """
+        n, nfeatures = self.count_, len(self.xMean_)
+        if n <= nfeatures:
+            raise ValueError('need more galaxies (%i) than features (%i)' % (n, nfeatures))
+        eigen_vals_, V = linalg.eigh(self.xx_)
+        eigen_vals_ = np.maximum(eigen_vals_, 0.)
+        Vh = V.T
+        alpha_ = 1. / (self.yy_ / n)
+        lambda_ = 1.
+        coef_old_ = None
+        for iter_ in range(self.n_iter):
+            coef_ = np.dot(np.dot(Vh.T, Vh / (eigen_vals_ + lambda_ / alpha_)[:, np.newaxis]), self.xy_)
+            self.alpha_ = alpha_
+            self.lambda_ = lambda_
+            #the residual sum of squares from the cross products
+            rmse_ = self.yy_ - 2 * np.dot(coef_, self.xy_) + np.dot(coef_, np.dot(self.xx_, coef_))
+            gamma_ = np.sum((alpha_ * eigen_vals_) / (lambda_ + alpha_ * eigen_vals_))
+            lambda_ = (gamma_ + 2 * self.lambda_1) / (np.sum(coef_ ** 2) + 2 * self.lambda_2)
+            alpha_ = (n - gamma_ + 2 * self.alpha_1) / (rmse_ + 2 * self.alpha_2)
+            if iter_ != 0 and np.sum(np.abs(coef_old_ - coef_)) < self.tol:
+                break
+            coef_old_ = np.copy(coef_)
+
+        self.coef_ = coef_
+        self.sigma_ = (1. / alpha_) * np.dot(Vh.T, Vh / (eigen_vals_ + lambda_ / alpha_)[:, np.newaxis])
+        self.scores_ = []
+        self.X_offset_ = self.xMean_.copy()
+        self.X_scale_ = np.ones(nfeatures)
+        self.intercept_ = self.yMean_ - np.dot(self.xMean_, self.coef_)
+        return self
+
+
+def _rescaleTrees(trees, shift, scale):
+    """
+    Transform the thresholds of the trees in place to the features (X - shift) / scale.
+    """
+    for tree in trees:
+        inner = tree.tree_.feature >= 0
+        feature = tree.tree_.feature[inner]
+        threshold = tree.tree_.threshold
+        threshold[inner] = (threshold[inner] - shift[feature]) / scale[feature]
+
+
+def readCatalog(filename, features, chunksize=1000000):
+    """
+    The IDs, the raw feature columns and the redshifts of a Kaggle style catalog.
+    """
+    blocks = list(_readKaggleChunks(filename, features.columns + ['redshift'], chunksize))
+    ids = np.concatenate([block[0] for block in blocks])
+    data = np.vstack([block[1] for block in blocks])
+    return ids, data[:, :-1], data[:, -1].astype(np.float64)
+
+
+class IncrementalPhotoz(object):
+    """
+    Photo-z models that are updated with batches of new galaxies, see the module docstring.
+
+    :param features: features transform (features.PhotometricFeatures), by default the
+                     magnitudes and their errors; its scaler is set from the running moments
+    :param models: names of the models to train, a subset of MODELS
+    :param initialTrees: number of trees of the forest trained by fit
+    :param treesPerUpdate: number of trees added to the forest by each update
+    :param initialStages: number of gradient boosting stages fitted by fit
+    :param stagesPerUpdate: number of stages added by each update
+    :param n_jobs: number of cores of the forest, -1 for all
+    :param random_state: seed of the models, the forest of each update gets the next seed
+    """
+    def __init__(self, features=None, models=MODELS, initialTrees=200, treesPerUpdate=20, initialStages=1000,
+                 stagesPerUpdate=100, n_jobs=-1, random_state=42):
+        self.features = PhotometricFeatures() if features is None else features
+        self.names = list(models)
+        self.initialTrees = initialTrees
+        self.treesPerUpdate = treesPerUpdate
+        self.initialStages = initialStages
+        self.stagesPerUpdate = stagesPerUpdate
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.models = {}
+        self.history = []
+
+    def _forest(self, n_estimators, random_state):
+        settings = dict(RANDOM_FOREST, max_features=min(RANDOM_FOREST['max_features'], len(self.features.names)))
+        return RandomForestRegressor(n_estimators=n_estimators, n_jobs=self.n_jobs, random_state=random_state,
+                                     **settings)
+
+    def _updateScaler(self, raw):
+        """
+        Add the features of a batch to the running moments and move the models to the new scaling.
+        """
+        old = self.features.scaler
+        self.count, self.mean, self.m2 = _updateMoments(self.count, self.mean, self.m2,
+                                                        self.features.transform(raw, scale=False))
+        self.features.scaler = _scalerFromMoments(self.count, self.mean, self.m2)
+        if old is None:
+            return
+        #old scaled features x relate to the new ones as (x - shift) / scale
+        scale = self.features.scaler.scale_ / old.scale_
+        shift = (self.features.scaler.mean_ - old.mean_) / old.scale_
+        if 'randomForest' in self.models:
+            _rescaleTrees(self.models['randomForest'].estimators_, shift, scale)
+        if 'GradientBoostingRegressor' in self.models:
+            _rescaleTrees(self.models['GradientBoostingRegressor'].estimators_.ravel(), shift, scale)
+        if 'BayesianRidge' in self.models:
+            self.models['BayesianRidge'].rescale(shift, scale)
+
+    def fit(self, raw, redshift, validation, validationRedshift):
+        """
+        Train the models on the raw feature columns and redshifts of a catalog, and set
+        the fixed validation set.
+        """
+        nfeatures = len(self.features.names)
+        self.count, self.mean, self.m2 = 0, np.zeros(nfeatures), np.zeros(nfeatures)
+        self.features.scaler = None
+        self.validation = np.asarray(validation, dtype=np.float32)
+        self.validationRedshift = np.asarray(validationRedshift, dtype=np.float64)
+        self.models = {}
+        self.history = []
+        self._updateScaler(raw)
+        X = self.features.transform(raw)
+
+        start = time.time()
+        if 'randomForest' in self.names:
+            with instrument.stage('fit', rows=len(redshift), model='RandomForest'):
+                self.models['randomForest'] = self._forest(self.initialTrees, self.random_state).fit(X, redshift)
+        if 'GradientBoostingRegressor' in self.names:
+            with instrument.stage('fit', rows=len(redshift), model='GBR'):
+                self.models['GradientBoostingRegressor'] = GBR(n_estimators=self.initialStages,
+                                                               random_state=self.random_state,
+                                                               **GRADIENT_BOOSTING).fit(X, redshift)
+        if 'BayesianRidge' in self.names:
+            with instrument.stage('fit', rows=len(redshift), model='BayesianRidge'):
+                self.models['BayesianRidge'] = SufficientStatisticsBayesianRidge(**BAYESIAN_RIDGE).fit(X, redshift)
+        return self.validate(len(redshift), time.time() - start)
+
+    def update(self, raw, redshift):
+        """
+        Update the scaler and the models with a batch of new galaxies (raw feature columns
+        and redshifts), then score the validation set.
+        """
+        if len(redshift) == 0:
+            raise ValueError('the batch has no galaxies')
+        start = time.time()
+        self._updateScaler(raw)
+        X = self.features.transform(raw)
+        if 'randomForest' in self.models:
+            with instrument.stage('update', rows=len(redshift), model='RandomForest'):
+                forest = self.models['randomForest']
+                trees = self._forest(self.treesPerUpdate, self.random_state + len(self.history)).fit(X, redshift)
+                forest.estimators_ += trees.estimators_
+                forest.n_estimators = len(forest.estimators_)
+        if 'GradientBoostingRegressor' in self.models:
+            with instrument.stage('update', rows=len(redshift), model='GBR'):
+                gbr = self.models['GradientBoostingRegressor']
+                gbr.set_params(warm_start=True, n_estimators=gbr.n_estimators + self.stagesPerUpdate)
+                gbr.fit(X, redshift)
+        if 'BayesianRidge' in self.models:
+            with instrument.stage('update', rows=len(redshift), model='BayesianRidge'):
+                self.models['BayesianRidge'].partial_fit(X, redshift)
+        return self.validate(len(redshift), time.time() - start)
+
+    def predict(self, raw, model='GradientBoostingRegressor'):
+        """
+        Photo-z of the raw feature columns with one of the models.
+        """
+        return self.models[model].predict(self.features.transform(raw))
+
+    def validate(self, rows, duration):
+        """
+        Score the models on the validation set and add the metrics to the history.
+        """
+        entry = {'update': len(self.history), 'rows': rows, 'seconds': duration,
+                 'training_rows': self.count, 'models': {}}
+        for name in self.names:
+            with instrument.stage('validate', rows=len(self.validationRedshift), model=name):
+                result = PhotozMetrics().update(self.predict(self.validation, name), self.validationRedshift).results()
+            entry['models'][name] = dict((key, result[key]) for key in ('rms', 'bias', 'nmad', 'outliers'))
+        self.history.append(entry)
+        return entry
+
+    def report(self):
+        """
+        Print the validation metrics of every update and their drift since the first fit.
+        """
+        print '%6s %9s %11s %8s  %-26s %9s %9s %9s %9s %10s' % ('update', 'rows', 'training', 'seconds', 'model',
+                                                               'RMS', 'bias', 'NMAD', 'outliers', 'drift RMS')
+        for entry in self.history:
+            for name in self.names:
+                metrics = entry['models'][name]
+                drift = metrics['rms'] - self.history[0]['models'][name]['rms']
+                print '%6i %9i %11i %8.2f  %-26s %9.5f %9.5f %9.5f %9.5f %+10.5f' % \
+                      (entry['update'], entry['rows'], entry['training_rows'], entry['seconds'], name,
+                       metrics['rms'], metrics['bias'], metrics['nmad'], metrics['outliers'], drift)
+
+    def save(self, folder='model/incremental/'):
+        """
+        Pickle the state to folder/state.pkl.
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        fh = open(os.path.join(folder, 'state.pkl'), 'wb')
+        cPickle.dump(self, fh, protocol=2)
+        fh.close()
+
+    def export(self, folder='model/'):
+        """
+        Write the models with the current features transform to the places the model
+        functions of photometricRedshifts save them to, so that photozInference and
+        scoringService pick them up: model/RF/, model/GBR/ (and model/GBR.pkl for
+        warm starts) and model/BayesianRidge.pkl.
+        """
+        if 'randomForest' in self.models:
+            modelStore.saveEnsemble(self.models['randomForest'], os.path.join(folder, 'RF/'))
+            modelStore.saveFeatures(self.features, os.path.join(folder, 'RF/'))
+        if 'GradientBoostingRegressor' in self.models:
+            modelStore.saveEnsemble(self.models['GradientBoostingRegressor'], os.path.join(folder, 'GBR/'))
+            modelStore.saveFeatures(self.features, os.path.join(folder, 'GBR/'))
+            fh = open(os.path.join(folder, 'GBR.pkl'), 'wb')
+            cPickle.dump(self.models['GradientBoostingRegressor'], fh, protocol=2)
+            fh.close()
+        if 'BayesianRidge' in self.models:
+            fh = open(os.path.join(folder, 'BayesianRidge.pkl'), 'wb')
+            cPickle.dump(self.models['BayesianRidge'], fh, protocol=2)
+            fh.close()
+            modelStore.saveFeatures(self.features, os.path.join(folder, 'BayesianRidge.pkl'))
+
+
+def load(folder='model/incremental/'):
+    """
+    Load the state saved by IncrementalPhotoz.save, None if there is none.
+    """
+    filename = os.path.join(folder, 'state.pkl')
+    if not os.path.exists(filename):
+        return None
+    fh = open(filename, 'rb')
+    state = cPickle.load(fh)
+    fh.close()
+    return state
+
+
+def updateCatalog(catalog, folder='model/incremental/', features=None, export=False, test_size=0.35,
+                  random_state=42, **kwargs):
+    """
+    Update the models of the state in folder with the galaxies of a catalog (a csv file
+    with the ID, the photometry and the redshift), or, if there is no state yet, train
+    them on the catalog with its test part (test_size) as the validation set. The
+    features transform and the keyword arguments, passed to IncrementalPhotoz, only
+    apply when the state is created.
+
+    :return: the updated IncrementalPhotoz
+    """
+    state = load(folder)
+    if state is None:
+        state = IncrementalPhotoz(features, random_state=random_state, **kwargs)
+        ids, raw, redshift = readCatalog(catalog, state.features)
+        test = _testMask(ids, test_size, random_state)
+        state.fit(raw[~test], redshift[~test], raw[test], redshift[test])
+    else:
+        ids, raw, redshift = readCatalog(catalog, state.features)
+        state.update(raw, redshift)
+    state.save(folder)
+    if export:
+        state.export()
+    state.report()
+    return state
@@ -0,0 +1,313 @@
+"""
+Instrumentation
+===============
+
+Timing and memory instrumentation of the pipeline stages.
+
+The stages of a run (load, split, scale, fit, predict, metrics and plot) are wrapped
+in stage() blocks. When the instrumentation is enabled every block emits an event with
+the wall time, the CPU time, the peak resident memory during the block, the number of
+rows processed and the throughput. The events are kept in memory, optionally appended
+to a JSON lines file, and summary() prints where the time and the memory went. Stages
+can be nested, e.g. the stages of a run* function inside a block named after it, and
+the path of the stage (runRandomForestKaggle/fit) is recorded with the event.
+
+The peak memory of a stage is measured by resetting the high water mark of the process
+(Linux /proc/self/clear_refs) when the stage begins and reading it when the stage ends.
+Where that is not possible the peak of the whole process so far is reported instead.
+
+When disabled (the default) stage() returns a shared no-op block, so the instrumented
+code runs with practically no overhead.
+
+Selected stages can also be profiled, either with cProfile (a .prof file for pstats or
+snakeviz) or with a sampling profiler that records the Python stack of the main thread
+every few milliseconds of CPU time (a collapsed stack file for flamegraph.pl). The
+sampler has a much lower overhead than cProfile for long fits.
+
+Usage::
+
+    import instrument
+    instrument.configure(output='events.jsonl', profile=('fit',))
+    with instrument.stage('fit', rows=len(y)):
+        clf.fit(X, y)
+    instrument.summary()
+
+Only the standard library is used.
+
+:version: 0.1
+"""
+import collections
+import resource
+import cProfile
+import signal
+import json
+import time
+import os
+
+
+class _NullStage(object):
+    """
+    No-op stage used when the instrumentation is disabled.
+    """
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL = _NullStage()
+
+
+def _readStatus(field):
+    """
+    Value of a memory field of /proc/self/status in MB, None if not available.
+    """
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    return None
+
+
+def _resetPeak():
+    """
+    Reset the peak resident memory of the process, returns False if not supported.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return True
+    except IOError:
+        return False
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler sampling the Python stack of the main thread on SIGPROF.
+
+    :param interval: CPU time between the samples in seconds
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%i)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+    def dump(self, filename):
+        """
+        Write the samples in the collapsed stack format of flamegraph.pl.
+        """
+        with open(filename, 'w') as fh:
+            for stack, count in self.samples.most_common():
+                fh.write('%s %i\n' % (stack, count))
+
+
+class Stage(object):
+    """
+    A timed block, emits an event to the Instrumentation when it ends. The number
+    of rows can also be set inside the block, e.g. once the data have been loaded.
+    """
+    def __init__(self, instrumentation, name, rows=None, **fields):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.rows = rows
+        self.fields = fields
+        self.childPeak = 0.
+
+    def __enter__(self):
+        instrumentation = self.instrumentation
+        parent = instrumentation.stack[-1] if instrumentation.stack else None
+        self.path = self.name if parent is None else parent.path + '/' + self.name
+        instrumentation.stack.append(self)
+
+        self.profiler = None
+        if self.name in instrumentation.profile:
+            if instrumentation.profiler == 'sampling':
+                self.profiler = SamplingProfiler(instrumentation.interval)
+            else:
+                self.profiler = cProfile.Profile()
+        if instrumentation.echo:
+            print '[%s] started' % self.path
+
+        self.resetPeak = _resetPeak()
+        self.rss = _readStatus('VmRSS:')
+        self.cpu = os.times()
+        self.start = time.time()
+        if self.profiler is not None:
+            if isinstance(self.profiler, SamplingProfiler):
+                self.profiler.start()
+            else:
+                self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler is not None:
+            if isinstance(self.profiler, SamplingProfiler):
+                self.profiler.stop()
+            else:
+                self.profiler.disable()
+        duration = time.time() - self.start
+        cpu = os.times()
+        instrumentation = self.instrumentation
+        instrumentation.stack.pop()
+
+        if self.resetPeak:
+            peak = max(_readStatus('VmHWM:'), self.childPeak)
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        if instrumentation.stack:
+            parent = instrumentation.stack[-1]
+            parent.childPeak = max(parent.childPeak, peak)
+
+        event = {'stage': self.name, 'path': self.path, 'start': self.start, 'duration': duration,
+                 'cpu': (cpu[0] - self.cpu[0]) + (cpu[1] - self.cpu[1]),
+                 'children_cpu': (cpu[2] - self.cpu[2]) + (cpu[3] - self.cpu[3]),
+                 'peak_rss_mb': peak, 'rss_start_mb': self.rss, 'rss_end_mb': _readStatus('VmRSS:'),
+                 'rows': self.rows, 'rows_per_second': None if self.rows is None else self.rows / max(duration, 1e-9),
+                 'failed': exc_type is not None}
+        event.update(self.fields)
+        if self.profiler is not None:
+            event['profile'] = instrumentation.saveProfile(self)
+        instrumentation.emit(event)
+        return False
+
+
+class Instrumentation(object):
+    """
+    Collects the stage events.
+
+    :param output: JSON lines file the events are written to, None to keep them in memory only
+    :param profile: names of the stages to profile, e.g. ('fit',)
+    :param profiler: 'cprofile' or 'sampling'
+    :param interval: sampling interval of the sampling profiler in seconds of CPU time
+    :param folder: folder of the profile files
+    :param echo: print a line when a stage starts and ends
+    """
+    def __init__(self, output=None, profile=(), profiler='cprofile', interval=0.005, folder='profiles/', echo=True):
+        if profiler not in ('cprofile', 'sampling'):
+            raise ValueError('profiler must be cprofile or sampling, got %s' % profiler)
+        self.output = output
+        if output is not None:
+            #worker processes forked later append to the same file
+            open(output, 'w').close()
+        self.profile = set(profile)
+        self.profiler = profiler
+        self.interval = interval
+        self.folder = folder
+        self.echo = echo
+        self.events = []
+        self.stack = []
+
+    def stage(self, name, rows=None, **fields):
+        return Stage(self, name, rows, **fields)
+
+    def emit(self, event):
+        self.events.append(event)
+        if self.output is not None:
+            with open(self.output, 'a') as fh:
+                fh.write(json.dumps(event) + '\n')
+        if self.echo:
+            print '[%s] %.2f s, %.2f s CPU, peak %.0f MB%s' % \
+                  (event['path'], event['duration'], event['cpu'], event['peak_rss_mb'],
+                   '' if event['rows'] is None else ', %i rows, %.0f rows/s' % (event['rows'], event['rows_per_second']))
+
+    def saveProfile(self, stage):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        filename = os.path.join(self.folder, '%s-%i' % (stage.path.replace('/', '-'), len(self.events)))
+        if isinstance(stage.profiler, SamplingProfiler):
+            filename += '.folded'
+            stage.profiler.dump(filename)
+        else:
+            filename += '.prof'
+            stage.profiler.dump_stats(filename)
+        return filename
+
+
+_instrumentation = None
+
+
+def configure(enabled=True, **kwargs):
+    """
+    Enable (or disable) the instrumentation, the keyword arguments are passed to Instrumentation.
+    """
+    global _instrumentation
+    _instrumentation = Instrumentation(**kwargs) if enabled else None
+    return _instrumentation
+
+
+def enabled():
+    return _instrumentation is not None
+
+
+def stage(name, rows=None, **fields):
+    """
+    Block timing a pipeline stage, a no-op unless the instrumentation has been configured.
+    """
+    if _instrumentation is None:
+        return _NULL
+    return _instrumentation.stage(name, rows, **fields)
+
+
+def events():
+    return [] if _instrumentation is None else _instrumentation.events
+
+
+def readEvents(filename):
+    """
+    Read the events of a JSON lines file.
+    """
+    with open(filename) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def summary(eventList=None):
+    """
+    Print the total time, CPU time, peak memory and throughput of every stage path, and
+    the fraction of the time of the enclosing stage spent in it. By default the events
+    recorded in this process are summarised.
+    """
+    if eventList is None:
+        eventList = events()
+    totals = {}
+    for event in eventList:
+        total = totals.setdefault(event['path'], {'calls': 0, 'duration': 0., 'cpu': 0., 'peak': 0., 'rows': 0,
+                                                  'start': event['start']})
+        total['start'] = min(total['start'], event['start'])
+        total['calls'] += 1
+        total['duration'] += event['duration']
+        total['cpu'] += event['cpu']
+        total['peak'] = max(total['peak'], event['peak_rss_mb'])
+        total['rows'] += event['rows'] or 0
+
+    print '%-50s %6s %10s %10s %7s %10s %12s' % ('stage', 'calls', 'wall [s]', 'CPU [s]', 'share', 'peak [MB]',
+                                                 'rows/s')
+    #in the order the stages were first entered
+    for path in sorted(totals, key=lambda path: totals[path]['start']):
+        total = totals[path]
+        parent = totals.get(path.rsplit('/', 1)[0]) if '/' in path else None
+        share = '%6.1f%%' % (100. * total['duration'] / max(parent['duration'], 1e-9)) if parent else ''
+        rate = '%12.0f' % (total['rows'] / max(total['duration'], 1e-9)) if total['rows'] else ''
+        print '%-50s %6i %10.2f %10.2f %7s %10.0f %12s' % (path, total['calls'], total['duration'], total['cpu'],
+                                                           share, total['peak'], rate)
+    return totals
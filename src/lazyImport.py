@@ -0,0 +1,38 @@
+"""
+Lazy Imports
+============
+
+Modules that are imported on first use.
+
+matplotlib and the search and validation parts of sklearn take a large part of the
+start-up time of the scripts, but are needed by a few functions only. A LazyModule
+stands in for such a module under its usual name (e.g. plt) and imports it the first
+time one of its attributes is accessed, so a process that never plots never imports
+matplotlib.
+
+:version: 0.1
+"""
+import importlib
+
+
+class LazyModule(object):
+    """
+    Proxy of a module that is imported when it is first used.
+
+    :param name: full name of the module, e.g. 'matplotlib.pyplot'
+    :param setup: optional function called once before the import, e.g. to set rcParams
+    """
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            if self._setup is not None:
+                self._setup()
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
@@ -0,0 +1,117 @@
+"""
+Nearest Neighbours
+==================
+
+k-nearest-neighbour photometric redshifts.
+
+The redshift of a galaxy is the (optionally distance weighted) mean redshift of its
+k nearest neighbours in the scaled feature space of the training set, and the spread
+of the neighbour redshifts is an estimate of its error. The KD-tree (or ball tree)
+index of the training set is built once in fit and pickled with the model, so a saved
+model answers queries without rebuilding the index.
+
+Large query sets are split into batches that are queried in a pool of worker processes.
+The workers are forked after the index has been set, so they share it copy-on-write
+instead of receiving a pickled copy.
+
+:requires: numpy
+:requires: scikit-learn
+
+:version: 0.1
+"""
+import numpy as np
+import multiprocessing
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.neighbors import KDTree, BallTree
+
+
+#estimator and query set of the worker processes, set before the pool is created
+_estimator = None
+_X = None
+
+
+def _queryBatch(bounds):
+    start, stop = bounds
+    return _estimator._predictBatch(_X[start:stop])
+
+
+class NearestNeighbourRegressor(BaseEstimator, RegressorMixin):
+    """
+    k-nearest-neighbour regression with a persisted spatial index.
+
+    :param n_neighbors: number of neighbours
+    :param weights: 'uniform' or 'distance' (inverse distance weighted mean)
+    :param algorithm: 'kd_tree' or 'ball_tree'
+    :param leaf_size: leaf size of the tree
+    :param batch_size: number of galaxies queried in one batch
+    :param n_jobs: number of worker processes, -1 to use all the cores
+    """
+    def __init__(self, n_neighbors=10, weights='distance', algorithm='kd_tree', leaf_size=40, batch_size=10000,
+                 n_jobs=-1):
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y):
+        """
+        Build the index of the training set.
+        """
+        if self.algorithm not in ('kd_tree', 'ball_tree'):
+            raise ValueError('algorithm must be kd_tree or ball_tree, got %s' % self.algorithm)
+        if self.weights not in ('uniform', 'distance'):
+            raise ValueError('weights must be uniform or distance, got %s' % self.weights)
+        index = KDTree if self.algorithm == 'kd_tree' else BallTree
+        self.index_ = index(np.asarray(X, dtype=np.float64), leaf_size=self.leaf_size)
+        self.y_ = np.asarray(y, dtype=np.float64).ravel()
+        return self
+
+    def _predictBatch(self, X):
+        """
+        Weighted mean and standard deviation of the neighbour redshifts of a batch.
+        """
+        distance, neighbours = self.index_.query(np.asarray(X, dtype=np.float64), k=self.n_neighbors)
+        values = self.y_[neighbours]
+        if self.weights == 'uniform':
+            weights = np.ones_like(distance)
+        else:
+            #an exact match gets all the weight, as in sklearn's KNeighborsRegressor
+            with np.errstate(divide='ignore'):
+                weights = 1. / distance
+            exact = np.isinf(weights)
+            exactRows = exact.any(axis=1)
+            weights[exactRows] = exact[exactRows]
+        weights /= weights.sum(axis=1)[:, np.newaxis]
+        mean = np.sum(weights * values, axis=1)
+        std = np.sqrt(np.sum(weights * (values - mean[:, np.newaxis]) ** 2, axis=1))
+        return np.column_stack((mean, std))
+
+    def predict(self, X, return_std=False):
+        """
+        Predict the redshifts of the rows of X, and with return_std=True also the
+        (weighted) standard deviation of the neighbour redshifts.
+        """
+        global _estimator, _X
+        n = X.shape[0]
+        n_jobs = multiprocessing.cpu_count() if self.n_jobs < 1 else self.n_jobs
+        batches = [(start, min(start + self.batch_size, n)) for start in range(0, n, self.batch_size)]
+        if not batches:
+            result = np.empty((0, 2))
+        #workers of a pool, e.g. of photozInference, cannot start a pool of their own
+        elif n_jobs == 1 or len(batches) == 1 or multiprocessing.current_process().daemon:
+            result = np.vstack([self._predictBatch(X[start:stop]) for start, stop in batches])
+        else:
+            _estimator, _X = self, X
+            pool = multiprocessing.Pool(min(n_jobs, len(batches)))
+            try:
+                result = np.vstack(pool.map(_queryBatch, batches))
+            finally:
+                #also stops the workers if a batch raises
+                pool.terminate()
+                pool.join()
+                _estimator, _X = None, None
+        if return_std:
+            return result[:, 0], result[:, 1]
+        return result[:, 0]
@@ -22,18 +22,6 @@ matplotlib 1.4.2
 :contact: s.niemi@icloud.com
 :version: 0.8
 """
-import matplotlib
-matplotlib.rcParams['font.size'] = 17
-matplotlib.rc('xtick', labelsize=14)
-matplotlib.rc('axes', linewidth=1.1)
-matplotlib.rcParams['legend.fontsize'] = 11
-matplotlib.rcParams['legend.handlelength'] = 3
-matplotlib.rcParams['xtick.major.size'] = 5
-matplotlib.rcParams['ytick.major.size'] = 5
-matplotlib.rcParams['image.interpolation'] = 'none'
-import matplotlib as mpl
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from sklearn import cross_validation
@@ -42,52 +30,89 @@ from sklearn.ensemble import RandomForestRegressor
 from sklearn.ensemble import GradientBoostingRegressor as GBR
 from sklearn import linear_model
 from sklearn.svm import SVR
-from sklearn import grid_search
 from sklearn.cross_validation import cross_val_score
-from sklearn.learning_curve import validation_curve
-from sklearn.learning_curve import learning_curve
 from sklearn import metrics
 from sklearn import preprocessing
+from sklearn.base import clone
+from numpy.lib.format import open_memmap
 import copy
 import cPickle
-
-
-def loadKaggledata(folder='MachineLearning/photo-z/kaggleData/', useErrors=True):
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+import modelStore
+import instrument
+from lazyImport import LazyModule
+from plotting import mpl, cm, plt
+from diagnostics import DiagnosticsRunner
+from approximateSVR import ApproximateKernelSVR
+from hyperparameterSearch import SuccessiveHalvingSearch
+from histogramBoosting import HistogramGradientBoostingRegressor
+from pipeline import PipelineRunner
+from batchedForest import BatchedRandomForestRegressor
+import uncertainty as photozUncertainty
+from photozMetrics import PhotozMetrics
+from nearestNeighbours import NearestNeighbourRegressor
+from features import PhotometricFeatures, MAGNITUDES, _readKaggleChunks
+
+
+#plotting and the grid search are imported on first use, see lazyImport and plotting
+grid_search = LazyModule('sklearn.grid_search')
+
+#hyper-parameters of the models trained without a search, also used by benchmark and incremental
+RANDOM_FOREST = {'max_depth': 28, 'max_features': 7, 'min_samples_split': 2, 'min_samples_leaf': 2}
+GRADIENT_BOOSTING = {'learning_rate': 0.05, 'loss': 'huber', 'max_depth': 3, 'subsample': 0.8}
+BAYESIAN_RIDGE = {'n_iter': 1000, 'tol': 1e-3, 'alpha_1': 1., 'fit_intercept': True}
+NEAREST_NEIGHBOURS = {'n_neighbors': 10, 'weights': 'distance'}
+
+
+def loadKaggledata(folder='MachineLearning/photo-z/kaggleData/', useErrors=True, features=None):
     """
     Load Kaggle photometric redshift competition data. These data are from 2012 and at low-z.
 
     train: ID, u, g, r, i, z, uErr, gErr, rErr, iErr, zErr, redshift
     query: ID, u, g, r, i, z, uErr, gErr, rErr, iErr, zErr
     solution: ID, redshift, estimatedRedshiftError
+
+    The features are computed with a features.PhotometricFeatures transform (by default
+    the magnitudes, and with useErrors their errors). The scaler fitted to the training
+    set is stored in the transform, so a transform passed in is fitted in place and can
+    be saved with the model.
     """
+    if features is None:
+        features = PhotometricFeatures(errors=useErrors)
     filename = folder + 'train.csv'
-    data = pd.read_csv(filename, index_col=0, usecols=['ID', 'u', 'g', 'r', 'i', 'z',
-                                                       'modelmagerr_u', 'modelmagerr_g',
-                                                       'modelmagerr_r', 'modelmagerr_i',
-                                                       'modelmagerr_z', 'redshift'])
-    if useErrors:
-        data_features = data[['u', 'g', 'r', 'i', 'z',
-                              'modelmagerr_u', 'modelmagerr_g',
-                              'modelmagerr_r', 'modelmagerr_i',
-                              'modelmagerr_z']]
-    else:
-        data_features = data[['u', 'g', 'r', 'i', 'z']]
+    with instrument.stage('load') as stage:
+        data = pd.read_csv(filename, index_col=0, usecols=['ID', 'u', 'g', 'r', 'i', 'z',
+                                                           'modelmagerr_u', 'modelmagerr_g',
+                                                           'modelmagerr_r', 'modelmagerr_i',
+                                                           'modelmagerr_z', 'redshift'])
+        stage.rows = len(data)
+    with instrument.stage('features', rows=len(data)):
+        data_features = features.transform(data[features.columns].values, scale=False)
     data_redshifts = data[['redshift']]
 
-    X_train, X_test, y_train, y_test = train_test_split(data_features.values,
-                                                        data_redshifts.values,
-                                                        test_size=0.35,
-                                                        random_state=42)
+    with instrument.stage('split', rows=len(data)):
+        X_train, X_test, y_train, y_test = train_test_split(data_features,
+                                                            data_redshifts.values,
+                                                            test_size=0.35,
+                                                            random_state=42)
     # remove mean dn scale to unit variance
-    scaler = preprocessing.StandardScaler().fit(X_train)    
-    X_train = scaler.transform(X_train)                                                    
-    X_test = scaler.transform(X_test)                                                    
+    with instrument.stage('scale', rows=len(data)):
+        scaler = preprocessing.StandardScaler().fit(X_train)
+        features.scaler = scaler
+        X_train = scaler.transform(X_train)
+        X_test = scaler.transform(X_test)
 
     #make 1D vectors
     y_train = y_train.ravel()
     y_test = y_test.ravel()
 
-    print "feature vector shape=", data_features.values.shape
+    print "feature vector shape=", data_features.shape
     print 'Training sample shape=', X_train.shape
     print 'Testing sample shape=', X_test.shape
     print 'Target training redshift sample shape=', y_train.shape
@@ -96,9 +121,247 @@ def loadKaggledata(folder='MachineLearning/photo-z/kaggleData/', useErrors=True)
     return X_train, X_test, y_train, y_test
 
 
+def _testMask(ids, test_size=0.35, random_state=42):
+    """
+    Deterministic train/test assignment based on a multiplicative (Fibonacci) hash of the ID.
+
+    As the assignment only depends on the ID of the galaxy and the seed, the split is
+    the same whatever the chunk size or the row order of the file is.
+    """
+    hashed = (ids.astype(np.uint64) + np.uint64(random_state)) * np.uint64(11400714819323198485)
+    uniform = (hashed >> np.uint64(11)).astype(np.float64) / 2.**53
+    return uniform < test_size
+
+
+def _updateMoments(count, mean, m2, block):
+    """
+    Combine the running mean and sum of squared deviations with a new block of
+    data (Chan et al. parallel algorithm). Accumulates in float64.
+    """
+    n = block.shape[0]
+    if n == 0:
+        return count, mean, m2
+    block_mean = block.mean(axis=0, dtype=np.float64)
+    block_m2 = ((block - block_mean) ** 2).sum(axis=0)
+    total = count + n
+    delta = block_mean - mean
+    mean = mean + delta * n / total
+    m2 = m2 + block_m2 + delta ** 2 * count * n / total
+    return total, mean, m2
+
+
+def _scalerFromMoments(count, mean, m2):
+    """
+    Build a fitted StandardScaler from running moments.
+    """
+    var = m2 / max(count, 1)
+    std = np.sqrt(var)
+    std[std == 0.0] = 1.0
+    scaler = preprocessing.StandardScaler()
+    scaler.mean_ = mean
+    #the name of the scale attribute depends on the sklearn version
+    scaler.std_ = std
+    scaler.scale_ = std
+    scaler.var_ = var
+    scaler.n_samples_seen_ = count
+    return scaler
+
+
+def fitScalerChunked(filename, useErrors=True, chunksize=1000000, test_size=0.35, random_state=42, features=None):
+    """
+    Fit a StandardScaler to the features of the training part of a Kaggle csv file one
+    block at a time.
+
+    Returns the fitted scaler and the number of training and testing rows.
+    """
+    if features is None:
+        features = PhotometricFeatures(errors=useErrors)
+    nfeatures = len(features.names)
+    count, mean, m2 = 0, np.zeros(nfeatures), np.zeros(nfeatures)
+    n_test = 0
+    for ids, block in _readKaggleChunks(filename, features.columns, chunksize):
+        test = _testMask(ids, test_size, random_state)
+        n_test += test.sum()
+        count, mean, m2 = _updateMoments(count, mean, m2, features.transform(block[~test], scale=False))
+    return _scalerFromMoments(count, mean, m2), count, n_test
+
+
+def streamKaggledata(folder='MachineLearning/photo-z/kaggleData/', useErrors=True, chunksize=1000000,
+                     test_size=0.35, random_state=42, scaler=None, features=None):
+    """
+    Stream the Kaggle training data in blocks of at most chunksize rows.
+
+    If no fitted scaler is given, the file is read once to fit it to the training rows.
+    Yields scaled float32 feature blocks (X_train, X_test, y_train, y_test), so the full
+    table is never held in memory. The split is deterministic, see _testMask. The scaler
+    is stored in the features transform.
+    """
+    filename = folder + 'train.csv'
+    if features is None:
+        features = PhotometricFeatures(errors=useErrors)
+    if scaler is None:
+        scaler, n_train, n_test = fitScalerChunked(filename, useErrors, chunksize, test_size, random_state,
+                                                   features)
+    features.scaler = scaler
+    columns = features.columns + ['redshift']
+    for ids, block in _readKaggleChunks(filename, columns, chunksize):
+        test = _testMask(ids, test_size, random_state)
+        X = features.transform(block[:, :-1])
+        y = block[:, -1]
+        yield X[~test], X[test], y[~test], y[test]
+
+
+def loadKaggledataChunked(folder='MachineLearning/photo-z/kaggleData/', useErrors=True, chunksize=1000000,
+                          test_size=0.35, random_state=42, output='split/', features=None):
+    """
+    Memory bounded version of loadKaggledata for large catalogs.
+
+    Reads the training file in blocks with explicit float32 dtypes, fits the scaler
+    incrementally and writes the scaled train/test split to .npy files in the output
+    folder together with the pickled scaler and the pickled features transform (which
+    holds the scaler too). The arrays are returned memory-mapped, so the peak memory use is set by the
+    chunk size rather than by the size of the catalog.
+
+    Note that the split is based on a hash of the ID (see _testMask) and therefore
+    differs from the train_test_split used in loadKaggledata.
+    """
+    filename = folder + 'train.csv'
+    if features is None:
+        features = PhotometricFeatures(errors=useErrors)
+    nfeatures = len(features.names)
+    with instrument.stage('scale') as stage:
+        scaler, n_train, n_test = fitScalerChunked(filename, useErrors, chunksize, test_size, random_state,
+                                                   features)
+        stage.rows = n_train + n_test
+
+    if not os.path.exists(output):
+        os.makedirs(output)
+    X_train = open_memmap(output + 'X_train.npy', mode='w+', dtype=np.float32, shape=(n_train, nfeatures))
+    X_test = open_memmap(output + 'X_test.npy', mode='w+', dtype=np.float32, shape=(n_test, nfeatures))
+    y_train = open_memmap(output + 'y_train.npy', mode='w+', dtype=np.float32, shape=(n_train,))
+    y_test = open_memmap(output + 'y_test.npy', mode='w+', dtype=np.float32, shape=(n_test,))
+
+    #the split and the scaling are done on the fly while the blocks are read
+    i, j = 0, 0
+    with instrument.stage('load', rows=n_train + n_test):
+        for Xtr, Xte, ytr, yte in streamKaggledata(folder, useErrors, chunksize, test_size, random_state, scaler,
+                                                   features):
+            X_train[i:i + len(ytr)] = Xtr
+            y_train[i:i + len(ytr)] = ytr
+            X_test[j:j + len(yte)] = Xte
+            y_test[j:j + len(yte)] = yte
+            i += len(ytr)
+            j += len(yte)
+
+        for array in (X_train, X_test, y_train, y_test):
+            array.flush()
+    with open(output + 'scaler.pkl', 'wb') as fh:
+        cPickle.dump(scaler, fh, protocol=2)
+    modelStore.saveFeatures(features, output)
+    del X_train, X_test, y_train, y_test
+
+    X_train, X_test, y_train, y_test = [np.load(output + name + '.npy', mmap_mode='r')
+                                        for name in ('X_train', 'X_test', 'y_train', 'y_test')]
+
+    print 'Training sample shape=', X_train.shape
+    print 'Testing sample shape=', X_test.shape
+    print 'Target training redshift sample shape=', y_train.shape
+    print 'Testing redshift sample shape=',  y_test.shape
+
+    return X_train, X_test, y_train, y_test
+
+
+def _fileHash(filename, cache='cache/', blocksize=2**24):
+    """
+    SHA1 of the content of a file.
+
+    The digest is remembered in cache/sources.json together with the size and the
+    modification time of the file, so an unchanged file is hashed only once.
+    """
+    stat = os.stat(filename)
+    stamp = [stat.st_size, stat.st_mtime]
+    index = cache + 'sources.json'
+    sources = {}
+    if os.path.exists(index):
+        with open(index) as fh:
+            sources = json.load(fh)
+    key = os.path.abspath(filename)
+    if key in sources and sources[key]['stamp'] == stamp:
+        return sources[key]['sha1']
+
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            sha1.update(block)
+    sources[key] = {'stamp': stamp, 'sha1': sha1.hexdigest()}
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+    with open(index, 'w') as fh:
+        json.dump(sources, fh, indent=1)
+    return sources[key]['sha1']
+
+
+def loadKaggledataCached(folder='MachineLearning/photo-z/kaggleData/', useErrors=True, test_size=0.35,
+                         random_state=42, chunksize=1000000, cache='cache/', features=None):
+    """
+    Load the scaled Kaggle training data from an on-disk feature cache.
+
+    The cache entry is keyed on the SHA1 of train.csv, the feature names, the split
+    seed and test_size. On a cold run the entry is built with loadKaggledataChunked,
+    on a warm run the csv file is not parsed at all and the scaled train and test
+    matrices are memory-mapped from the .npy files without a copy. If the source file
+    has changed the key changes too, so a stale entry is never used and a new one is
+    built.
+    """
+    filename = folder + 'train.csv'
+    if features is None:
+        features = PhotometricFeatures(errors=useErrors)
+    manifest = {'source': _fileHash(filename, cache),
+                'columns': features.names,
+                'random_state': random_state,
+                'test_size': test_size}
+    key = hashlib.sha1(json.dumps(manifest, sort_keys=True)).hexdigest()
+    entry = cache + key + '/'
+
+    valid = False
+    if os.path.exists(entry + 'manifest.json'):
+        with open(entry + 'manifest.json') as fh:
+            valid = json.load(fh) == manifest
+
+    if valid:
+        print 'Loading cached features from', entry
+        with instrument.stage('load', cached=True) as stage:
+            X_train, X_test, y_train, y_test = [np.load(entry + name + '.npy', mmap_mode='r')
+                                                for name in ('X_train', 'X_test', 'y_train', 'y_test')]
+            stage.rows = len(y_train) + len(y_test)
+        #the configuration of the features is part of the key, only the fitted scaler is read
+        with open(entry + 'scaler.pkl', 'rb') as fh:
+            features.scaler = cPickle.load(fh)
+    else:
+        print 'Building the feature cache', entry
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        X_train, X_test, y_train, y_test = loadKaggledataChunked(folder, useErrors, chunksize, test_size,
+                                                                 random_state, output=entry, features=features)
+        #the manifest is written last to mark the entry complete
+        with open(entry + 'manifest.json', 'w') as fh:
+            json.dump(manifest, fh, indent=1)
+
+    return X_train, X_test, y_train, y_test
+
+
+def _loadTrainingData(useErrors=True, cache=None, features=None):
+    """
+    Load the training data either from the feature cache or directly from the csv file.
+    """
+    if cache is None:
+        return loadKaggledata(useErrors=useErrors, features=features)
+    return loadKaggledataCached(useErrors=useErrors, cache=cache, features=features)
+
+
 
 def plot_learning_curve(estimator, title, X, y, ylim=None, cv=None,
-                        n_jobs=1, train_sizes=np.linspace(.1, 1.0, 5)):
+                        n_jobs=1, train_sizes=np.linspace(.1, 1.0, 5), scores=None):
     """
     Generate a simple plot of the test and training learning curve.
 
@@ -128,6 +391,9 @@ def plot_learning_curve(estimator, title, X, y, ylim=None, cv=None,
 
     n_jobs : integer, optional
         Number of jobs to run in parallel (default 1).
+
+    scores : tuple (train_sizes, train_scores, test_scores), optional
+        Precomputed learning curve, e.g. from DiagnosticsRunner.learningCurve.
     """
     plt.figure()
     plt.title(title)
@@ -135,8 +401,10 @@ def plot_learning_curve(estimator, title, X, y, ylim=None, cv=None,
         plt.ylim(*ylim)
     plt.xlabel("Training examples")
     plt.ylabel("Score")
-    train_sizes, train_scores, test_scores = learning_curve(
-        estimator, X, y, cv=cv, n_jobs=n_jobs, train_sizes=train_sizes)
+    if scores is None:
+        from sklearn.learning_curve import learning_curve
+        scores = learning_curve(estimator, X, y, cv=cv, n_jobs=n_jobs, train_sizes=train_sizes)
+    train_sizes, train_scores, test_scores = scores
     train_scores_mean = np.mean(train_scores, axis=1)
     train_scores_std = np.std(train_scores, axis=1)
     test_scores_mean = np.mean(test_scores, axis=1)
@@ -156,7 +424,8 @@ def plot_learning_curve(estimator, title, X, y, ylim=None, cv=None,
     return plt
     
 
-def randomForest(X_train, X_test, y_train, y_test, search=True, save=False):
+def randomForest(X_train, X_test, y_train, y_test, search=True, save=False, n_jobs=None, batchSize=None,
+                 uncertainty=None, features=None):
     """
     A random forest regressor.
 
@@ -165,7 +434,25 @@ def randomForest(X_train, X_test, y_train, y_test, search=True, save=False):
     predictive accuracy and control over-fitting.
 
     Can run a grid search to look for the best parameters (search=True) and
-    save the model to a file (save=True).
+    save the model to a file (save=True). With search='halving' a random sample of
+    the grid is searched with successive halving on the size of the training set,
+    see hyperparameterSearch.SuccessiveHalvingSearch.
+
+    With n_jobs given, at most n_jobs cores are used in total (the search runs n_jobs
+    single threaded forests in parallel).
+
+    With batchSize set (and no search) the forest is grown batchSize trees at a time and
+    each batch is written to disk as soon as it is done, so the memory use is set by the
+    batch size rather than by the number of trees, see batchedForest. The batches go to
+    model/RF/ if save=True and to a temporary folder, removed at the end, otherwise. The
+    predictions are the same as those of the forest trained in memory.
+
+    With uncertainty='spread' the standard deviation of the predictions of the trees, and
+    with uncertainty='quantile' half of the 16-84 per cent range of the leaf values, is
+    returned as a third array with the error of each galaxy, see uncertainty.
+
+    The fitted features transform the data were loaded with (features) is saved with the
+    model, see modelStore.saveFeatures.
     """
     if search:
         # parameter values over which we will search
@@ -173,21 +460,23 @@ def randomForest(X_train, X_test, y_train, y_test, search=True, save=False):
                       'min_samples_leaf': [1, 2, 3, 10],
                      'max_features': [None, 'sqrt', 7],
                      'max_depth': [None, 15, 30, 40]}
-        rf = RandomForestRegressor(n_estimators=100, n_jobs=4, verbose=1)
+        rf = RandomForestRegressor(n_estimators=100, n_jobs=4 if n_jobs is None else 1, verbose=1)
         #note: one can run out of memory if using n_jobs=-1..
-        rf_tuned = grid_search.GridSearchCV(rf, parameters, scoring='r2', n_jobs=2, verbose=1, cv=3)
+        if search == 'halving':
+            rf_tuned = SuccessiveHalvingSearch(rf, parameters, n_candidates=27, resource='n_samples',
+                                               n_jobs=n_jobs or 2, folder='search/RF/')
+        else:
+            rf_tuned = grid_search.GridSearchCV(rf, parameters, scoring='r2', n_jobs=n_jobs or 2, verbose=1, cv=3)
+    elif batchSize is not None:
+        rf_tuned = BatchedRandomForestRegressor(n_estimators=2000, batch_size=batchSize,
+                                                folder='model/RF/' if save else None,
+                                                n_jobs=n_jobs or -1, verbose=1, **RANDOM_FOREST)
     else:
-        rf_tuned = RandomForestRegressor(n_estimators=2000,
-                                         max_depth=28,
-                                         max_features=7,
-                                         min_samples_split=2,
-                                         min_samples_leaf=2,
-                                         n_jobs=-1, verbose=1)
+        rf_tuned = RandomForestRegressor(n_estimators=2000, n_jobs=n_jobs or -1, verbose=1, **RANDOM_FOREST)
        #n_estimators=5000 will take about 36GB of RAM
 
-    print '\nTraining...'
-    rf_optimised = rf_tuned.fit(X_train, y=y_train)
-    print 'Done'
+    with instrument.stage('fit', rows=len(y_train), model='RandomForest'):
+        rf_optimised = rf_tuned.fit(X_train, y=y_train)
     
     if search:
         print 'The best score and estimator:'
@@ -195,41 +484,69 @@ def randomForest(X_train, X_test, y_train, y_test, search=True, save=False):
         print(rf_optimised.best_estimator_)
         rf_optimised = rf_optimised.best_estimator_
 
-    if save:
-        print 'Save the Random Forest to a pickled file; note that the model can quickly take 100G'
-        fp = open('model/RF.pkl', 'w')
-        cPickle.dump(rf_optimised, fp)
-        fp.close()
-
-    print '\nPredicting...'
-    predicted = rf_optimised.predict(X_test)
-    expected = y_test.copy()
-    print 'Done'
-
-    return predicted, expected
+    if save and not isinstance(rf_optimised, BatchedRandomForestRegressor):
+        print 'Save the Random Forest to flat node arrays in model/RF/'
+        modelStore.saveEnsemble(rf_optimised, 'model/RF/')
+    if save and features is not None:
+        modelStore.saveFeatures(features, 'model/RF/')
+
+    try:
+        with instrument.stage('predict', rows=len(y_test), model='RandomForest'):
+            predicted = rf_optimised.predict(X_test)
+        expected = y_test.copy()
+
+        if uncertainty == 'spread':
+            with instrument.stage('uncertainty', rows=len(y_test), model='RandomForest'):
+                error = photozUncertainty.forestSpread(rf_optimised, X_test)[1]
+            return predicted, expected, error
+        if uncertainty == 'quantile':
+            with instrument.stage('uncertainty', rows=len(y_test), model='RandomForest'):
+                low, high = photozUncertainty.forestQuantiles(rf_optimised, X_test, quantiles=(0.16, 0.84)).T
+            return predicted, expected, (high - low) / 2.
+
+        return predicted, expected
+    finally:
+        if isinstance(rf_optimised, BatchedRandomForestRegressor):
+            #removes the batches only if they were written to a temporary folder
+            rf_optimised.close()
     
     
-def SupportVectorRegression(X_train, X_test, y_train, y_test, search, save=False):
+def SupportVectorRegression(X_train, X_test, y_train, y_test, search, save=False, method='exact', n_jobs=None,
+                            features=None):
     """
     Support Vector Regression.
     
     Can run a grid search to look for the best parameters (search=True) and
-    save the model to a file (save=True).    
+    save the model to a file (save=True), together with the features transform.
+
+    The exact kernel SVR does not scale beyond a few hundred thousand galaxies. With
+    method='nystroem' or method='fourier' the kernel is approximated with an explicit
+    feature map and a linear model is trained in mini-batches, see approximateSVR.
+
+    n_jobs sets the number of parallel fits of the search, by default all the cores.
     """
     if search:
         # parameter values over which we will search
-        parameters = {'C': [0.1, 0.5, 1., 1.5, 2.],
-                     'kernel': ['rbf', 'sigmoid', 'poly'],
-                     'degree': [3, 5]}
-        s = SVR()
-        clf = grid_search.GridSearchCV(s, parameters, scoring='r2',
-                                       n_jobs=-1, verbose=1, cv=3)
-    else:
+        #the degree is used only by the polynomial kernel
+        parameters = [{'C': [0.1, 0.5, 1., 1.5, 2.], 'kernel': ['rbf', 'sigmoid']},
+                      {'C': [0.1, 0.5, 1., 1.5, 2.], 'kernel': ['poly'], 'degree': [3, 5]}]
+        s = SVR() if method == 'exact' else ApproximateKernelSVR(method=method)
+        if method == 'fourier':
+            #random Fourier features approximate only the rbf kernel
+            parameters = {'C': [0.1, 0.5, 1., 1.5, 2.], 'kernel': ['rbf']}
+        if search == 'halving':
+            clf = SuccessiveHalvingSearch(s, parameters, n_candidates=27, resource='n_samples',
+                                          n_jobs=n_jobs or multiprocessing.cpu_count(), folder='search/SVR/')
+        else:
+            clf = grid_search.GridSearchCV(s, parameters, scoring='r2',
+                                           n_jobs=n_jobs or -1, verbose=1, cv=3)
+    elif method == 'exact':
         clf = SVR(verbose=1)
+    else:
+        clf = ApproximateKernelSVR(method=method, verbose=1)
     
-    print '\nTraining...'
-    clf.fit(X_train, y_train)
-    print 'Done'
+    with instrument.stage('fit', rows=len(y_train), model='SVR'):
+        clf.fit(X_train, y_train)
 
     if search:
         print 'The best score and estimator:'
@@ -237,18 +554,19 @@ def SupportVectorRegression(X_train, X_test, y_train, y_test, search, save=False
         print(clf.best_estimator_)
         print 'Best hyperparameters:'
         print clf.best_params_
-        clf = clf.best_estimator
+        clf = clf.best_estimator_
 
     if save:
         print 'Save the SVR model to a pickled file...'
         fp = open('model/SVR.pkl', 'w')
         cPickle.dump(clf, fp)
         fp.close()
+        if features is not None:
+            modelStore.saveFeatures(features, 'model/SVR.pkl')
 
-    print '\nPredicting...'
-    predicted = clf.predict(X_test)
-    expected = y_test.copy()    
-    print 'Done'
+    with instrument.stage('predict', rows=len(y_test), model='SVR'):
+        predicted = clf.predict(X_test)
+    expected = y_test.copy()
 
     return predicted, expected    
  
@@ -257,21 +575,125 @@ def BayesianRidge(X_train, X_test, y_train, y_test, search=True):
     """
     Bayesian Ridge Regression.
     """
-    print '\nTraining...'
-    clf = linear_model.BayesianRidge(n_iter=1000, tol=1e-3, alpha_1=1., 
-                                     fit_intercept=True, normalize=False, verbose=1)
-    clf.fit(X_train, y_train)
-    print 'Done'
-    
-    print '\nPredicting...'
-    predicted = clf.predict(X_test)
-    expected = y_test.copy()    
-    print 'Done'
+    clf = linear_model.BayesianRidge(normalize=False, verbose=1, **BAYESIAN_RIDGE)
+    with instrument.stage('fit', rows=len(y_train), model='BayesianRidge'):
+        clf.fit(X_train, y_train)
+
+    with instrument.stage('predict', rows=len(y_test), model='BayesianRidge'):
+        predicted = clf.predict(X_test)
+    expected = y_test.copy()
 
     return predicted, expected    
 
 
-def GradientBoostingRegressor(X_train, X_test, y_train, y_test, search, save=False):
+def NearestNeighbours(X_train, X_test, y_train, y_test, search=False, save=False, n_jobs=None, uncertainty=False,
+                      features=None):
+    """
+    k-nearest-neighbour regression, see nearestNeighbours.
+
+    The KD-tree of the training set is built once and saved with the model (save=True),
+    together with the features transform.
+    Can run a grid search over the number of neighbours, the weighting and the index
+    (search=True). With uncertainty=True the weighted standard deviation of the
+    neighbour redshifts is returned as a third array with the error of each galaxy.
+    """
+    if search:
+        parameters = {'n_neighbors': [3, 5, 10, 20, 40],
+                      'weights': ['uniform', 'distance'],
+                      'algorithm': ['kd_tree', 'ball_tree']}
+        clf = grid_search.GridSearchCV(NearestNeighbourRegressor(n_jobs=1), parameters, scoring='r2',
+                                       n_jobs=n_jobs or -1, verbose=1, cv=3)
+    else:
+        clf = NearestNeighbourRegressor(n_jobs=n_jobs or -1, **NEAREST_NEIGHBOURS)
+
+    with instrument.stage('fit', rows=len(y_train), model='kNN'):
+        clf.fit(X_train, y_train)
+
+    if search:
+        print 'The best score and estimator:'
+        print(clf.best_score_)
+        print 'Best hyperparameters:'
+        print clf.best_params_
+        clf = clf.best_estimator_.set_params(n_jobs=n_jobs or -1)
+
+    if save:
+        print 'Save the kNN model with its index to model/kNN.pkl'
+        fp = open('model/kNN.pkl', 'wb')
+        cPickle.dump(clf, fp, protocol=2)
+        fp.close()
+        if features is not None:
+            modelStore.saveFeatures(features, 'model/kNN.pkl')
+
+    with instrument.stage('predict', rows=len(y_test), model='kNN'):
+        predicted, error = clf.predict(X_test, return_std=True)
+    expected = y_test.copy()
+
+    if uncertainty:
+        return predicted, expected, error
+    return predicted, expected
+
+
+class EarlyStoppingMonitor(object):
+    """
+    Monitor for GBR.fit that tracks the loss on a held-out validation set as the
+    stages are added and stops the fit when the loss has not improved for patience stages.
+
+    The validation predictions are updated with the newest tree only, so checking the
+    loss costs one tree evaluation per stage. Works also when continuing a warm-started
+    model, in which case the earlier stages are evaluated once at the first call.
+
+    The validation set is scored with a fixed metric, the mean squared (metric='mse') or
+    absolute (metric='mae') error, and not with the training loss of the model: the
+    gamma of the Huber loss is refitted to the training residuals at every stage, so the
+    Huber loss of the validation set keeps falling and would never trigger the stop.
+    """
+    def __init__(self, X_valid, y_valid, patience=200, tol=0.0, metric='mse'):
+        if metric not in ('mse', 'mae'):
+            raise ValueError('metric must be mse or mae, got %s' % metric)
+        self.X_valid = X_valid
+        self.y_valid = np.asarray(y_valid, dtype=np.float64).ravel()
+        self.patience = patience
+        self.metric = metric
+        self.tol = tol
+        self.predicted = None
+        self.losses = []
+        self.best = 0
+        self.bestLoss = np.inf
+
+    def __call__(self, i, est, locals_):
+        if self.predicted is None:
+            self.predicted = est.init_.predict(self.X_valid).astype(np.float64).ravel()
+            for tree in est.estimators_[:i, 0]:
+                self.predicted += est.learning_rate * tree.predict(self.X_valid)
+            self.losses = [np.nan] * i
+        self.predicted += est.learning_rate * est.estimators_[i, 0].predict(self.X_valid)
+        residual = self.y_valid - self.predicted
+        loss = np.dot(residual, residual) / len(residual) if self.metric == 'mse' else np.mean(np.abs(residual))
+        self.losses.append(loss)
+
+        if loss < self.bestLoss - self.tol:
+            self.best, self.bestLoss = i, loss
+        return i - self.best >= self.patience
+
+    def keepBest(self, est):
+        """
+        Drop the stages after the iteration with the lowest validation loss.
+        """
+        n = self.best + 1
+        print 'Keeping %i stages, lowest validation loss %f' % (n, self.bestLoss)
+        est.estimators_ = est.estimators_[:n]
+        est.train_score_ = est.train_score_[:n]
+        if hasattr(est, 'oob_improvement_'):
+            est.oob_improvement_ = est.oob_improvement_[:n]
+        if hasattr(est, 'n_estimators_'):
+            est.n_estimators_ = n
+        est.n_estimators = n
+        return est
+
+
+def GradientBoostingRegressor(X_train, X_test, y_train, y_test, search, save=False,
+                              patience=None, warmStart=None, extraStages=1000, engine='exact', n_jobs=None,
+                              uncertainty=False, features=None):
     """
     GB builds an additive model in a forward stage-wise fashion;
     it allows for the optimization of arbitrary differentiable loss functions.
@@ -279,7 +701,7 @@ def GradientBoostingRegressor(X_train, X_test, y_train, y_test, search, save=Fal
     given loss function.
 
     Can run a grid search to look for the best parameters (search=True) and
-    save the model to a file (save=True).    
+    save the model to a file (save=True), together with the features transform.
     Among the most important hyperparameters for GBRT are:
 
         #. number of regression trees (n_estimators)
@@ -287,6 +709,21 @@ def GradientBoostingRegressor(X_train, X_test, y_train, y_test, search, save=Fal
         #. loss function (loss)
         #. learning rate (learning_rate)
 
+    With patience set the training is stopped when the loss on a validation set, held out
+    from the training data, has not improved for patience stages and only the stages up to
+    the best iteration are kept. A model saved earlier (model/GBR.pkl) can be continued with
+    warmStart, in which case extraStages more stages are added.
+
+    With engine='histogram' the model is trained with the histogram binned, multithreaded
+    HistogramGradientBoostingRegressor using the same loss and subsampling (early stopping
+    and warm starts are only available for the exact sklearn engine).
+
+    n_jobs sets the number of parallel fits of the search and the threads of the histogram
+    engine, by default all the cores.
+
+    With uncertainty=True two companion models with the same settings but the quantile loss
+    are trained for the 16th and the 84th percentiles, and half of their difference is
+    returned as a third array with the error of each galaxy.
     """   
     if search:
         # parameter values over which we will search
@@ -295,14 +732,33 @@ def GradientBoostingRegressor(X_train, X_test, y_train, y_test, search, save=Fal
                      'max_depth': [1, 2, 3, 5, 7, None],
                      'max_features': ['sqrt', None]}
         s = GBR(n_estimators=500, verbose=1)
-        clf = grid_search.GridSearchCV(s, parameters, scoring='r2',
-                                       n_jobs=-1, verbose=1, cv=3)
+        if search == 'halving':
+            clf = SuccessiveHalvingSearch(s, parameters, n_candidates=81, resource='n_estimators',
+                                          min_resource=20, n_jobs=n_jobs or multiprocessing.cpu_count(),
+                                          folder='search/GBR/')
+        else:
+            clf = grid_search.GridSearchCV(s, parameters, scoring='r2',
+                                           n_jobs=n_jobs or -1, verbose=1, cv=3)
+    elif engine == 'histogram':
+        clf = HistogramGradientBoostingRegressor(verbose=100, n_estimators=5000, n_jobs=n_jobs or -1,
+                                                 **GRADIENT_BOOSTING)
+    elif warmStart is not None:
+        clf = modelStore.loadModel(warmStart)
+        clf.set_params(warm_start=True, n_estimators=clf.n_estimators + extraStages)
     else:
-        clf = GBR(verbose=1, n_estimators=5000,learning_rate=0.05, loss='huber', max_depth=3, subsample=0.8)
-        
-    print '\nTraining...'    
-    clf.fit(X_train, y_train)
-    print 'Done'
+        clf = GBR(verbose=1, n_estimators=5000, **GRADIENT_BOOSTING)
+
+    monitor = None
+    if patience is not None and not search and engine == 'exact':
+        X_train, X_valid, y_train, y_valid = train_test_split(X_train, y_train, test_size=0.1, random_state=42)
+        monitor = EarlyStoppingMonitor(X_valid, y_valid, patience=patience)
+
+    with instrument.stage('fit', rows=len(y_train), model='GBR', engine=engine):
+        if monitor is None:
+            clf.fit(X_train, y_train)
+        else:
+            clf.fit(X_train, y_train, monitor=monitor)
+            monitor.keepBest(clf)
 
     if search:
         print 'The best score and estimator:'
@@ -312,21 +768,96 @@ def GradientBoostingRegressor(X_train, X_test, y_train, y_test, search, save=Fal
         print clf.best_params_
         clf = clf.best_estimator_
 
+    companions = []
+    if uncertainty:
+        for alpha in (0.16, 0.84):
+            with instrument.stage('fit', rows=len(y_train), model='GBR quantile %.2f' % alpha, engine=engine):
+                companions.append(_quantileCompanion(clf, alpha).fit(X_train, y_train))
+
     if save:
-        print 'Save the BGR model to a pickled file...'
-        fp = open('model/GBR.pkl', 'w')
-        cPickle.dump(clf, fp)
+        print 'Save the GBR model to flat node arrays in model/GBR/ and to model/GBR.pkl for warm starts'
+        modelStore.saveEnsemble(clf, 'model/GBR/')
+        fp = open('model/GBR.pkl', 'wb')
+        cPickle.dump(clf, fp, protocol=2)
         fp.close()
+        if features is not None:
+            modelStore.saveFeatures(features, 'model/GBR/')
+        for alpha, companion in zip((0.16, 0.84), companions):
+            folder = 'model/GBR_q%02i/' % (100 * alpha)
+            modelStore.saveEnsemble(companion, folder)
+            if features is not None:
+                modelStore.saveFeatures(features, folder)
  
-    print '\nPredicting...'
-    predicted = clf.predict(X_test)
-    expected = y_test.copy()    
-    print 'Done'
+    with instrument.stage('predict', rows=len(y_test), model='GBR', engine=engine):
+        predicted = clf.predict(X_test)
+    expected = y_test.copy()
+
+    if uncertainty:
+        with instrument.stage('uncertainty', rows=len(y_test), model='GBR', engine=engine):
+            low, high = [companion.predict(X_test) for companion in companions]
+        return predicted, expected, (high - low) / 2.
 
     return predicted, expected    
 
 
-def randomForestTestPlots(X_train, X_test, y_train, y_test):
+def _quantileCompanion(clf, alpha):
+    """
+    Unfitted copy of a gradient boosting model with the quantile loss for the alpha quantile.
+    """
+    if isinstance(clf, HistogramGradientBoostingRegressor):
+        return HistogramGradientBoostingRegressor(n_estimators=len(clf.estimators_), learning_rate=clf.learning_rate,
+                                                  loss='quantile', alpha=alpha, max_depth=clf.max_depth,
+                                                  min_samples_leaf=clf.min_samples_leaf, subsample=clf.subsample,
+                                                  max_bins=clf.max_bins, n_jobs=clf.n_jobs,
+                                                  random_state=clf.random_state, verbose=clf.verbose)
+    return clone(clf).set_params(loss='quantile', alpha=alpha, n_estimators=len(clf.estimators_), warm_start=False)
+
+
+def _fitEngine(engine, X_train, X_test, y_train, n_estimators, queue):
+    """
+    Fit and predict with a gradient boosting engine, run in a separate process by
+    compareGradientBoostingEngines so that the peak memory of each engine is measured alone.
+    """
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    settings = dict(GRADIENT_BOOSTING, n_estimators=n_estimators)
+    if engine == 'histogram':
+        clf = HistogramGradientBoostingRegressor(**settings)
+    else:
+        clf = GBR(**settings)
+    t0 = time.time()
+    clf.fit(X_train, y_train)
+    fitTime = time.time() - t0
+    predicted = clf.predict(X_test)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start
+    queue.put((fitTime, peak / 1024., predicted))
+
+
+def compareGradientBoostingEngines(X_train, X_test, y_train, y_test, n_estimators=500):
+    """
+    Benchmark the exact sklearn and the histogram gradient boosting engines.
+
+    Reports the fit time, the increase of the peak memory during the fit and the
+    RMS and R2 from plotResults for both engines.
+    """
+    results = {}
+    for engine in ('exact', 'histogram'):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_fitEngine,
+                                          args=(engine, X_train, X_test, y_train, n_estimators, queue))
+        process.start()
+        fitTime, peak, predicted = queue.get()
+        process.join()
+        scores = plotResults(predicted, y_test, output='GBREngine%s' % engine.capitalize())
+        results[engine] = dict(fit_time=fitTime, peak_memory_mb=peak, rms=scores['rms'], r2=scores['r2'])
+
+    print '%-10s %12s %16s %10s %10s' % ('engine', 'fit [s]', 'peak mem [MB]', 'RMS', 'R2')
+    for engine in ('exact', 'histogram'):
+        r = results[engine]
+        print '%-10s %12.2f %16.1f %10.4f %10.4f' % (engine, r['fit_time'], r['peak_memory_mb'], r['rms'], r['r2'])
+    return results
+
+
+def randomForestTestPlots(X_train, X_test, y_train, y_test, runner=None):
     """
     Validation Curve
     ================
@@ -343,22 +874,27 @@ def randomForestTestPlots(X_train, X_test, y_train, y_test):
     score and the training score converge to a value that is too low with
     increasing size of the training set, we will not benefit much from more
     training data.
+
+    The fits of both curves are run together by a DiagnosticsRunner, which caches
+    the scores of every fit on disk.
     """
-    title = "Validation Curve (Random Forest)"
-    print title
+    if runner is None:
+        runner = DiagnosticsRunner(X_train, X_test, y_train, y_test)
+
     param_range = np.round(np.linspace(0, 60, 15) + 1).astype(np.int)
     rf = RandomForestRegressor(n_estimators=100,
                                max_features=6,
                                min_samples_split=2,
                                n_jobs=2, verbose=1)
+    train_sizes = np.linspace(.1, 1.0, 5)
+    #schedule the fits of both plots in one go
+    runner.compute(runner.validationCurveTasks(rf, 'max_depth', param_range) +
+                   runner.learningCurveTasks(rf, train_sizes, n_iter=50, test_size=0.2, random_state=0))
+
     #validation curve
-    train_scores, test_scores = validation_curve(rf,
-                                                 X_train,
-                                                 y_train,
-                                                 'max_depth',
-                                                 param_range,
-                                                 n_jobs=-1,
-                                                 verbose=1)
+    title = "Validation Curve (Random Forest)"
+    print title
+    train_scores, test_scores = runner.validationCurve(rf, 'max_depth', param_range)
     train_scores_mean = np.mean(train_scores, axis=1)
     train_scores_std = np.std(train_scores, axis=1)
     test_scores_mean = np.mean(test_scores, axis=1)
@@ -382,31 +918,34 @@ def randomForestTestPlots(X_train, X_test, y_train, y_test):
     #learning curve
     title = "Learning Curves (Random Forest)"
     print title
-    cv = cross_validation.ShuffleSplit(X_train.shape[0], n_iter=50,
-                                       test_size=0.2, random_state=0)
-    
-    plot_learning_curve(rf, title, X_train, y_train, ylim=(0.85, 1.01), cv=cv, n_jobs=-1)
+    scores = runner.learningCurve(rf, train_sizes, n_iter=50, test_size=0.2, random_state=0)
+    plot_learning_curve(rf, title, X_train, y_train, ylim=(0.85, 1.01), scores=scores)
     plt.savefig('RandomForestLearningCurve.pdf')
     plt.close()
 
 
 
-def GradientBoostingRegressorTestPlots(X_train, X_test, y_train, y_test, n_estimators=1000):
+def GradientBoostingRegressorTestPlots(X_train, X_test, y_train, y_test, n_estimators=1000, runner=None,
+                                       features=None):
     """
     An important diagnostic when using GBRT in practise is the so-called deviance
     plot that shows the training/testing error (or deviance) as a function of the
     number of trees.
+
+    The feature importances are labelled with the names of the features transform the
+    data were loaded with (by default the magnitudes and, if present, their errors).
+
+    The models are fitted by a DiagnosticsRunner: the baseline model is fitted once and
+    shared by the deviance, importance and comparison plots, the other variants are
+    fitted in parallel, and the results are cached on disk.
     """
     def fmt_params(params):
         return ", ".join("{0}={1}".format(key, val) for key, val in params.iteritems())
         
-    def deviance_plot(est, X_test, y_test, ax=None, label='', train_color='#2c7bb6', 
+    def deviance_plot(result, ax=None, label='', train_color='#2c7bb6', 
                       test_color='#d7191c', alpha=1.0):
-        """Deviance plot for ``est``, use ``X_test`` and ``y_test`` for test error. """
-        test_dev = np.empty(n_estimators)
-    
-        for i, pred in enumerate(est.staged_predict(X_test)):
-           test_dev[i] = est.loss_(y_test, pred)
+        """Deviance plot for the fit ``result`` of the runner. """
+        test_dev = result['test_deviance']
     
         if ax is None:
             fig = plt.figure(figsize=(8, 5))
@@ -414,17 +953,28 @@ def GradientBoostingRegressorTestPlots(X_train, X_test, y_train, y_test, n_estim
             
         ax.plot(np.arange(n_estimators) + 1, test_dev, color=test_color, label='Test %s' % label, 
                  linewidth=2, alpha=alpha)
-        ax.plot(np.arange(n_estimators) + 1, est.train_score_, color=train_color, 
+        ax.plot(np.arange(n_estimators) + 1, result['train_score'], color=train_color, 
                  label='Train %s' % label, linewidth=2, alpha=alpha)
         ax.set_ylabel('Error')
         ax.set_xlabel('n_estimators')
         return test_dev, ax
 
-    est = GBR(n_estimators=n_estimators, verbose=1)
-    est.fit(X_train, y_train)
-    feature_importance = est.feature_importances_
+    if runner is None:
+        runner = DiagnosticsRunner(X_train, X_test, y_train, y_test)
+
+    comparisons = [('GBRTree.pdf', [({'min_samples_leaf': 1}, ('#d7191c', '#2c7bb6')),
+                                    ({'min_samples_leaf': 4}, ('#fdae61', '#abd9e9'))]),
+                   ('GBRShrinkage.pdf', [({'learning_rate': 0.2}, ('#d7191c', '#2c7bb6')),
+                                         ({'learning_rate': 0.7}, ('#fdae61', '#abd9e9'))]),
+                   ('GBRSubsample.pdf', [({'subsample': 1.}, ('#d7191c', '#2c7bb6')),
+                                         ({'subsample': 0.7}, ('#fdae61', '#abd9e9'))])]
+    baseline = GBR(n_estimators=n_estimators, verbose=1)
+    variants = [params for output, plots in comparisons for params, colors in plots]
+    results = runner.deviance([baseline] + [clone(baseline).set_params(**params) for params in variants])
+    baseline, variants = results[0], iter(results[1:])
+    feature_importance = baseline['feature_importances']
     
-    test_dev, ax = deviance_plot(est, X_test, y_test)
+    test_dev, ax = deviance_plot(baseline)
     ax.legend(loc='upper right')
     ax.annotate('Lowest test error', xy=(test_dev.argmin() + 1, test_dev.min() + 0.02), xycoords='data',
                 xytext=(150, 1.0), textcoords='data',
@@ -432,61 +982,21 @@ def GradientBoostingRegressorTestPlots(X_train, X_test, y_train, y_test, n_estim
     plt.savefig('GBRdeviance.pdf')
     plt.close()
         
-    #sample leaves
-    fig = plt.figure(figsize=(8, 5))
-    ax = plt.gca()
-    for params, (test_color, train_color) in [({'min_samples_leaf': 1},
-                                                ('#d7191c', '#2c7bb6')),
-                                              ({'min_samples_leaf': 4},
-                                               ('#fdae61', '#abd9e9'))]:
-        est = GBR(n_estimators=n_estimators, verbose=1)
-        est.set_params(**params)
-        est.fit(X_train, y_train)
-        
-        test_dev, ax = deviance_plot(est, X_test, y_test, ax=ax, label=fmt_params(params),
-                                     train_color=train_color, test_color=test_color)
-    plt.legend(loc='upper right')
-    plt.savefig('GBRTree.pdf')
-    plt.close()
-    
-    #lerning rate
-    fig = plt.figure(figsize=(8, 5))
-    ax = plt.gca()
-    for params, (test_color, train_color) in [({'learning_rate': 0.2},
-                                                ('#d7191c', '#2c7bb6')),
-                                              ({'learning_rate': 0.7},
-                                               ('#fdae61', '#abd9e9'))]:
-        est = GBR(n_estimators=n_estimators, verbose=1)
-        est.set_params(**params)
-        est.fit(X_train, y_train)
-        
-        test_dev, ax = deviance_plot(est, X_test, y_test, ax=ax, label=fmt_params(params),
-                                     train_color=train_color, test_color=test_color)
-    plt.legend(loc='upper right')
-    plt.savefig('GBRShrinkage.pdf')
-    plt.close()
-    
-    #sub-samples
-    fig = plt.figure(figsize=(8, 5))
-    ax = plt.gca()
-    for params, (test_color, train_color) in [({'subsample': 1.},
-                                                ('#d7191c', '#2c7bb6')),
-                                              ({'subsample': 0.7},
-                                               ('#fdae61', '#abd9e9'))]:
-        est = GBR(n_estimators=n_estimators, verbose=1)
-        est.set_params(**params)
-        est.fit(X_train, y_train)
-        
-        test_dev, ax = deviance_plot(est, X_test, y_test, ax=ax, label=fmt_params(params),
-                                     train_color=train_color, test_color=test_color)
-    plt.legend(loc='upper right')
-    plt.savefig('GBRSubsample.pdf')
-    plt.close()    
+    #sample leaves, learning rate and sub-samples
+    for output, plots in comparisons:
+        fig = plt.figure(figsize=(8, 5))
+        ax = plt.gca()
+        for params, (test_color, train_color) in plots:
+            test_dev, ax = deviance_plot(next(variants), ax=ax, label=fmt_params(params),
+                                         train_color=train_color, test_color=test_color)
+        plt.legend(loc='upper right')
+        plt.savefig(output)
+        plt.close()
     
     #feature importance
-    feature_names = ['u', 'g', 'r', 'i', 'z', 'modelmagerr_u', 'modelmagerr_g',
-                     'modelmagerr_r', 'modelmagerr_i', 'modelmagerr_z']
-    feature_names = np.asarray(feature_names)
+    if features is None:
+        features = PhotometricFeatures(errors=X_train.shape[1] > len(MAGNITUDES))
+    feature_names = np.asarray(features.names)
     feature_importance = 100.0 * (feature_importance / feature_importance.max())
     sorted_idx = np.argsort(feature_importance)
     pos = np.arange(sorted_idx.shape[0]) + .5
@@ -499,79 +1009,179 @@ def GradientBoostingRegressorTestPlots(X_train, X_test, y_train, y_test, n_estim
     plt.close()
 
 
-def plotResults(predicted, expected, output):
+def plotResults(predicted, expected, output, density=None):
     """
     Generate a simple plot demonstrating the results.
+
+    With density=True the galaxies are binned to a 2D histogram drawn as a raster, with
+    the bias and the outlier fraction per redshift bin, see densityPlot. By default the
+    density plot is used for more than 100000 galaxies, for which a scatter plot would
+    take long to draw and give a very large file.
+
+    The metrics are accumulated in a single pass over chunks of the galaxies and include
+    the bias, NMAD and outlier fraction of dz/(1+z), also in redshift bins, see photozMetrics.
+    Returns the metrics as a dictionary.
     """
-    var = metrics.explained_variance_score(expected, predicted)
-    mae = metrics.mean_absolute_error(expected, predicted)
-    mse = metrics.mean_squared_error(expected, predicted)
-    r2 = metrics.r2_score(expected, predicted)
-    rms = np.sqrt(np.mean((expected - predicted) ** 2))
+    with instrument.stage('metrics', rows=len(expected)):
+        accumulator = PhotozMetrics()
+        for start in range(0, len(expected), 1000000):
+            accumulator.update(predicted[start:start + 1000000], expected[start:start + 1000000])
 
     print output
-    print 'Explained variance (best possible score is 1.0, lower values are worse):', var
-    print 'Mean Absolute Error (best is 0.0):', mae
-    print 'Mean Squred Error (best is 0.0):', mse
-    print 'R2 score (best is 1.0):', r2
-    print 'RMS:', rms
+    result = accumulator.report()
     print '\n\n\n'
+    mse, r2, rms = result['mse'], result['r2'], result['rms']
 
     title = 'RMS=%.4f, MSE=%.4f, R2=%.3f' % (rms, mse, r2)
 
-    fig = plt.figure()
-    ax1 = fig.add_subplot(111)
-    plt.title(title)
-    ax1.scatter(expected, predicted, alpha=0.2, s=5)
-    ax1.set_xlabel("Spectroscopic Redshift")
-    ax1.set_ylabel("Photo-z")
-    ax1.plot([0, 8], [0, 8], '-r')
-    ax1.set_xlim(0, 1.1*expected.max())
-    ax1.set_ylim(0, 1.1*expected.max())
-    plt.savefig(output+'Results.pdf')
-    plt.close()
+    if density is None:
+        density = len(expected) > 100000
 
+    if density:
+        from densityPlot import RedshiftDensity
+        with instrument.stage('plot', rows=len(expected), density=True):
+            RedshiftDensity().update(predicted, expected).plot(output + 'Results.pdf', title)
+        return result
 
+    with instrument.stage('plot', rows=len(expected)):
+        fig = plt.figure()
+        ax1 = fig.add_subplot(111)
+        plt.title(title)
+        ax1.scatter(expected, predicted, alpha=0.2, s=5)
+        ax1.set_xlabel("Spectroscopic Redshift")
+        ax1.set_ylabel("Photo-z")
+        ax1.plot([0, 8], [0, 8], '-r')
+        ax1.set_xlim(0, 1.1*expected.max())
+        ax1.set_ylim(0, 1.1*expected.max())
+        plt.savefig(output+'Results.pdf')
+        plt.close()
+
+    return result
 
-def runRandomForestKaggle(useErrors=True, search=False, test=False):
-    """
-    Simple Random Forest on Kaggle training data.
-    """
-    X_train, X_test, y_train, y_test = loadKaggledata(useErrors=useErrors)
-    if test: randomForestTestPlots(X_train, X_test, y_train, y_test)
-    predictedRF, expectedRF = randomForest(X_train, X_test, y_train, y_test, search=search)
-    plotResults(predictedRF, expectedRF, output='RandomForestKaggleErrors')
 
 
-def runBayesianRidgeKaggle(useErrors=True):
+def runRandomForestKaggle(useErrors=True, search=False, test=False, cache=None, batchSize=None, uncertainty=None,
+                          features=None):
+    """
+    Simple Random Forest on Kaggle training data. Use batchSize to train the forest in
+    batches of trees spilled to disk, and uncertainty ('spread' or 'quantile') to check
+    the per-galaxy errors.
+    """
+    with instrument.stage('runRandomForestKaggle'):
+        X_train, X_test, y_train, y_test = _loadTrainingData(useErrors, cache, features)
+        if test:
+            with instrument.stage('diagnostics'):
+                randomForestTestPlots(X_train, X_test, y_train, y_test)
+        result = randomForest(X_train, X_test, y_train, y_test, search=search, batchSize=batchSize,
+                              uncertainty=uncertainty)
+        predictedRF, expectedRF = result[:2]
+        if uncertainty:
+            photozUncertainty.coverage(predictedRF, expectedRF, result[2])
+        plotResults(predictedRF, expectedRF, output='RandomForestKaggleErrors')
+
+
+def runBayesianRidgeKaggle(useErrors=True, cache=None, features=None):
     """
     Run Bayesian Ridge on Kaggle training data.
     """
-    X_train, X_test, y_train, y_test = loadKaggledata(useErrors=useErrors)
-    predicted, expected = BayesianRidge(X_train, X_test, y_train, y_test)
-    plotResults(predicted, expected, output='BayesianRidgeKaggleErrors')
+    with instrument.stage('runBayesianRidgeKaggle'):
+        X_train, X_test, y_train, y_test = _loadTrainingData(useErrors, cache, features)
+        predicted, expected = BayesianRidge(X_train, X_test, y_train, y_test)
+        plotResults(predicted, expected, output='BayesianRidgeKaggleErrors')
     
     
-def runSupportVectorRegression(useErrors=False, search=False):
+def runNearestNeighboursKaggle(useErrors=True, search=False, cache=None, uncertainty=False, features=None):
+    """
+    k-nearest-neighbour baseline on Kaggle training data.
+    """
+    with instrument.stage('runNearestNeighboursKaggle'):
+        X_train, X_test, y_train, y_test = _loadTrainingData(useErrors, cache, features)
+        result = NearestNeighbours(X_train, X_test, y_train, y_test, search=search, uncertainty=uncertainty)
+        predicted, expected = result[:2]
+        if uncertainty:
+            photozUncertainty.coverage(predicted, expected, result[2])
+        plotResults(predicted, expected, output='kNNKaggleErrors')
+
+
+def runSupportVectorRegression(useErrors=False, search=False, cache=None, method='exact', features=None):
     """
-    Pretty slow to run.
+    Pretty slow to run, unless an approximate kernel (method='nystroem' or 'fourier') is used.
     """
-    X_train, X_test, y_train, y_test = loadKaggledata(useErrors=useErrors)
-    predicted, expected = SupportVectorRegression(X_train, X_test, y_train, y_test, search)
-    plotResults(predicted, expected, output='SVRKaggleErrors')    
+    with instrument.stage('runSupportVectorRegression'):
+        X_train, X_test, y_train, y_test = _loadTrainingData(useErrors, cache, features)
+        predicted, expected = SupportVectorRegression(X_train, X_test, y_train, y_test, search, method=method)
+        plotResults(predicted, expected, output='SVRKaggleErrors')
 
 
-def runGradientBoostingRegressor(useErrors=True, search=False, test=True):
+def runGradientBoostingRegressor(useErrors=True, search=False, test=True, cache=None, patience=None,
+                                 warmStart=None, engine='exact', uncertainty=False, features=None):
     """
     Run Gradient Boosting on Kaggle training data.
+
+    The engine is either 'exact' (sklearn) or 'histogram' (histogramBoosting). With
+    uncertainty=True quantile companions are trained and the per-galaxy errors checked.
+    Other features than the magnitudes, e.g. colours, can be used by passing a
+    features.PhotometricFeatures transform (features), which overrides useErrors.
     """
-    X_train, X_test, y_train, y_test = loadKaggledata(useErrors=useErrors)
-    if test: GradientBoostingRegressorTestPlots(X_train, X_test, y_train, y_test)
-    predicted, expected = GradientBoostingRegressor(X_train, X_test, y_train, y_test, search)
-    plotResults(predicted, expected, output='GBRKaggleErrors')    
+    with instrument.stage('runGradientBoostingRegressor'):
+        X_train, X_test, y_train, y_test = _loadTrainingData(useErrors, cache, features)
+        if test:
+            with instrument.stage('diagnostics'):
+                GradientBoostingRegressorTestPlots(X_train, X_test, y_train, y_test, features=features)
+        result = GradientBoostingRegressor(X_train, X_test, y_train, y_test, search, patience=patience,
+                                           warmStart=warmStart, engine=engine, uncertainty=uncertainty)
+        predicted, expected = result[:2]
+        if uncertainty:
+            photozUncertainty.coverage(predicted, expected, result[2])
+        plotResults(predicted, expected, output='GBRKaggleErrors')
 
     
+def _pipelineJobs(models, X_train, search=False, engine='exact', method='exact'):
+    """
+    Pipeline jobs of the models with their cores and memory estimates.
+
+    The exact GBR, Bayesian Ridge and the exact SVR are single threaded. The forest and the
+    kNN queries use all the cores they are given; a fully grown tree with leaves of about two galaxies has
+    roughly as many nodes as there are training galaxies, at 64 bytes per node.
+    """
+    n_train = X_train.shape[0]
+    jobs = {'GradientBoostingRegressor': dict(function=GradientBoostingRegressor, output='GBRKaggleErrors',
+                                              kwargs=dict(search=search, engine=engine),
+                                              cores=-1 if search or engine == 'histogram' else 1),
+            'BayesianRidge': dict(function=BayesianRidge, output='BayesianRidgeKaggleErrors', cores=1),
+            'randomForest': dict(function=randomForest, output='RandomForestKaggleErrors',
+                                 kwargs=dict(search=search), cores=-1,
+                                 memory=2000 * 64 * n_train + 4 * X_train.nbytes),
+            'SupportVectorRegression': dict(function=SupportVectorRegression, output='SVRKaggleErrors',
+                                            kwargs=dict(search=search, method=method), cores=-1 if search else 1),
+            'NearestNeighbours': dict(function=NearestNeighbours, output='kNNKaggleErrors',
+                                      kwargs=dict(search=search), cores=-1)}
+    return [dict(jobs[model], name=model, report=plotResults) for model in models]
+
+
+def runKagglePipeline(models=('GradientBoostingRegressor', 'BayesianRidge', 'randomForest'), useErrors=True,
+                      cache=None, search=False, n_jobs=-1, memoryBudget=16 * 1024 ** 3, folder='pipeline/',
+                      features=None):
+    """
+    Run several models on the Kaggle training data concurrently, see pipeline.PipelineRunner.
+
+    The data are loaded and scaled once and shared with the workers, the models are
+    scheduled under a single budget of n_jobs cores and memoryBudget bytes, and the
+    metrics of all the models are printed as one comparison table (and written to
+    pipeline/report.json).
+    """
+    with instrument.stage('runKagglePipeline'):
+        X_train, X_test, y_train, y_test = _loadTrainingData(useErrors, cache, features)
+        runner = PipelineRunner(X_train, X_test, y_train, y_test, n_jobs=n_jobs, memoryBudget=memoryBudget,
+                                folder=folder)
+        results = runner.run(_pipelineJobs(models, X_train, search))
+        runner.report()
+    return results
+
+
 if __name__ == '__main__':
-    runGradientBoostingRegressor()
-    runBayesianRidgeKaggle()
-    runRandomForestKaggle()
+    #time and memory of every stage are written to events.jsonl, see instrument
+    instrument.configure(output='events.jsonl')
+    #the csv file is parsed only once and the models are trained concurrently on the shared data
+    runKagglePipeline(cache='cache/')
+    instrument.summary(instrument.readEvents('events.jsonl'))
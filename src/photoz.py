@@ -0,0 +1,229 @@
+"""
+Photo-z Command Line
+====================
+
+Command line entry point of the photometric redshift scripts.
+
+Subcommands::
+
+    python photoz.py cache --data kaggleData/ --cache cache/ --colours
+    python photoz.py train GradientBoostingRegressor --data kaggleData/ --cache cache/ --colours
+    python photoz.py predict model/GBR/ kaggleData/query.csv photoz.csv
+    python photoz.py diagnose randomForest --data kaggleData/ --cache cache/
+    python photoz.py plot photoz.csv kaggleData/train.csv --output GBRKaggle
+    python photoz.py update newRedshifts.csv --state model/incremental/ --export
+
+train saves the model together with its features transform (see features), which
+predict picks up, so a model is always scored with the features it was trained on.
+update trains the models of an incremental state on a catalog, or updates them with
+the new galaxies of a catalog if the state exists already, see incremental.
+With --events the time and the memory of every stage are written to a file and
+summarised at the end, see instrument.
+
+Only the modules a subcommand needs are imported, and that only after the command
+line has been parsed: predict loads numpy, pandas and the model store but neither
+matplotlib nor the training code, and with the default --n-jobs 1 the catalog is
+scored in the same process. The cold start of predict can be measured with
+benchmark.coldStart.
+
+:requires: pandas
+:requires: numpy
+:requires: scikit-learn
+:requires: matplotlib
+
+:version: 0.1
+"""
+import argparse
+import sys
+import os
+
+
+#models that can be trained and saved, with their uncertainty option
+TRAINABLE = {'randomForest': 'spread', 'GradientBoostingRegressor': True,
+             'NearestNeighbours': True, 'SupportVectorRegression': None}
+
+
+def _features(args):
+    """
+    Features transform of the command line options.
+    """
+    from features import PhotometricFeatures
+    return PhotometricFeatures(magnitudes=not args.no_magnitudes, errors=not args.no_errors,
+                               colours=args.colours, fluxes=args.fluxes)
+
+
+def _load(args, features):
+    """
+    Load the training data from the csv file or the feature cache.
+    """
+    import photometricRedshifts as pz
+    if args.cache is None:
+        return pz.loadKaggledata(folder=args.data, features=features)
+    return pz.loadKaggledataCached(folder=args.data, cache=args.cache, features=features)
+
+
+def cache(args):
+    """
+    Build (or check) the feature cache entry of the training data.
+    """
+    _load(args, _features(args))
+
+
+def train(args):
+    """
+    Train a model, save it with its features transform to model/ and report the metrics.
+    """
+    import photometricRedshifts as pz
+    features = _features(args)
+    X_train, X_test, y_train, y_test = _load(args, features)
+    if not os.path.exists('model'):
+        os.makedirs('model')
+
+    kwargs = dict(search=args.search, save=True, features=features)
+    if args.n_jobs is not None:
+        kwargs['n_jobs'] = args.n_jobs
+    if args.uncertainty:
+        if TRAINABLE[args.model] is None:
+            raise SystemExit('%s has no uncertainty estimate' % args.model)
+        kwargs['uncertainty'] = TRAINABLE[args.model]
+    result = getattr(pz, args.model)(X_train, X_test, y_train, y_test, **kwargs)
+
+    predicted, expected = result[:2]
+    if args.uncertainty:
+        pz.photozUncertainty.coverage(predicted, expected, result[2])
+    if args.plot:
+        pz.plotResults(predicted, expected, output=args.plot)
+    else:
+        from photozMetrics import PhotozMetrics
+        PhotozMetrics().update(predicted, expected).report()
+
+
+def predict(args):
+    """
+    Score a catalog with a saved model.
+    """
+    from photozInference import predictCatalog
+    predictCatalog(args.model, args.scaler, args.catalog, args.output, useErrors=not args.no_errors,
+                   chunksize=args.chunksize, n_jobs=args.n_jobs, uncertainty=args.uncertainty,
+                   metrics=args.metrics)
+
+
+def diagnose(args):
+    """
+    Write the diagnostic plots (validation and learning curves, deviance, importances).
+    """
+    import photometricRedshifts as pz
+    features = _features(args)
+    X_train, X_test, y_train, y_test = _load(args, features)
+    if args.model == 'randomForest':
+        pz.randomForestTestPlots(X_train, X_test, y_train, y_test)
+    else:
+        pz.GradientBoostingRegressorTestPlots(X_train, X_test, y_train, y_test, features=features)
+
+
+def plot(args):
+    """
+    Plot the photo-z written by predict against the redshifts of the catalog.
+    """
+    import pandas as pd
+    import photometricRedshifts as pz
+    predictions = pd.read_csv(args.predictions, usecols=['ID', 'photo_z'], index_col=0)
+    redshifts = pd.read_csv(args.catalog, usecols=['ID', 'redshift'], index_col=0)
+    data = predictions.join(redshifts, how='inner')
+    pz.plotResults(data['photo_z'].values, data['redshift'].values, output=args.output, density=args.density)
+
+
+def update(args):
+    """
+    Train the incremental models on a catalog, or update them with its galaxies.
+    """
+    from incremental import updateCatalog
+    kwargs = {}
+    if args.n_jobs is not None:
+        kwargs['n_jobs'] = args.n_jobs
+    updateCatalog(args.catalog, folder=args.state, features=_features(args), export=args.export, **kwargs)
+
+
+def _featureOptions(parser):
+    parser.add_argument('--data', default='MachineLearning/photo-z/kaggleData/',
+                        help='folder of the Kaggle train.csv')
+    parser.add_argument('--cache', help='feature cache folder, e.g. cache/ (default: no cache)')
+    _transformOptions(parser)
+
+
+def _transformOptions(parser):
+    parser.add_argument('--no-errors', action='store_true', help='leave out the magnitude errors')
+    parser.add_argument('--no-magnitudes', action='store_true', help='leave out the magnitudes')
+    parser.add_argument('--colours', action='store_true', help='add the colours u-g, g-r, r-i, i-z')
+    parser.add_argument('--fluxes', action='store_true', help='add the fluxes')
+
+
+def parser():
+    """
+    The argument parser of the command line.
+    """
+    main = argparse.ArgumentParser(description='Photometric redshifts with machine learning.')
+    main.add_argument('--events', help='write the time and memory of every stage to this file')
+    commands = main.add_subparsers()
+
+    command = commands.add_parser('cache', help='build the feature cache of the training data')
+    _featureOptions(command)
+    command.set_defaults(function=cache)
+
+    command = commands.add_parser('train', help='train and save a model')
+    command.add_argument('model', choices=sorted(TRAINABLE))
+    _featureOptions(command)
+    command.add_argument('--search', nargs='?', const=True, default=False, choices=[True, 'halving'],
+                         help='search the hyperparameters, optionally with successive halving')
+    command.add_argument('--n-jobs', type=int, help='number of cores')
+    command.add_argument('--uncertainty', action='store_true', help='check the per-galaxy errors')
+    command.add_argument('--plot', metavar='OUTPUT', help='also plot the results to OUTPUTResults.pdf')
+    command.set_defaults(function=train)
+
+    command = commands.add_parser('predict', help='score a catalog with a saved model')
+    command.add_argument('model', help='model store folder or pickled model')
+    command.add_argument('catalog', help='csv file with the ID and the magnitudes')
+    command.add_argument('output', help='output csv file (ID, photo_z)')
+    command.add_argument('--scaler', help='pickled scaler or features transform (default: saved with the model)')
+    command.add_argument('--no-errors', action='store_true', help='the model was trained without the errors '
+                                                                  '(only with --scaler)')
+    command.add_argument('--n-jobs', type=int, default=1, help='worker processes, -1 for all the cores')
+    command.add_argument('--chunksize', type=int, default=100000, help='rows scored at a time')
+    command.add_argument('--uncertainty', action='store_true', help='also write the spread of the trees')
+    command.add_argument('--metrics', action='store_true', help='the catalog has redshifts, report the metrics')
+    command.set_defaults(function=predict)
+
+    command = commands.add_parser('diagnose', help='diagnostic plots of a model')
+    command.add_argument('model', choices=['randomForest', 'GradientBoostingRegressor'])
+    _featureOptions(command)
+    command.set_defaults(function=diagnose)
+
+    command = commands.add_parser('plot', help='plot predictions against the spectroscopic redshifts')
+    command.add_argument('predictions', help='csv file written by predict')
+    command.add_argument('catalog', help='csv file with the ID and the redshift')
+    command.add_argument('--output', default='photoz', help='the plot is written to OUTPUTResults.pdf')
+    command.add_argument('--density', action='store_true', default=None, help='draw a density plot')
+    command.set_defaults(function=plot)
+
+    command = commands.add_parser('update', help='train or update the incremental models with a catalog')
+    command.add_argument('catalog', help='csv file with the ID, the magnitudes and the redshift')
+    command.add_argument('--state', default='model/incremental/', help='folder of the incremental state')
+    _transformOptions(command)
+    command.add_argument('--n-jobs', type=int, help='number of cores of the forest')
+    command.add_argument('--export', action='store_true', help='also write the models to model/ for predict')
+    command.set_defaults(function=update)
+    return main
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.events:
+        import instrument
+        instrument.configure(output=args.events)
+    args.function(args)
+    if args.events:
+        instrument.summary(instrument.readEvents(args.events))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,200 @@
+"""
+Photometric Redshift Inference
+==============================
+
+Streaming inference for catalogs of any size. A saved model and the scaler fitted
+to the training data are loaded once per worker process (models from the model store
+are memory-mapped and hence shared between the workers), the catalog is read in
+blocks and the blocks are scored in a process pool. The results are written to
+a csv file (ID, photo_z) as soon as each block is done, so the memory use is
+bounded by the block size and the number of blocks in flight. For forests the spread
+of the trees can be written as the estimated redshift error, see uncertainty.forestSpread.
+For catalogs with known redshifts the metrics are accumulated by the workers and merged,
+see photozMetrics, so the predictions never need to be collected in one place.
+
+:requires: pandas
+:requires: numpy
+:requires: scikit-learn
+
+:version: 0.1
+"""
+import numpy as np
+import multiprocessing
+import collections
+import cPickle
+import time
+from features import _featureColumns, _readKaggleChunks
+from modelStore import loadModel, loadFeatures
+from uncertainty import forestSpread
+from photozMetrics import PhotozMetrics
+
+
+#model and scaler (or features transform) of a worker process, set by _initWorker
+_model = None
+_scaler = None
+
+
+def loadPickle(filename):
+    """
+    Load a pickled object, e.g. a model saved by randomForest(save=True).
+    """
+    fh = open(filename, 'rb')
+    obj = cPickle.load(fh)
+    fh.close()
+    return obj
+
+
+def _transform(model, scaler):
+    """
+    The transform from the raw columns to the model input: the given pickled scaler or
+    features transform, by default the features transform saved with the model.
+    """
+    if scaler is None:
+        transform = loadFeatures(model)
+        if transform is None:
+            raise ValueError('no features transform saved with %s, give the scaler' % model)
+        return transform
+    return loadPickle(scaler)
+
+
+def _initWorker(model, scaler):
+    """
+    Load the model and the scaler once per worker process.
+    """
+    global _model, _scaler
+    _model = loadModel(model)
+    _scaler = _transform(model, scaler)
+
+
+def _predictBlock(block, uncertainty=False, labelled=False):
+    """
+    Scale a block of raw features and predict the photometric redshifts, and with
+    uncertainty=True also the spread of the trees. For a labelled block (the last
+    column is the redshift) the metrics of the block are returned too.
+    """
+    if labelled:
+        block, redshift = block[:, :-1], block[:, -1]
+    if uncertainty:
+        result = np.column_stack(forestSpread(_model, _scaler.transform(block))).astype(np.float32)
+        predicted = result[:, 0]
+    else:
+        result = predicted = _model.predict(_scaler.transform(block)).astype(np.float32)
+    if labelled:
+        return result, PhotozMetrics().update(predicted, redshift)
+    return result, None
+
+
+class _Finished(object):
+    """
+    Result of a block scored in the calling process, with the get of an AsyncResult.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class _InProcessPool(object):
+    """
+    Stand-in for the pool with n_jobs=1. The blocks are scored in the calling process,
+    which saves starting a worker and loading the model in it, most of the run time of
+    short scoring jobs.
+    """
+    def __init__(self, model, scaler):
+        _initWorker(model, scaler)
+
+    def apply_async(self, function, args):
+        return _Finished(function(*args))
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def predictCatalog(model, scaler, catalog, output, useErrors=True, chunksize=100000, n_jobs=-1,
+                   uncertainty=False, metrics=False):
+    """
+    Score a catalog with a saved model and write the photometric redshifts to a file.
+
+    :param model: model store folder (e.g. model/GBR/) or a pickled model
+    :param scaler: pickled scaler fitted to the training data, e.g. scaler.pkl in a feature cache entry,
+                   or a pickled features transform (features.pkl); None to use the features
+                   transform saved with the model
+    :param catalog: csv file with the ID and the features (e.g. the Kaggle query.csv)
+    :param output: name of the output csv file (ID, photo_z)
+    :param useErrors: whether the model was trained with the magnitude errors (only used with a scaler,
+                      a features transform knows its columns)
+    :param chunksize: number of rows scored in one block
+    :param n_jobs: number of worker processes, -1 to use all the cores; with n_jobs=1 the
+                   catalog is scored in the calling process
+    :param uncertainty: for forests, also write the standard deviation of the trees as
+                        estimatedRedshiftError
+    :param metrics: the catalog has a redshift column, report the metrics of the photo-z
+
+    At most two blocks per worker are in flight at a time, hence the memory use does not
+    depend on the size of the catalog.
+
+    :return: number of rows scored and the throughput in rows per second, and with metrics=True
+             also the dictionary of the metrics
+    """
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    if n_jobs == 1:
+        pool = _InProcessPool(model, scaler)
+    else:
+        pool = multiprocessing.Pool(n_jobs, initializer=_initWorker, initargs=(model, scaler))
+
+    start = time.time()
+    rows = 0
+    fh = open(output, 'w')
+    fh.write('ID,photo_z,estimatedRedshiftError\n' if uncertainty else 'ID,photo_z\n')
+    fmt = ['%d', '%.6f', '%.6f'] if uncertainty else ['%d', '%.6f']
+    inflight = collections.deque()
+    accumulator = PhotozMetrics()
+
+    def write(ids, result):
+        predicted, blockMetrics = result.get()
+        np.savetxt(fh, np.column_stack((ids, predicted)), fmt=fmt, delimiter=',')
+        if blockMetrics is not None:
+            accumulator.merge(blockMetrics)
+
+    transform = _transform(model, scaler)
+    columns = getattr(transform, 'columns', _featureColumns(useErrors)) + (['redshift'] if metrics else [])
+    for ids, block in _readKaggleChunks(catalog, columns, chunksize):
+        inflight.append((ids, pool.apply_async(_predictBlock, (block, uncertainty, metrics))))
+        rows += len(ids)
+        if len(inflight) >= 2 * n_jobs:
+            write(*inflight.popleft())
+    while inflight:
+        write(*inflight.popleft())
+
+    fh.close()
+    pool.close()
+    pool.join()
+
+    duration = time.time() - start
+    rate = rows / max(duration, 1e-9)
+    print 'Scored %i galaxies in %.1f seconds (%.0f rows per second)' % (rows, duration, rate)
+
+    if metrics:
+        return rows, rate, accumulator.report()
+    return rows, rate
+
+
+def runPredictKaggle(scaler=None, model='model/GBR/', folder='MachineLearning/photo-z/kaggleData/',
+                     useErrors=True, output='KaggleQueryPhotoz.csv'):
+    """
+    Derive photometric redshifts for the Kaggle query file.
+
+    The scaler is the scaler.pkl written to the feature cache entry the model was trained on,
+    by default the features transform saved with the model is used.
+    """
+    return predictCatalog(model, scaler, folder + 'query.csv', output, useErrors=useErrors)
+
+
+if __name__ == '__main__':
+    import sys
+    runPredictKaggle(sys.argv[1] if len(sys.argv) > 1 else None)
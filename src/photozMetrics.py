@@ -0,0 +1,202 @@
+"""
+Photo-z Metrics
+===============
+
+Streaming, mergeable accumulator of the photometric redshift metrics.
+
+The metrics of plotResults (explained variance, MAE, MSE, R2 and RMS) and the standard
+photo-z quantities of the normalised residuals dz = (photo-z - z) / (1 + z), i.e. the
+bias, the scatter, the NMAD (1.4826 times the median absolute deviation) and the fraction
+of catastrophic outliers (|dz| > 0.15), are accumulated chunk by chunk, overall and in
+bins of spectroscopic redshift.
+
+Each chunk is reduced to counts, sums, means and sums of squared deviations (combined
+with the pairwise update of Chan et al.), so the accumulators of parallel workers can
+be merged and the merged result is the same as that of a single pass over all the
+galaxies. The median and the NMAD cannot be reduced that way; they are computed from a
+fine histogram of dz (bins of 1e-4 by default), which is also mergeable and gives them
+to a fraction of the bin width.
+
+:requires: numpy
+
+:version: 0.1
+"""
+import numpy as np
+
+
+def _combine(n1, mean1, m21, n2, mean2, m22):
+    """
+    Merge the counts, means and sums of squared deviations of two sets (Chan et al.).
+    """
+    n = n1 + n2
+    nonzero = np.maximum(n, 1)
+    delta = mean2 - mean1
+    mean = mean1 + delta * n2 / nonzero
+    m2 = m21 + m22 + delta ** 2 * n1 * n2 / nonzero
+    return n, mean, m2
+
+
+def _histogramMedian(edges, cumulative, total):
+    """
+    Median of a histogram with linear interpolation within the bins.
+    """
+    return np.interp(0.5 * total, cumulative, edges)
+
+
+class PhotozMetrics(object):
+    """
+    Accumulates the photo-z metrics over chunks of galaxies.
+
+    :param zbins: edges of the spectroscopic redshift bins; galaxies outside the edges are
+                  counted in the first or the last bin
+    :param outlier: limit of |dz| for catastrophic outliers
+    :param resolution: bin width of the dz histogram used for the median and the NMAD
+    :param dzmax: range of the dz histogram, larger |dz| are counted at its ends
+    """
+    def __init__(self, zbins=np.linspace(0., 1., 11), outlier=0.15, resolution=1e-4, dzmax=0.5):
+        self.zbins = np.asarray(zbins, dtype=np.float64)
+        self.outlier = outlier
+        self.edges = np.linspace(-dzmax, dzmax, int(round(2 * dzmax / resolution)) + 1)
+        nz = len(self.zbins) - 1
+        #overall statistics
+        self.n = 0
+        self.zMean, self.zM2 = 0., 0.
+        self.residualMean, self.residualM2 = 0., 0.
+        self.absoluteSum, self.squareSum = 0., 0.
+        #statistics of dz in the redshift bins, the overall ones are combined from them
+        self.counts = np.zeros(nz, dtype=np.int64)
+        self.dzMean, self.dzM2 = np.zeros(nz), np.zeros(nz)
+        self.binAbsoluteSum, self.binSquareSum = np.zeros(nz), np.zeros(nz)
+        self.outliers = np.zeros(nz, dtype=np.int64)
+        self.histogram = np.zeros((nz, len(self.edges) + 1), dtype=np.int64)
+
+    def update(self, predicted, expected):
+        """
+        Add a chunk of galaxies.
+        """
+        predicted = np.asarray(predicted, dtype=np.float64).ravel()
+        expected = np.asarray(expected, dtype=np.float64).ravel()
+        n = expected.shape[0]
+        if n == 0:
+            return self
+        residual = expected - predicted
+        _, self.residualMean, self.residualM2 = _combine(self.n, self.residualMean, self.residualM2,
+                                                         n, residual.mean(), np.var(residual) * n)
+        self.n, self.zMean, self.zM2 = _combine(self.n, self.zMean, self.zM2,
+                                                n, expected.mean(), np.var(expected) * n)
+        absolute = np.abs(residual)
+        self.absoluteSum += absolute.sum()
+        self.squareSum += np.dot(residual, residual)
+
+        nz = len(self.counts)
+        zbin = np.clip(np.searchsorted(self.zbins, expected, side='right') - 1, 0, nz - 1)
+        dz = -residual / (1. + expected)
+        counts = np.bincount(zbin, minlength=nz)
+        mean = np.bincount(zbin, weights=dz, minlength=nz) / np.maximum(counts, 1)
+        m2 = np.bincount(zbin, weights=(dz - mean[zbin]) ** 2, minlength=nz)
+        self.counts, self.dzMean, self.dzM2 = _combine(self.counts, self.dzMean, self.dzM2, counts, mean, m2)
+        self.binAbsoluteSum += np.bincount(zbin, weights=absolute, minlength=nz)
+        self.binSquareSum += np.bincount(zbin, weights=residual ** 2, minlength=nz)
+        self.outliers += np.bincount(zbin, weights=np.abs(dz) > self.outlier, minlength=nz).astype(np.int64)
+        #bin 0 and the last bin count the dz beyond the range of the histogram
+        position = np.searchsorted(self.edges, dz, side='right')
+        self.histogram += np.bincount(zbin * self.histogram.shape[1] + position,
+                                      minlength=self.histogram.size).reshape(self.histogram.shape)
+        return self
+
+    def merge(self, other):
+        """
+        Add the statistics of another accumulator with the same binning, e.g. of a parallel worker.
+        """
+        if not (np.array_equal(self.zbins, other.zbins) and np.array_equal(self.edges, other.edges) and
+                self.outlier == other.outlier):
+            raise ValueError('the binning of the accumulators differs')
+        n = self.n
+        self.n, self.zMean, self.zM2 = _combine(n, self.zMean, self.zM2, other.n, other.zMean, other.zM2)
+        _, self.residualMean, self.residualM2 = _combine(n, self.residualMean, self.residualM2,
+                                                         other.n, other.residualMean, other.residualM2)
+        self.absoluteSum += other.absoluteSum
+        self.squareSum += other.squareSum
+        self.counts, self.dzMean, self.dzM2 = _combine(self.counts, self.dzMean, self.dzM2,
+                                                       other.counts, other.dzMean, other.dzM2)
+        self.binAbsoluteSum += other.binAbsoluteSum
+        self.binSquareSum += other.binSquareSum
+        self.outliers += other.outliers
+        self.histogram += other.histogram
+        return self
+
+    def _nmad(self, histogram):
+        """
+        Median and NMAD of dz from a row of the histogram.
+        """
+        total = histogram.sum()
+        if total == 0:
+            return np.nan, np.nan
+        #cumulative counts at the edges, the counts beyond the range are put at the ends
+        cumulative = np.cumsum(histogram[:-1])
+        median = _histogramMedian(self.edges, cumulative, total)
+
+        def within(radius):
+            return np.interp(median + radius, self.edges, cumulative) - np.interp(median - radius, self.edges,
+                                                                                  cumulative)
+        low, high = 0., self.edges[-1] - self.edges[0]
+        for i in range(60):
+            middle = 0.5 * (low + high)
+            if within(middle) >= 0.5 * total:
+                high = middle
+            else:
+                low = middle
+        return median, 1.4826 * high
+
+    def _dzStatistics(self, counts, mean, m2, outliers, histogram):
+        n = max(counts, 1)
+        median, nmad = self._nmad(histogram)
+        return dict(n=int(counts), bias=mean if counts else np.nan, sigma=np.sqrt(m2 / n) if counts else np.nan,
+                    median=median, nmad=nmad, outliers=outliers / float(n) if counts else np.nan)
+
+    def results(self):
+        """
+        The metrics as a dictionary. The statistics of dz in the redshift bins are in
+        'binned', a list with a dictionary per bin.
+        """
+        n = max(self.n, 1)
+        n_all, mean, m2 = self.counts[0], self.dzMean[0], self.dzM2[0]
+        for i in range(1, len(self.counts)):
+            n_all, mean, m2 = _combine(n_all, mean, m2, self.counts[i], self.dzMean[i], self.dzM2[i])
+        result = dict(var=1. - self.residualM2 / self.zM2 if self.zM2 > 0 else np.nan,
+                      mae=self.absoluteSum / n,
+                      mse=self.squareSum / n,
+                      r2=1. - self.squareSum / self.zM2 if self.zM2 > 0 else np.nan,
+                      rms=np.sqrt(self.squareSum / n))
+        result.update(self._dzStatistics(n_all, mean, m2, self.outliers.sum(), self.histogram.sum(axis=0)))
+
+        result['binned'] = []
+        for i in range(len(self.counts)):
+            binned = self._dzStatistics(self.counts[i], self.dzMean[i], self.dzM2[i], self.outliers[i],
+                                        self.histogram[i])
+            binned.update(zmin=self.zbins[i], zmax=self.zbins[i + 1],
+                          mae=self.binAbsoluteSum[i] / max(self.counts[i], 1),
+                          rms=np.sqrt(self.binSquareSum[i] / max(self.counts[i], 1)))
+            result['binned'].append(binned)
+        return result
+
+    def report(self):
+        """
+        Print the metrics, overall and in the redshift bins.
+        """
+        result = self.results()
+        print 'Explained variance (best possible score is 1.0, lower values are worse):', result['var']
+        print 'Mean Absolute Error (best is 0.0):', result['mae']
+        print 'Mean Squred Error (best is 0.0):', result['mse']
+        print 'R2 score (best is 1.0):', result['r2']
+        print 'RMS:', result['rms']
+        print 'Bias of dz/(1+z):', result['bias']
+        print 'NMAD of dz/(1+z):', result['nmad']
+        print 'Catastrophic outlier fraction (|dz|/(1+z) > %.2f): %f' % (self.outlier, result['outliers'])
+        print '%6s %6s %9s %10s %10s %10s %10s' % ('zmin', 'zmax', 'n', 'bias', 'NMAD', 'outliers', 'RMS')
+        for binned in result['binned']:
+            if binned['n']:
+                print '%6.2f %6.2f %9i %10.5f %10.5f %10.5f %10.5f' % (binned['zmin'], binned['zmax'], binned['n'],
+                                                                    binned['bias'], binned['nmad'],
+                                                                    binned['outliers'], binned['rms'])
+        return result
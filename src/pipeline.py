@@ -0,0 +1,181 @@
+"""
+Pipeline Runner
+===============
+
+Runs several estimators on the same training data concurrently.
+
+The catalog is loaded, split and scaled once. The arrays are shared read-only with
+the worker processes as memory-mapped .npy files (the feature cache is used directly
+when the data come from it), so no worker parses or rescales the data again and the
+pages are shared between the workers.
+
+Every job declares the number of cores and the memory it needs. The jobs are started
+as soon as both fit in the global core and memory budget, and the number of cores of a
+job is passed to it as n_jobs, so the nested parallelism of the estimators does not
+oversubscribe the machine. Each worker also has its address space capped at the memory
+of the job on top of the address space it inherited from the parent, as measured by
+the worker when it starts (see hyperparameterSearch._limitMemory). The metrics of all
+the jobs are gathered into a single comparison report.
+
+:requires: numpy
+
+:version: 0.1
+"""
+import numpy as np
+from hyperparameterSearch import dataFile, _limitMemory
+import multiprocessing
+import traceback
+import resource
+import Queue
+import inspect
+import json
+import time
+import os
+import instrument
+
+
+def _runJob(job, files, queue, memoryLimit):
+    """
+    Run a single job in a worker process and put its result to the queue.
+    """
+    start = time.time()
+    result = {'name': job['name'], 'cores': job['cores'], 'memory': job['memory'], 'start': start}
+    try:
+        _limitMemory(memoryLimit)
+        X_train, X_test, y_train, y_test = [np.load(filename, mmap_mode='r') for filename in files]
+        kwargs = dict(job.get('kwargs', {}))
+        if 'n_jobs' in inspect.getargspec(job['function']).args:
+            kwargs['n_jobs'] = job['cores']
+        with instrument.stage(job['name']):
+            predicted, expected = job['function'](X_train, X_test, y_train, y_test, **kwargs)
+            result['fit_predict'] = time.time() - start
+            np.save(job['predictions'], predicted)
+            if job.get('report') is not None:
+                result['metrics'] = job['report'](predicted, expected, output=job['output'])
+        result['status'] = 'done'
+    except MemoryError:
+        result['status'] = 'MemoryError'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['wall'] = time.time() - start
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    queue.put(result)
+
+
+class PipelineRunner(object):
+    """
+    Schedules estimator jobs on shared data under a core and memory budget.
+
+    A job is a dictionary with the keys:
+
+        * name: name of the job in the report
+        * function: called as function(X_train, X_test, y_train, y_test, **kwargs) and
+          returning the predicted and expected redshifts; if it takes n_jobs, the cores
+          of the job are passed as n_jobs
+        * kwargs: further keyword arguments of the function (optional)
+        * cores: number of cores the job uses, -1 for the whole budget
+        * memory: memory the job needs in bytes, by default four times the size of the training data
+        * report: called as report(predicted, expected, output=output) in the worker and
+          returning a dictionary of metrics, e.g. plotResults (optional)
+        * output: output name passed to report (optional)
+
+    :param n_jobs: total number of cores, -1 for the number of cores of the machine
+    :param memoryBudget: total memory of the workers in bytes
+    :param folder: folder of the shared data files, the predictions and the report
+    """
+    def __init__(self, X_train, X_test, y_train, y_test, n_jobs=-1, memoryBudget=16 * 1024 ** 3,
+                 folder='pipeline/', verbose=1):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.verbose = verbose
+        self.cores = multiprocessing.cpu_count() if n_jobs < 1 else n_jobs
+        self.memoryBudget = memoryBudget
+        self.defaultMemory = 4 * X_train.nbytes + 256 * 1024 ** 2
+        arrays = (('X_train', X_train), ('X_test', X_test), ('y_train', y_train), ('y_test', y_test))
+        self.files = [dataFile(folder, name, array) for name, array in arrays]
+
+    def _prepare(self, job):
+        job = dict(job)
+        job['cores'] = self.cores if job.get('cores', 1) < 1 else min(job.get('cores', 1), self.cores)
+        job['memory'] = min(job.get('memory') or self.defaultMemory, self.memoryBudget)
+        job['output'] = job.get('output', job['name'])
+        job['predictions'] = os.path.join(self.folder, job['name'] + '.npy')
+        return job
+
+    def run(self, jobs):
+        """
+        Run the jobs and return their results in the order of the jobs. The jobs are
+        started in the given order whenever they fit in the free cores and memory.
+        """
+        pending = [self._prepare(job) for job in jobs]
+        queue = multiprocessing.Queue()
+        running = {}
+        results = {}
+        freeCores, freeMemory = self.cores, self.memoryBudget
+        start = time.time()
+
+        while pending or running:
+            for job in list(pending):
+                if job['cores'] <= freeCores and job['memory'] <= freeMemory:
+                    pending.remove(job)
+                    #_limitMemory adds the address space the worker inherits from this process
+                    process = multiprocessing.Process(target=_runJob, args=(job, self.files, queue, job['memory']))
+                    process.start()
+                    running[job['name']] = (process, job)
+                    freeCores -= job['cores']
+                    freeMemory -= job['memory']
+                    if self.verbose:
+                        print 'Started %s with %i cores and %.1f GB (%i cores and %.1f GB free)' % \
+                              (job['name'], job['cores'], job['memory'] / 1024. ** 3, freeCores,
+                               freeMemory / 1024. ** 3)
+
+            try:
+                result = queue.get(timeout=1.)
+            except Queue.Empty:
+                #a worker killed without reporting back, e.g. by the kernel
+                for name, (process, job) in running.items():
+                    if not process.is_alive() and process.exitcode != 0:
+                        results[name] = {'name': name, 'cores': job['cores'], 'memory': job['memory'],
+                                         'status': 'exit code %i' % process.exitcode}
+                        del running[name]
+                        freeCores += job['cores']
+                        freeMemory += job['memory']
+                continue
+
+            process, job = running.pop(result['name'])
+            process.join()
+            freeCores += job['cores']
+            freeMemory += job['memory']
+            result['start'] -= start
+            results[result['name']] = result
+            if self.verbose:
+                print 'Finished %s: %s in %.1f s' % (result['name'], result['status'], result['wall'])
+                if 'error' in result:
+                    print result['error']
+
+        self.wall = time.time() - start
+        self.results = [results[job['name']] for job in jobs]
+        return self.results
+
+    def report(self, output='report.json'):
+        """
+        Print a comparison table of the jobs and write the results to a JSON file in the folder.
+        """
+        print '%-28s %-12s %6s %9s %10s %10s %10s %10s %10s' % ('job', 'status', 'cores', 'start [s]', 'wall [s]',
+                                                                'peak [MB]', 'RMS', 'R2', 'MAE')
+        for result in self.results:
+            metrics = result.get('metrics') or {}
+            print '%-28s %-12s %6i %9.1f %10.1f %10.0f %10s %10s %10s' % \
+                  (result['name'], result['status'], result['cores'], result.get('start', np.nan),
+                   result.get('wall', np.nan), result.get('peak_rss_mb', np.nan),
+                   '%.5f' % metrics['rms'] if 'rms' in metrics else '',
+                   '%.5f' % metrics['r2'] if 'r2' in metrics else '',
+                   '%.5f' % metrics['mae'] if 'mae' in metrics else '')
+        sequential = sum(result.get('wall', 0.) for result in self.results)
+        print 'Total wall time %.1f s, %.1f s if run one after another' % (self.wall, sequential)
+
+        with open(os.path.join(self.folder, output), 'w') as fh:
+            json.dump({'wall': self.wall, 'cores': self.cores, 'memoryBudget': self.memoryBudget,
+                       'results': self.results}, fh, indent=1, default=float)
@@ -0,0 +1,33 @@
+"""
+Plotting
+========
+
+Matplotlib set up for the plots of the photo-z scripts.
+
+The rcParams of the plots are set when matplotlib is first used, and pyplot stands in
+as a lazy module (see lazyImport), so importing a module that plots does not import
+matplotlib. Modules that plot take pyplot from here rather than importing it directly,
+which would bypass the rcParams.
+
+:requires: matplotlib
+
+:version: 0.1
+"""
+from lazyImport import LazyModule
+
+
+def _configureMatplotlib():
+    import matplotlib
+    matplotlib.rcParams['font.size'] = 17
+    matplotlib.rc('xtick', labelsize=14)
+    matplotlib.rc('axes', linewidth=1.1)
+    matplotlib.rcParams['legend.fontsize'] = 11
+    matplotlib.rcParams['legend.handlelength'] = 3
+    matplotlib.rcParams['xtick.major.size'] = 5
+    matplotlib.rcParams['ytick.major.size'] = 5
+    matplotlib.rcParams['image.interpolation'] = 'none'
+
+
+mpl = LazyModule('matplotlib', setup=_configureMatplotlib)
+cm = LazyModule('matplotlib.cm', setup=_configureMatplotlib)
+plt = LazyModule('matplotlib.pyplot', setup=_configureMatplotlib)
@@ -0,0 +1,401 @@
+"""
+Photo-z Scoring Service
+=======================
+
+Long-running local HTTP service that scores galaxies on demand with a saved model.
+
+The model and its features transform (or a pickled scaler) are loaded once, when the
+service starts, and stay resident, so a request costs only the scoring and not the
+start of a Python process and the loading of the model.
+
+Concurrent requests are coalesced into micro-batches: a batch is closed when it has
+batchSize rows or when its first request has waited maxWait seconds, whichever comes
+first, and is then scored as one block on a pool of workers (threads by default, or
+processes that load the model once each, see photozInference). At most two batches
+per worker are in flight; while they are scored new requests queue up, so the batches
+grow with the load. A request is checked (finite values, at least one row) before it
+joins a batch and is rejected with a 400 otherwise; should a batch still fail, its
+requests are scored again one at a time, so the error of one client never reaches the
+others. The service keeps counters of the requests, the rows and the batches, and the
+p50/p99 latency of the recent requests.
+
+Endpoints::
+
+    POST /predict  {"rows": [[u, g, r, i, z, modelmagerr_u, ...], ...]} -> {"photo_z": [...]}
+    GET  /stats    counters, latency percentiles, throughput and the input columns
+
+The rows are the raw catalog columns in the order of the columns of the features
+transform (see GET /stats). loadTest is a load generator: a number of concurrent
+clients send requests with rows of a catalog and the client side latency and the
+throughput are reported together with the statistics of the service.
+
+Usage::
+
+    python scoringService.py serve model/GBR/ --port 8080 --max-wait 0.002 --batch-size 2048
+    python scoringService.py load http://127.0.0.1:8080 kaggleData/query.csv --clients 16
+
+:requires: numpy
+:requires: pandas
+:requires: scikit-learn
+
+:version: 0.1
+"""
+import numpy as np
+import multiprocessing
+import multiprocessing.pool
+import BaseHTTPServer
+import SocketServer
+import collections
+import threading
+import argparse
+import urllib2
+import Queue
+import json
+import time
+import sys
+import photozInference
+from features import _featureColumns, _readKaggleChunks
+
+
+def _scoreBatch(block):
+    """
+    Score a batch in a worker, the error is returned as a string instead of raised.
+    """
+    try:
+        return photozInference._predictBlock(block)[0], None
+    except Exception as error:
+        return None, '%s: %s' % (error.__class__.__name__, error)
+
+
+class _Request(object):
+    """
+    Rows of a request waiting for their photo-z.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.start = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ServiceStatistics(object):
+    """
+    Counters of the requests, rows and batches, and the latencies of the last window requests.
+    """
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=window)
+
+    def batch(self, requests, rows, error):
+        now = time.time()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(requests)
+            self.rows += rows
+            if error:
+                self.errors += len(requests)
+            self.latencies.extend(now - request.start for request in requests)
+
+    def results(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            result = dict(requests=self.requests, rows=self.rows, batches=self.batches, errors=self.errors,
+                          uptime=time.time() - self.start)
+        result['rows_per_batch'] = result['rows'] / float(max(result['batches'], 1))
+        result['requests_per_second'] = result['requests'] / max(result['uptime'], 1e-9)
+        result['rows_per_second'] = result['rows'] / max(result['uptime'], 1e-9)
+        if len(latencies):
+            result['p50'], result['p99'] = np.percentile(latencies, [50, 99])
+        else:
+            result['p50'] = result['p99'] = None
+        return result
+
+
+class ScoringService(object):
+    """
+    Resident model with a micro-batching queue in front of a pool of workers.
+
+    :param model: model store folder (e.g. model/GBR/) or a pickled model
+    :param scaler: pickled scaler or features transform, None to use the features transform saved with the model
+    :param useErrors: whether the model was trained with the magnitude errors (only used with a scaler)
+    :param maxWait: longest time in seconds a request waits for others to join its batch
+    :param batchSize: largest number of rows in a batch
+    :param workers: number of workers, -1 for all the cores
+    :param processes: score in worker processes instead of threads
+    """
+    def __init__(self, model, scaler=None, useErrors=True, maxWait=0.002, batchSize=2048, workers=1,
+                 processes=False):
+        self.maxWait = maxWait
+        self.batchSize = batchSize
+        self.workers = multiprocessing.cpu_count() if workers < 1 else workers
+        transform = photozInference._transform(model, scaler)
+        self.columns = getattr(transform, 'columns', _featureColumns(useErrors))
+        if processes:
+            self.pool = multiprocessing.Pool(self.workers, initializer=photozInference._initWorker,
+                                             initargs=(model, scaler))
+        else:
+            #the threads share the model of this process, numpy and the tree code release the GIL
+            photozInference._initWorker(model, scaler)
+            self.pool = multiprocessing.pool.ThreadPool(self.workers)
+        self.statistics = ServiceStatistics()
+        self.queue = Queue.Queue()
+        self.inflight = threading.Semaphore(2 * self.workers)
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def predict(self, rows):
+        """
+        Photo-z of the rows of raw columns, blocks until the batch of the rows has been scored.
+        """
+        rows = np.asarray(rows, dtype=np.float32)
+        if rows.ndim != 2 or rows.shape[1] != len(self.columns):
+            raise ValueError('expected rows of the %i columns %s' % (len(self.columns), self.columns))
+        #a request is checked before it joins a batch, so that its bad input cannot fail the others
+        if rows.shape[0] == 0:
+            raise ValueError('no rows to score')
+        if not np.isfinite(rows).all():
+            raise ValueError('the rows contain NaN or infinite values')
+        request = _Request(rows)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.result
+
+    def _collect(self):
+        """
+        Coalesce the queued requests into batches and hand them to the pool.
+        """
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+            #wait for a free worker first, meanwhile the queue fills and the batch grows
+            self.inflight.acquire()
+            batch = [request]
+            rows = len(request.rows)
+            deadline = request.start + self.maxWait
+            while rows < self.batchSize:
+                try:
+                    request = self.queue.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                if request is None:
+                    self.queue.put(None)
+                    break
+                batch.append(request)
+                rows += len(request.rows)
+            block = batch[0].rows if len(batch) == 1 else np.vstack([request.rows for request in batch])
+            self.pool.apply_async(_scoreBatch, (block,), callback=self._finisher(batch, rows))
+
+    def _finisher(self, batch, rows, pending=None):
+        """
+        Callback of a scored batch. A failed batch of several requests is scored again one
+        request at a time, so that the error of one request never reaches the others; pending
+        counts the requests of such a batch still being scored, and the worker slot of the
+        batch is released when the last of them is done.
+        """
+        def finish(result):
+            predicted, error = result
+            if error is not None and len(batch) > 1:
+                #the callbacks all run in the result thread of the pool, so the counter needs no lock
+                remaining = [len(batch)]
+                for request in batch:
+                    self.pool.apply_async(_scoreBatch, (request.rows,),
+                                          callback=self._finisher([request], len(request.rows), remaining))
+                return
+            if pending is None:
+                self.inflight.release()
+            else:
+                pending[0] -= 1
+                if not pending[0]:
+                    self.inflight.release()
+            self.statistics.batch(batch, rows, error)
+            start = 0
+            for request in batch:
+                if error is None:
+                    request.result = predicted[start:start + len(request.rows)]
+                    start += len(request.rows)
+                request.error = error
+                request.done.set()
+        return finish
+
+    def close(self):
+        """
+        Score the queued requests and stop the workers.
+        """
+        self.queue.put(None)
+        self.collector.join()
+        #wait for the batches in flight, a failed batch still submits its requests again
+        for slot in range(2 * self.workers):
+            self.inflight.acquire()
+        self.pool.close()
+        self.pool.join()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    JSON endpoints of the service.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            result = self.server.service.statistics.results()
+            result.update(columns=self.server.service.columns, max_wait=self.server.service.maxWait,
+                          batch_size=self.server.service.batchSize, workers=self.server.service.workers)
+            self._reply(200, result)
+        else:
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            rows = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))['rows']
+            photoz = self.server.service.predict(rows)
+        except (ValueError, KeyError, TypeError) as error:
+            self._reply(400, {'error': str(error)})
+        except RuntimeError as error:
+            self._reply(500, {'error': str(error)})
+        else:
+            self._reply(200, {'photo_z': photoz.tolist()})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    #with the default backlog of 5 connections bursts of clients are refused and retried after a second
+    request_queue_size = 128
+
+
+def serve(model, scaler=None, host='127.0.0.1', port=8080, **kwargs):
+    """
+    Run the scoring service until interrupted, the keyword arguments are passed to ScoringService.
+    """
+    service = ScoringService(model, scaler, **kwargs)
+    server = _Server((host, port), _Handler)
+    server.service = service
+    print 'Scoring with %s on http://%s:%i (max wait %.1f ms, batch size %i, %i workers)' % \
+          (model, host, server.server_address[1], 1e3 * service.maxWait, service.batchSize, service.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()
+    return service.statistics.results()
+
+
+def _post(url, rows):
+    request = urllib2.Request(url + '/predict', json.dumps({'rows': rows}), {'Content-Type': 'application/json'})
+    return json.loads(urllib2.urlopen(request).read())['photo_z']
+
+
+def stats(url):
+    """
+    The statistics of a running service.
+    """
+    return json.loads(urllib2.urlopen(url + '/stats').read())
+
+
+def loadTest(url, catalog, clients=8, requests=1000, rows=1, maxRows=100000):
+    """
+    Load generator: clients concurrent clients send requests of rows galaxies each, taken
+    from the catalog (at most its first maxRows rows), to the service at url, until
+    requests requests have been sent in total.
+
+    :return: dictionary of the client side latency percentiles and the throughput, and the
+             statistics of the service over the test
+    """
+    columns = [str(column) for column in stats(url)['columns']]
+    galaxies = next(_readKaggleChunks(catalog, columns, maxRows))[1].tolist()
+    before = stats(url)
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = (i * rows) % max(len(galaxies) - rows, 1)
+            begin = time.time()
+            _post(url, galaxies[start:start + rows])
+            with lock:
+                latencies.append(time.time() - begin)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+
+    after = stats(url)
+    result = dict(clients=clients, requests=requests, rows=requests * rows, duration=duration,
+                  requests_per_second=requests / duration, rows_per_second=requests * rows / duration)
+    result['p50'], result['p99'] = np.percentile(latencies, [50, 99])
+    result['batches'] = after['batches'] - before['batches']
+    result['rows_per_batch'] = (after['rows'] - before['rows']) / float(max(result['batches'], 1))
+    print '%i clients, %i requests of %i rows: p50 %.2f ms, p99 %.2f ms, %.0f requests/s, %.1f rows per batch' % \
+          (clients, requests, rows, 1e3 * result['p50'], 1e3 * result['p99'], result['requests_per_second'],
+           result['rows_per_batch'])
+    return result
+
+
+def _parser():
+    main = argparse.ArgumentParser(description='Local photo-z scoring service.')
+    commands = main.add_subparsers()
+
+    command = commands.add_parser('serve', help='run the scoring service')
+    command.add_argument('model', help='model store folder or pickled model')
+    command.add_argument('--scaler', help='pickled scaler or features transform (default: saved with the model)')
+    command.add_argument('--no-errors', action='store_true', help='the model was trained without the errors '
+                                                                  '(only with --scaler)')
+    command.add_argument('--host', default='127.0.0.1')
+    command.add_argument('--port', type=int, default=8080)
+    command.add_argument('--max-wait', type=float, default=0.002, help='longest wait for a batch in seconds')
+    command.add_argument('--batch-size', type=int, default=2048, help='largest number of rows in a batch')
+    command.add_argument('--workers', type=int, default=1, help='number of workers, -1 for all the cores')
+    command.add_argument('--processes', action='store_true', help='score in worker processes instead of threads')
+    command.set_defaults(function=lambda args: serve(args.model, args.scaler, args.host, args.port,
+                                                     useErrors=not args.no_errors, maxWait=args.max_wait,
+                                                     batchSize=args.batch_size, workers=args.workers,
+                                                     processes=args.processes))
+
+    command = commands.add_parser('load', help='load test a running service')
+    command.add_argument('url', help='address of the service, e.g. http://127.0.0.1:8080')
+    command.add_argument('catalog', help='csv file with the raw columns of the galaxies')
+    command.add_argument('--clients', type=int, default=8, help='number of concurrent clients')
+    command.add_argument('--requests', type=int, default=1000, help='total number of requests')
+    command.add_argument('--rows', type=int, default=1, help='galaxies per request')
+    command.set_defaults(function=lambda args: loadTest(args.url, args.catalog, args.clients, args.requests,
+                                                        args.rows))
+    return main
+
+
+if __name__ == '__main__':
+    args = _parser().parse_args(sys.argv[1:])
+    args.function(args)
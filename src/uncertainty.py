@@ -0,0 +1,107 @@
+"""
+Photo-z Uncertainty
+===================
+
+Per-galaxy uncertainties of the photometric redshifts.
+
+For a random forest the spread of the predictions of the individual trees is used. The
+mean and the standard deviation over the trees are accumulated tree by tree with
+vectorized running moments (Welford's algorithm), so a single pass over the trees is
+needed and only a few vectors of the length of the catalog are held in memory, never
+the trees x galaxies matrix of predictions.
+
+Quantiles cannot be accumulated with running moments. They are computed from the leaf
+values the galaxy falls into in every tree, i.e. the quantiles of the conditional
+distribution of a quantile regression forest in which each leaf is represented by its
+value. With small leaves (min_samples_leaf=2 in randomForest) the leaf values are
+close to the training redshifts in the leaves. The trees x galaxies values are held for
+one chunk of galaxies at a time.
+
+For gradient boosting the quantiles are instead predicted with companion models trained
+with the quantile loss, see GradientBoostingRegressor in photometricRedshifts.
+
+The forest can be a fitted RandomForestRegressor, a batchedForest.BatchedRandomForestRegressor
+or a forest loaded from the model store.
+
+:requires: numpy
+
+:version: 0.1
+"""
+import numpy as np
+
+
+def _treeValues(model, X):
+    """
+    Yield the predictions of the individual trees of a forest for the rows of X.
+    """
+    if hasattr(model, 'ensemble_'):
+        #a batchedForest.BatchedRandomForestRegressor
+        model = model.ensemble_
+    if hasattr(model, 'batches'):
+        for batch in model.batches():
+            for values in _treeValues(batch, X):
+                yield values
+    elif hasattr(model, 'meta'):
+        if model.meta['kind'] != 'forest':
+            raise ValueError('the spread over the trees is only defined for forests, got %s' % model.meta['kind'])
+        X = np.asarray(X, dtype=np.float32)
+        for tree in range(model.meta['n_trees']):
+            yield model._treeValues(X, tree)
+    else:
+        X = np.asarray(X, dtype=np.float32)
+        for tree in model.estimators_:
+            yield tree.predict(X)
+
+
+def forestSpread(model, X, chunksize=100000):
+    """
+    Mean and standard deviation of the predictions of the trees of a forest for each
+    row of X, accumulated in a single pass over the trees with running moments.
+
+    The mean is the prediction of the forest (up to rounding). The rows are processed
+    in chunks of chunksize.
+
+    :return: mean, std
+    """
+    n = X.shape[0]
+    mean, std = np.empty(n), np.empty(n)
+    for start in range(0, n, chunksize):
+        Xchunk = X[start:start + chunksize]
+        m = np.zeros(Xchunk.shape[0])
+        m2 = np.zeros(Xchunk.shape[0])
+        delta = np.empty(Xchunk.shape[0])
+        count = 0
+        for values in _treeValues(model, Xchunk):
+            count += 1
+            np.subtract(values, m, out=delta)
+            m += delta / count
+            m2 += delta * (values - m)
+        mean[start:start + chunksize] = m
+        std[start:start + chunksize] = np.sqrt(m2 / count)
+    return mean, std
+
+
+def forestQuantiles(model, X, quantiles=(0.16, 0.5, 0.84), chunksize=10000):
+    """
+    Quantiles of the leaf values of the trees of a forest for each row of X.
+
+    Only a chunksize x n_trees block of leaf values is held in memory at a time.
+
+    :return: array of shape (n_rows, len(quantiles))
+    """
+    n = X.shape[0]
+    result = np.empty((n, len(quantiles)))
+    for start in range(0, n, chunksize):
+        values = np.array(list(_treeValues(model, X[start:start + chunksize])))
+        result[start:start + chunksize] = np.percentile(values, 100. * np.asarray(quantiles), axis=0).T
+    return result
+
+
+def coverage(predicted, expected, error):
+    """
+    Fraction of the galaxies whose redshift is within the estimated error of the
+    prediction, about 0.68 for well calibrated one sigma errors.
+    """
+    fraction = np.mean(np.abs(expected - predicted) <= error)
+    print 'Fraction of galaxies within the estimated error: %.3f (0.683 for Gaussian 1 sigma errors)' % fraction
+    return fraction
@@ -0,0 +1,51 @@
+"""
+Tests of the approximate kernel SVR.
+"""
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import photometricRedshifts as pz
+from benchmark import syntheticCatalog
+from approximateSVR import ApproximateKernelSVR
+
+
+class ApproximateKernelSVRTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        folder = tempfile.mkdtemp()
+        try:
+            syntheticCatalog(os.path.join(folder, 'train.csv'), 5000)
+            cls.data = pz.loadKaggledata(folder=folder + '/')
+        finally:
+            shutil.rmtree(folder)
+
+    def _check(self, solver, method, kernels):
+        X_train, X_test, y_train, y_test = self.data
+        for kernel in kernels:
+            for C in (0.1, 2.):
+                model = ApproximateKernelSVR(kernel=kernel, C=C, method=method, solver=solver, n_components=100,
+                                             random_state=0).fit(X_train, y_train)
+                rms = np.sqrt(np.mean((model.predict(X_test) - y_test) ** 2))
+                #better than predicting the mean redshift
+                self.assertTrue(np.isfinite(rms) and rms < np.std(y_test),
+                                '%s %s %s C=%s: RMS %f' % (solver, method, kernel, C, rms))
+
+    def test_ridge(self):
+        self._check('ridge', 'nystroem', ('rbf', 'poly', 'sigmoid'))
+        self._check('ridge', 'fourier', ('rbf',))
+
+    def test_sgd(self):
+        self._check('sgd', 'nystroem', ('rbf', 'poly', 'sigmoid'))
+        self._check('sgd', 'fourier', ('rbf',))
+
+    def test_defaultSolverIsRidge(self):
+        self.assertEqual(ApproximateKernelSVR().solver, 'ridge')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+Tests of the folders of the batched random forest.
+"""
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.ensemble import RandomForestRegressor
+from batchedForest import BatchedRandomForestRegressor
+
+
+class BatchedForestTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = rng.normal(size=(500, 4)).astype(np.float32)
+        self.y = np.sin(self.X[:, 0]) + rng.normal(0, 0.3, 500)
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_temporaryFolder(self):
+        forest = BatchedRandomForestRegressor(n_estimators=20, batch_size=7, random_state=0).fit(self.X, self.y)
+        folder = forest.temporaryFolder_
+        expected = RandomForestRegressor(n_estimators=20, random_state=0).fit(self.X, self.y).predict(self.X)
+        np.testing.assert_array_equal(forest.predict(self.X), expected)
+        forest.close()
+        self.assertFalse(os.path.exists(folder))
+
+    def test_givenFolderIsKept(self):
+        model = os.path.join(self.folder, 'RF')
+        os.makedirs(model)
+        features = os.path.join(model, 'features.pkl')
+        open(features, 'w').close()
+        forest = BatchedRandomForestRegressor(n_estimators=20, batch_size=7, folder=model, random_state=0)
+        #refitting replaces the batches but keeps the other files of the folder
+        forest.fit(self.X, self.y)
+        forest.set_params(batch_size=10).fit(self.X, self.y)
+        self.assertEqual(sorted(os.listdir(model)), ['batch00000', 'batch00001', 'features.pkl', 'meta.json'])
+        forest.close()
+        self.assertTrue(os.path.exists(features))
+
+
+if __name__ == '__main__':
+    unittest.main()
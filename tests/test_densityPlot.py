@@ -0,0 +1,33 @@
+"""
+Tests of the density plots.
+"""
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from densityPlot import RedshiftDensity
+
+
+class DensityPlotTest(unittest.TestCase):
+
+    def test_plotUsesTheRcParams(self):
+        rng = np.random.RandomState(0)
+        z = rng.uniform(0, 1, 1000)
+        density = RedshiftDensity(bins=20)
+        density.update(z + rng.normal(0, 0.02, 1000), z)
+        folder = tempfile.mkdtemp()
+        try:
+            density.plot(os.path.join(folder, 'density.png'))
+            self.assertTrue(os.path.exists(os.path.join(folder, 'density.png')))
+        finally:
+            shutil.rmtree(folder)
+        import matplotlib
+        #set by plotting._configureMatplotlib, the default is 10
+        self.assertEqual(matplotlib.rcParams['font.size'], 17)
+
+
+if __name__ == '__main__':
+    unittest.main()
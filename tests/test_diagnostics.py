@@ -0,0 +1,29 @@
+"""
+Tests of the single-pass staged deviance.
+"""
+import numpy as np
+import unittest
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.ensemble import GradientBoostingRegressor
+from diagnostics import stagedDeviance
+
+
+class StagedDevianceTest(unittest.TestCase):
+
+    def test_sameAsLossOfStagedPredict(self):
+        rng = np.random.RandomState(0)
+        X = rng.normal(size=(1000, 4))
+        y = np.sin(X[:, 0]) + 0.3 * X[:, 1] + rng.standard_t(3, 1000) * 0.2
+        for loss in ('ls', 'huber', 'lad', 'quantile'):
+            model = GradientBoostingRegressor(n_estimators=50, loss=loss, subsample=0.8, random_state=0)
+            model.fit(X[:600], y[:600])
+            expected = [model.loss_(y[600:], predicted) for predicted in model.staged_predict(X[600:])]
+            #chunks smaller than the test set
+            np.testing.assert_allclose(stagedDeviance(model, X[600:], y[600:], chunksize=150), expected,
+                                       rtol=1e-10, err_msg=loss)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+"""
+Tests of the early stopping of the gradient boosting.
+"""
+import numpy as np
+import unittest
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.ensemble import GradientBoostingRegressor as GBR
+from photometricRedshifts import EarlyStoppingMonitor
+
+
+class EarlyStoppingTest(unittest.TestCase):
+
+    def test_huberStops(self):
+        rng = np.random.RandomState(0)
+        X = rng.normal(size=(600, 4))
+        y = np.sin(X[:, 0]) + 0.3 * X[:, 1] + rng.normal(0, 0.3, 600)
+        X_train, X_valid, y_train, y_valid = X[:400], X[400:], y[:400], y[400:]
+        clf = GBR(n_estimators=3000, learning_rate=0.05, loss='huber', max_depth=4, subsample=0.8, random_state=0)
+        monitor = EarlyStoppingMonitor(X_valid, y_valid, patience=100)
+        clf.fit(X_train, y_train, monitor=monitor)
+        #the fit stopped patience stages after the best one, long before the last stage
+        self.assertLess(len(clf.estimators_), 3000)
+        self.assertEqual(len(clf.estimators_), monitor.best + monitor.patience + 1)
+        #and the best stage has the lowest validation error of all the stages
+        errors = [np.mean((y_valid - predicted) ** 2) for predicted in clf.staged_predict(X_valid)]
+        self.assertEqual(int(np.argmin(errors)), monitor.best)
+        monitor.keepBest(clf)
+        self.assertEqual(len(clf.estimators_), monitor.best + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
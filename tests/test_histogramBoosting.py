@@ -0,0 +1,42 @@
+"""
+Tests of the histogram gradient boosting against the sklearn GBR.
+"""
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.ensemble import GradientBoostingRegressor
+import photometricRedshifts as pz
+from benchmark import syntheticCatalog
+from histogramBoosting import HistogramGradientBoostingRegressor
+
+
+class HistogramBoostingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        folder = tempfile.mkdtemp()
+        try:
+            syntheticCatalog(os.path.join(folder, 'train.csv'), 5000)
+            cls.data = pz.loadKaggledata(folder=folder + '/')
+        finally:
+            shutil.rmtree(folder)
+
+    def _rms(self, model):
+        X_train, X_test, y_train, y_test = self.data
+        model.fit(X_train, y_train)
+        return np.sqrt(np.mean((model.predict(X_test) - y_test) ** 2))
+
+    def test_sameAccuracyAsSklearn(self):
+        for loss in ('ls', 'huber', 'quantile'):
+            settings = dict(pz.GRADIENT_BOOSTING, loss=loss, n_estimators=200, random_state=0)
+            expected = self._rms(GradientBoostingRegressor(**settings))
+            rms = self._rms(HistogramGradientBoostingRegressor(n_jobs=1, **settings))
+            self.assertLess(abs(rms - expected), 0.05 * expected, '%s: RMS %f against %f' % (loss, rms, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Tests of the successive halving search and of the halving branch of SupportVectorRegression.
+"""
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import json
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.svm import SVR
+import photometricRedshifts as pz
+from hyperparameterSearch import SuccessiveHalvingSearch, sampleCandidates
+
+
+def _data(n=300, random_state=0):
+    rng = np.random.RandomState(random_state)
+    X = rng.normal(size=(n, 4))
+    y = 0.3 * X[:, 0] - 0.2 * X[:, 1] ** 2 + rng.normal(0, 0.05, n)
+    return X, y
+
+
+class SuccessiveHalvingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.folder)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def test_degreeOnlyForPolynomialKernel(self):
+        grid = [{'C': [0.1, 1.], 'kernel': ['rbf', 'sigmoid']}, {'C': [0.1, 1.], 'kernel': ['poly'], 'degree': [3, 5]}]
+        candidates = sampleCandidates(grid, 100, random_state=0)
+        self.assertEqual(len(candidates), 8)
+        self.assertEqual(len(set(json.dumps(c, sort_keys=True) for c in candidates)), 8)
+        for candidate in candidates:
+            self.assertEqual('degree' in candidate, candidate['kernel'] == 'poly')
+
+    def test_staleTrialLogIgnored(self):
+        X, y = _data()
+        parameters = {'C': [0.1, 1., 10.]}
+        search = SuccessiveHalvingSearch(SVR(), parameters, n_candidates=3, n_jobs=1, folder='search/', verbose=0)
+        search.fit(X, y)
+        trials = len(open('search/trials.jsonl').readlines())
+        #the same search again reuses all the trials
+        SuccessiveHalvingSearch(SVR(), parameters, n_candidates=3, n_jobs=1, folder='search/', verbose=0).fit(X, y)
+        self.assertEqual(len(open('search/trials.jsonl').readlines()), trials)
+        #other data and another estimator run all the trials again
+        SuccessiveHalvingSearch(SVR(), parameters, n_candidates=3, n_jobs=1, folder='search/',
+                                verbose=0).fit(X, y + 1.)
+        self.assertEqual(len(open('search/trials.jsonl').readlines()), 2 * trials)
+        SuccessiveHalvingSearch(SVR(epsilon=0.2), parameters, n_candidates=3, n_jobs=1, folder='search/',
+                                verbose=0).fit(X, y)
+        self.assertEqual(len(open('search/trials.jsonl').readlines()), 3 * trials)
+
+    def test_supportVectorRegressionHalving(self):
+        X, y = _data(400)
+        predicted, expected = pz.SupportVectorRegression(X[:300], X[300:], y[:300], y[300:], search='halving',
+                                                         n_jobs=1)
+        self.assertEqual(predicted.shape, expected.shape)
+        self.assertTrue(np.all(np.isfinite(predicted)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""
+Tests of the incremental updates of the photo-z models.
+"""
+import numpy as np
+import unittest
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn import linear_model
+from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+from incremental import SufficientStatisticsBayesianRidge, _rescaleTrees
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = rng.normal(size=(3000, 5)) * [1., 2., 0.5, 3., 1.] + [0., 1., -2., 5., 0.]
+        self.y = np.dot(self.X, [0.3, -0.1, 0.5, 0.05, 0.]) + rng.normal(0, 0.1, 3000)
+        self.shift = rng.normal(0, 0.5, 5)
+        self.scale = rng.uniform(0.5, 2., 5)
+
+    def test_bayesianRidgeFromStatistics(self):
+        X, y, shift, scale = self.X, self.y, self.shift, self.scale
+        model = SufficientStatisticsBayesianRidge(n_iter=1000, tol=1e-3, alpha_1=1.).fit(X[:1000], y[:1000])
+        model.partial_fit(X[1000:1500], y[1000:1500])
+        #from here on the features are (X - shift) / scale
+        model.rescale(shift, scale)
+        X = (X - shift) / scale
+        model.partial_fit(X[1500:2200], y[1500:2200])
+        model.partial_fit(X[2200:], y[2200:])
+        expected = linear_model.BayesianRidge(n_iter=1000, tol=1e-3, alpha_1=1.).fit(X, y)
+        np.testing.assert_allclose(model.coef_, expected.coef_, rtol=1e-8, atol=1e-9)
+        self.assertAlmostEqual(model.intercept_, expected.intercept_, places=8)
+        self.assertAlmostEqual(model.alpha_ / expected.alpha_, 1., places=8)
+        self.assertAlmostEqual(model.lambda_ / expected.lambda_, 1., places=8)
+        np.testing.assert_allclose(model.predict(X[:100]), expected.predict(X[:100]), rtol=1e-8, atol=1e-9)
+
+    def test_rescaledTreesPredictTheSame(self):
+        X, y = self.X.astype(np.float32), self.y
+        query = (self.X[::7] + 0.01).astype(np.float32)
+        rescaled = ((query - self.shift) / self.scale).astype(np.float32)
+        for model in (RandomForestRegressor(n_estimators=20, random_state=0),
+                      GradientBoostingRegressor(n_estimators=50, subsample=0.8, random_state=0)):
+            model.fit(X, y)
+            expected = model.predict(query)
+            trees = model.estimators_.ravel() if hasattr(model, 'learning_rate') else model.estimators_
+            _rescaleTrees(trees, self.shift, self.scale)
+            np.testing.assert_array_equal(model.predict(rescaled), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
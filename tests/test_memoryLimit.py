@@ -0,0 +1,80 @@
+"""
+Tests of the memory limit of the worker processes.
+"""
+import numpy as np
+import multiprocessing
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.ensemble import GradientBoostingRegressor
+from hyperparameterSearch import _limitMemory
+from diagnostics import DiagnosticsRunner
+from pipeline import PipelineRunner
+
+
+def _allocate(size):
+    try:
+        return np.ones(size, dtype=np.uint8).sum()
+    except MemoryError:
+        return None
+
+
+def _allocatingJob(X_train, X_test, y_train, y_test, size=0):
+    np.ones(size, dtype=np.uint8).sum()
+    return y_test, y_test
+
+
+class MemoryLimitTest(unittest.TestCase):
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), 'needs /proc')
+    def test_limitIsAboveTheInheritedMemory(self):
+        #the workers inherit this array, which is larger than the limit
+        inherited = np.ones(300 * 1024 ** 2, dtype=np.uint8)
+        pool = multiprocessing.Pool(1, initializer=_limitMemory, initargs=(100 * 1024 ** 2,))
+        try:
+            self.assertEqual(pool.apply(_allocate, (50 * 1024 ** 2,)), 50 * 1024 ** 2)
+            self.assertIsNone(pool.apply(_allocate, (200 * 1024 ** 2,)))
+        finally:
+            pool.terminate()
+            pool.join()
+        del inherited
+
+    def test_poolIsTerminatedOnMemoryError(self):
+        rng = np.random.RandomState(0)
+        X = rng.normal(size=(2000, 4))
+        y = X[:, 0] + rng.normal(0, 0.1, 2000)
+        folder = tempfile.mkdtemp()
+        try:
+            runner = DiagnosticsRunner(X[:1500], X[1500:], y[:1500], y[1500:], folder=folder, n_jobs=1,
+                                       memoryBudget=1024, verbose=0)
+            tasks = runner.devianceTasks([GradientBoostingRegressor(n_estimators=10)])
+            self.assertRaises(MemoryError, runner.compute, tasks)
+            self.assertEqual(multiprocessing.active_children(), [])
+        finally:
+            shutil.rmtree(folder)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), 'needs /proc')
+    def test_pipelineJobIsCappedAtItsMemory(self):
+        #the workers inherit this array, which must not be added to the memory of the jobs twice
+        inherited = np.ones(300 * 1024 ** 2, dtype=np.uint8)
+        rng = np.random.RandomState(0)
+        X, y = rng.normal(size=(100, 4)), rng.normal(size=100)
+        folder = tempfile.mkdtemp()
+        try:
+            runner = PipelineRunner(X[:80], X[80:], y[:80], y[80:], n_jobs=1, folder=folder, verbose=0)
+            jobs = [{'name': 'within', 'function': _allocatingJob, 'kwargs': {'size': 50 * 1024 ** 2},
+                     'memory': 100 * 1024 ** 2},
+                    {'name': 'beyond', 'function': _allocatingJob, 'kwargs': {'size': 200 * 1024 ** 2},
+                     'memory': 100 * 1024 ** 2}]
+            results = runner.run(jobs)
+            self.assertEqual([result['status'] for result in results], ['done', 'MemoryError'])
+        finally:
+            shutil.rmtree(folder)
+        del inherited
+
+
+if __name__ == '__main__':
+    unittest.main()
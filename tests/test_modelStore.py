@@ -0,0 +1,48 @@
+"""
+Tests of the model store evaluation.
+"""
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+import modelStore
+
+
+class ModelStoreTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        cls.X = rng.normal(size=(2000, 6)).astype(np.float32)
+        cls.y = np.sin(cls.X[:, 0]) + 0.3 * cls.X[:, 1] + rng.normal(0, 0.3, 2000)
+
+    def _check(self, model):
+        model.fit(self.X[:1000], self.y[:1000])
+        folder = tempfile.mkdtemp()
+        try:
+            modelStore.saveEnsemble(model, folder)
+            store = modelStore.loadEnsemble(folder)
+            X = self.X[1000:]
+            expected = model.predict(X)
+            #large batches use the sklearn trees, small ones NumPy, both exactly as the model
+            np.testing.assert_array_equal(store.predict(X), expected)
+            np.testing.assert_array_equal(store.predict(X, n_jobs=2), expected)
+            np.testing.assert_array_equal(store.predict(X, smallBatch=10**9), expected)
+            for rows in (1, 2, 50):
+                np.testing.assert_array_equal(store.predict(X[:rows]), expected[:rows])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_randomForest(self):
+        self._check(RandomForestRegressor(n_estimators=30, min_samples_leaf=2, random_state=0))
+
+    def test_gradientBoosting(self):
+        self._check(GradientBoostingRegressor(n_estimators=300, loss='huber', subsample=0.8, random_state=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""
+Tests of the nearest neighbour regression.
+"""
+import numpy as np
+import multiprocessing
+import unittest
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.neighbors import KNeighborsRegressor
+from nearestNeighbours import NearestNeighbourRegressor
+
+
+class NearestNeighbourTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = rng.normal(size=(500, 4))
+        self.y = self.X[:, 0] + rng.normal(0, 0.1, 500)
+
+    def test_sameAsSklearn(self):
+        model = NearestNeighbourRegressor(batch_size=64, n_jobs=2).fit(self.X[:400], self.y[:400])
+        expected = KNeighborsRegressor(n_neighbors=10, weights='distance').fit(self.X[:400], self.y[:400])
+        np.testing.assert_allclose(model.predict(self.X[400:]), expected.predict(self.X[400:]))
+
+    def test_emptyInput(self):
+        model = NearestNeighbourRegressor().fit(self.X, self.y)
+        self.assertEqual(model.predict(np.empty((0, 4))).shape, (0,))
+        mean, std = model.predict(np.empty((0, 4)), return_std=True)
+        self.assertEqual((mean.shape, std.shape), ((0,), (0,)))
+
+    def test_poolIsTerminatedOnError(self):
+        model = NearestNeighbourRegressor(batch_size=64, n_jobs=2).fit(self.X, self.y)
+        #the wrong number of columns fails in the workers
+        self.assertRaises(ValueError, model.predict, np.zeros((300, 3)))
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Tests of the isolation of the requests of the scoring service.
+"""
+import numpy as np
+import threading
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from sklearn.ensemble import GradientBoostingRegressor
+import photometricRedshifts as pz
+import modelStore
+import scoringService
+from benchmark import syntheticCatalog
+
+
+class ScoringServiceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        syntheticCatalog(os.path.join(cls.folder, 'train.csv'), 2000)
+        features = pz.PhotometricFeatures()
+        X_train, X_test, y_train, y_test = pz.loadKaggledata(folder=cls.folder + '/', features=features)
+        cls.model = os.path.join(cls.folder, 'model/')
+        modelStore.saveEnsemble(GradientBoostingRegressor(n_estimators=20).fit(X_train, y_train), cls.model)
+        modelStore.saveFeatures(features, cls.model)
+        #raw columns of the catalog, in the order the service expects
+        cls.rows = np.random.RandomState(0).uniform(18, 22, size=(50, len(features.columns))).astype(np.float32)
+        cls.rows[:, 5:] = 0.05
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def setUp(self):
+        #a long wait so that the concurrent requests are coalesced into one batch
+        self.service = scoringService.ScoringService(self.model, maxWait=0.2)
+
+    def tearDown(self):
+        self.service.close()
+
+    def _concurrent(self, requests):
+        results = [None] * len(requests)
+
+        def send(i):
+            try:
+                results[i] = self.service.predict(requests[i])
+            except Exception as error:
+                results[i] = error
+
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_badRequestDoesNotFailTheBatch(self):
+        requests = [self.rows[i:i + 1] for i in range(len(self.rows))]
+        requests[7] = requests[7].copy()
+        requests[7][0, 2] = np.nan
+        results = self._concurrent(requests)
+        self.assertIsInstance(results[7], ValueError)
+        expected = self.service.predict(self.rows)
+        for i, result in enumerate(results):
+            if i != 7:
+                np.testing.assert_array_equal(result, expected[i:i + 1])
+
+    def test_emptyRequest(self):
+        self.assertRaises(ValueError, self.service.predict, np.zeros((0, len(self.service.columns))))
+        self.assertRaises(ValueError, self.service.predict, [])
+
+    def test_failedBatchIsRescoredPerRequest(self):
+        score = scoringService._scoreBatch
+
+        def failBatches(block):
+            #only batches of several requests fail
+            if len(block) > 1:
+                return None, 'RuntimeError: batch failed'
+            return score(block)
+
+        scoringService._scoreBatch = failBatches
+        try:
+            results = self._concurrent([self.rows[i:i + 1] for i in range(10)])
+        finally:
+            scoringService._scoreBatch = score
+        self.assertTrue(all(isinstance(result, np.ndarray) and len(result) == 1 for result in results))
+
+
+if __name__ == '__main__':
+    unittest.main()